@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import logging
+import sys
+import time
+
+import omero
+import omero.clients
+assert omero.clients
+
+from getopt import getopt, GetoptError
+from omero.model import ChannelI, EventI, EventTypeI, ExperimenterI, \
+    ExperimenterGroupI, ImageI, PixelsI, TagAnnotationI, WellI, WellSampleI
+from omero.sys import ParametersI
+
+from . import prune
+from .document import QUERY_WELL_IDS
+from .loader import BATCH_SIZE, LOADERS
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+
+def usage(error=None):
+    """
+    Prints usage so that we don't have to. :)
+    """
+    cmd = sys.argv[0]
+    if error:
+        print error
+    print """Usage:
+  %(cmd)s <options>
+
+Benchmarks unloading the parts of Well object graphs that are not indexed
+with the single pass pruner against the original walk of the graph
+
+Options:
+  -s                  server hostname
+  -p                  server port
+  -u                  username
+  -w                  password
+  -h                  display this help and exit
+  --plate <id>        benchmark with the Wells of a Plate loaded from OMERO
+  --loader <s>        loader to use for --plate (default: 'join')
+  --wells <n>         benchmark with <n> generated Wells (default: 384)
+  --fields <n>        WellSamples per generated Well (default: 16)
+  --channels <n>      Channels per generated Image (default: 4)
+  --annotations <n>   annotations per generated Image (default: 5)
+  --repeat <n>        number of times to run each benchmark (default: 3)
+  --debug             turn debugging on
+
+Examples:
+    %(cmd)s --wells 1536 --fields 9
+    %(cmd)s -s localhost -p 4064 -u jsmith -w secret --plate 1
+
+Report bugs to support@glencoesoftware.com""" % {'cmd': cmd}
+    sys.exit(2)
+
+
+def unload_annotation_details(obj):
+    if obj.isAnnotationLinksLoaded():
+        for annotation_link in obj.copyAnnotationLinks():
+            annotation_link.child.unloadDetails()
+
+
+def walk_well(obj):
+    """
+    The original, hand written, walk of a Well's object graph that
+    `omero_es.prune.WELL` replaces.
+    """
+    obj.details.owner.unloadDetails()
+    obj.details.group.unloadDetails()
+    obj.details.creationEvent.unloadDetails()
+    obj.details.creationEvent.type.unloadDetails()
+    obj.details.updateEvent.unloadDetails()
+    obj.details.updateEvent.type.unloadDetails()
+    if obj.isWellSamplesLoaded() and obj.sizeOfWellSamples() > 0:
+        for wellsample in obj.copyWellSamples():
+            wellsample.unloadDetails()
+            image = wellsample.image
+            if image is not None and image.isLoaded():
+                image.unloadDetails()
+                unload_annotation_details(image)
+                if image.isPixelsLoaded():
+                    pixels = image.getPrimaryPixels()
+                    pixels.unloadDetails()
+                    if pixels.isChannelsLoaded():
+                        for channel in pixels.copyChannels():
+                            channel.unloadDetails()
+                            unload_annotation_details(channel)
+    unload_annotation_details(obj)
+
+
+def set_details(obj, owner, group, event):
+    obj.details.setOwner(owner)
+    obj.details.setGroup(group)
+    obj.details.setCreationEvent(event)
+    obj.details.setUpdateEvent(event)
+    return obj
+
+
+def generate_wells(wells, fields, channels, annotations):
+    """
+    Generates Wells with the same shape as those loaded for indexing.  The
+    owner, group, event and annotations are shared as they would be.
+    """
+    owner = ExperimenterI(1L, True)
+    group = ExperimenterGroupI(1L, True)
+    event = EventI(1L, True)
+    event.type = EventTypeI(1L, True)
+    tags = [
+        set_details(TagAnnotationI(v + 1L, True), owner, group, event)
+        for v in range(annotations)
+    ]
+    generated = list()
+    for i in range(wells):
+        well = set_details(WellI(i + 1L, True), owner, group, event)
+        for j in range(fields):
+            _id = i * fields + j + 1L
+            wellsample = set_details(
+                WellSampleI(_id, True), owner, group, event
+            )
+            image = set_details(ImageI(_id, True), owner, group, event)
+            pixels = set_details(PixelsI(_id, True), owner, group, event)
+            for k in range(channels):
+                pixels.addChannel(set_details(
+                    ChannelI(_id * channels + k, True), owner, group, event
+                ))
+            image.addPixels(pixels)
+            for tag in tags:
+                image.linkAnnotation(tag)
+            wellsample.image = image
+            well.addWellSample(wellsample)
+        for tag in tags:
+            well.linkAnnotation(tag)
+        generated.append(well)
+    return generated
+
+
+def load_wells(client, plate_id, loader):
+    session = client.getSession()
+    query_service = session.getQueryService()
+    ids = [r[0].val for r in query_service.projection(
+        QUERY_WELL_IDS, ParametersI().addId(plate_id),
+        {'omero.group': '-1'}
+    )]
+    wells = list()
+    loader = LOADERS[loader]()
+    for i in range(0, len(ids), BATCH_SIZE):
+        wells.extend(loader.load_wells(query_service, ids[i:i + BATCH_SIZE]))
+    return wells
+
+
+def benchmark(name, load, walk, repeat):
+    """
+    Times `walk` over freshly loaded Wells, best of `repeat` runs.
+    """
+    best = None
+    for i in range(repeat):
+        wells = load()
+        wellsamples = sum([v.sizeOfWellSamples() for v in wells])
+        t0 = time.time()
+        for well in wells:
+            walk(well)
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    log.info(
+        '%s: %d Wells, %d WellSamples (%.1fms)' % (
+            name, len(wells), wellsamples, best * 1000
+        )
+    )
+    return best
+
+
+def main():
+    try:
+        options, args = getopt(
+            sys.argv[1:], "s:p:u:w:h", [
+                "debug", "plate=", "loader=", "wells=", "fields=",
+                "channels=", "annotations=", "repeat="
+            ]
+        )
+    except GetoptError, (msg, _opt):
+        usage(msg)
+
+    level = logging.INFO
+    server = username = password = None
+    port = 4064
+    plate_id = None
+    loader = 'join'
+    shape = {'wells': 384, 'fields': 16, 'channels': 4, 'annotations': 5}
+    repeat = 3
+    for option, argument in options:
+        if option == "-s":
+            server = argument
+        if option == "-p":
+            port = int(argument)
+        if option == "-u":
+            username = argument
+        if option == "-w":
+            password = argument
+        if option == "-h":
+            usage()
+        if option == "--debug":
+            level = logging.DEBUG
+        if option == "--plate":
+            plate_id = long(argument)
+        if option == "--loader":
+            if argument not in LOADERS:
+                usage('Invalid loader: %s' % argument)
+            loader = argument
+        if option in ("--wells", "--fields", "--channels", "--annotations"):
+            shape[option[2:]] = int(argument)
+        if option == "--repeat":
+            repeat = int(argument)
+
+    format = "%(asctime)s %(levelname)-7s [%(name)16s] %(message)s"
+    logging.basicConfig(level=level, format=format)
+
+    client = None
+    if plate_id is not None:
+        if server is None or username is None or password is None:
+            usage('Server, username and password required with --plate!')
+        client = omero.client(server, port)
+        client.createSession(username, password)
+        load = lambda: load_wells(client, plate_id, loader)
+    else:
+        load = lambda: generate_wells(**shape)
+    try:
+        walked = benchmark('Walk', load, walk_well, repeat)
+        pruned = benchmark('Prune', load, prune.WELL.prune, repeat)
+        if pruned > 0:
+            log.info('Pruner speedup %.2fx' % (walked / pruned))
+    finally:
+        if client is not None:
+            client.closeSession()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+from Queue import Queue
+
+from elasticsearch import TransportError
+from elasticsearch.helpers import BulkIndexError
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Same defaults as `elasticsearch.helpers.bulk()`; the chunk size is only
+# the initial one when adapting to the observed latency
+CHUNK_SIZE = 500
+
+MAX_CHUNK_BYTES = 100 * 1024 * 1024
+
+# Bounds of the adapted chunk size
+MIN_CHUNK_SIZE = 10
+
+MAX_CHUNK_SIZE = 10000
+
+# Bulk request latency, in seconds, that the chunk size is adapted to
+TARGET_LATENCY = 1.0
+
+# Number of times rejected actions are retried, and the backoff, in
+# seconds, before the first and any retry
+MAX_RETRIES = 8
+
+INITIAL_BACKOFF = 1.0
+
+MAX_BACKOFF = 60.0
+
+# HTTP status of actions and requests rejected by an overloaded cluster
+REJECTED = 429
+
+# HTTP status of externally versioned actions whose document is already
+# indexed at the same or a newer version; skipped if it is unchanged
+CONFLICT = 409
+
+# Error type of an update whose document does not exist; reported to the
+# action's writer rather than failed
+DOCUMENT_MISSING = 'document_missing_exception'
+
+# Metadata of an action that identifies its document for a multi get
+DOCUMENT_METADATA = ('_index', '_type', '_id', '_parent')
+
+# Number of bulk requests in flight at once
+CONCURRENCY = 2
+
+# Marks the end of the chunks queued for sending
+END = object()
+
+
+def status(item):
+    """
+    Returns the status of an item of a bulk API response.  Deleting a
+    document that is already gone is not a failure.
+    """
+    op, result = item.items()[0]
+    if 'error' in result and 'status' not in result:
+        return 500
+    if op == 'delete' and result.get('status') == 404:
+        return 200
+    return result.get('status', 500)
+
+
+def missing(item):
+    """
+    Returns whether an item of a bulk API response is an update of a
+    document that does not exist.
+    """
+    op, result = item.items()[0]
+    error = result.get('error')
+    return op == 'update' and isinstance(error, dict) and \
+        error.get('type') == DOCUMENT_MISSING
+
+
+def read_actions(path):
+    """
+    Reads the bulk API actions of an NDJSON file such as a dead letter
+    file; each an action and a source line, or only the action line of a
+    delete.  Files with a `.gz` suffix are decompressed.
+    """
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    else:
+        f = open(path)
+    with f:
+        while True:
+            action = f.readline()
+            if not action:
+                return
+            if action.startswith('{"delete"'):
+                yield action
+                continue
+            source = f.readline()
+            if not source:
+                return
+            yield action + source
+
+
+class DeadLetters(object):
+    """
+    Appends the actions that failed permanently to an NDJSON file that can
+    be resubmitted later.  Each action is written with a single `write()`
+    to a file opened for appending so that processes can share the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, actions):
+        with self.lock:
+            for action in actions:
+                os.write(self.fd, action)
+                self.count += 1
+
+    def close(self):
+        os.close(self.fd)
+        if self.count > 0:
+            log.warn(
+                'Wrote %d failed actions to %s' % (self.count, self.path)
+            )
+
+
+class Writer(object):
+    """
+    Sends the actions of a single container to a shared `Sink` and keeps
+    the per container accounting of how many of them succeeded or were
+    skipped, either as the document was already indexed with the same
+    source at the same or a newer version or because the sink's
+    fingerprint store found the document unchanged.  Updates of documents
+    that do not exist are neither successes nor failures; their response
+    items are kept in `missing` for the caller to index the documents in
+    full.  The sink records the fingerprints of the actions sent as they
+    are indexed.
+    """
+
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self.submitted = 0
+        self.acknowledged = 0
+        self.success = 0
+        self.skipped = 0
+        self.failed = list()
+        self.missing = list()
+        self.error = None
+        self.completed = None
+        self.condition = threading.Condition()
+
+    def send(self, actions):
+        """
+        Queues pre-serialized bulk API `actions`, each the newline
+        terminated action and source lines, and returns their number;
+        including those dropped as unchanged.
+        """
+        store = self.sink.fingerprints
+        count = 0
+        for action in actions:
+            count += 1
+            fingerprint = None
+            if store is not None:
+                fingerprint = store.check(action)
+                if fingerprint is None:
+                    with self.condition:
+                        self.skipped += 1
+                    continue
+            with self.condition:
+                self.submitted += 1
+            self.sink.add(self, action, fingerprint)
+        return count
+
+    def acknowledge(self, count, failed=(), error=None, skipped=0,
+                    missing=()):
+        """
+        Records the outcome of `count` of the actions sent; those that
+        `failed` or, if `error` is specified, all of them.  `skipped` of
+        them were not written as the document was already up to date and
+        `missing` updated documents that do not exist.
+        """
+        with self.condition:
+            self.acknowledged += count
+            if error is None:
+                self.success += count - len(failed) - skipped - len(missing)
+                self.skipped += skipped
+                self.failed.extend(failed)
+                self.missing.extend(missing)
+            elif self.error is None:
+                self.error = error
+            self.completed = time.time()
+            self.condition.notify_all()
+
+    def wait(self):
+        """
+        Blocks until all the actions sent have been acknowledged and
+        returns the number that succeeded.  Like
+        `elasticsearch.helpers.bulk()` raises `BulkIndexError` if any
+        failed, or the error of a failed request.
+        """
+        self.sink.flush(self)
+        with self.condition:
+            while self.acknowledged < self.submitted:
+                self.condition.wait(1)
+        if self.error is not None:
+            raise self.error
+        if len(self.failed) > 0:
+            raise BulkIndexError(
+                '%i document(s) failed to index.' % len(self.failed),
+                self.failed
+            )
+        return self.success
+
+
+class Sink(object):
+    """
+    A long lived, per process, bulk API sink that the actions of all
+    containers stream into.  Actions are buffered until either the chunk
+    size or `max_chunk_bytes` bytes are reached, regardless of which
+    container they belong to, and the chunk is then sent by one of
+    `concurrency` sender threads.  Adding blocks once `concurrency` chunks
+    are waiting to be sent so that memory use stays bounded.
+
+    The chunk size starts at `chunk_size` and is adapted to the cluster:
+    grown while requests complete within `target_latency` seconds, shrunk
+    in proportion when they do not and halved when actions are rejected.
+    Rejected actions are retried, up to `max_retries` times with
+    exponential backoff; those that still fail, or fail for any other
+    reason, are written to `dead_letters` if specified.  Updates of
+    documents that do not exist are not failures; see `Writer`.  Actions
+    for documents that a `fingerprints` store, if specified, finds
+    unchanged are dropped by their writer, and the fingerprints of the
+    others are recorded with each bulk response, only for the actions that
+    were indexed; see `omero_es.fingerprint`.
+    """
+
+    def __init__(self, es, chunk_size=CHUNK_SIZE,
+                 max_chunk_bytes=MAX_CHUNK_BYTES, concurrency=CONCURRENCY,
+                 target_latency=TARGET_LATENCY, max_retries=MAX_RETRIES,
+                 dead_letters=None, fingerprints=None):
+        self.es = es
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.dead_letters = dead_letters
+        self.fingerprints = fingerprints
+        self.lock = threading.Lock()
+        self.actions = list()
+        self.size = 0
+        self.writers = list()
+        # Fingerprints of the buffered actions, `None` without a store
+        self.pending = list()
+        self.chunks = Queue(concurrency)
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.sizes = [chunk_size]
+        self.threads = list()
+        for i in range(concurrency):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def writer(self, name):
+        return Writer(self, name)
+
+    def take(self):
+        chunk = (self.actions, self.writers, self.pending)
+        self.actions = list()
+        self.size = 0
+        self.writers = list()
+        self.pending = list()
+        return chunk
+
+    def add(self, writer, action, fingerprint=None):
+        chunk = None
+        with self.lock:
+            if len(self.writers) > 0 and (
+                    len(self.writers) >= self.chunk_size or
+                    self.size + len(action) > self.max_chunk_bytes):
+                chunk = self.take()
+            self.actions.append(action)
+            self.size += len(action)
+            self.writers.append(writer)
+            self.pending.append(fingerprint)
+        if chunk is not None:
+            self.chunks.put(chunk)
+
+    def flush(self, writer=None):
+        """
+        Sends the buffered actions now; if `writer` is specified only when
+        some of them are its own.
+        """
+        with self.lock:
+            if len(self.writers) == 0:
+                return
+            if writer is not None and writer not in self.writers:
+                return
+            chunk = self.take()
+        self.chunks.put(chunk)
+
+    def adapt(self, count, elapsed, rejected):
+        """
+        Adapts the chunk size following a request of `count` actions that
+        took `elapsed` seconds and of which `rejected` were rejected.
+        """
+        if self.target_latency is None:
+            return
+        with self.lock:
+            size = self.chunk_size
+            if rejected > 0:
+                size = size / 2
+            elif elapsed > self.target_latency:
+                size = int(size * self.target_latency / elapsed)
+            elif count >= size:
+                # Only grow when requests are limited by the chunk size
+                size += max(MIN_CHUNK_SIZE, size / 10)
+            size = max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size))
+            if size == self.chunk_size:
+                return
+            log.debug(
+                'Chunk size %d -> %d (%d actions, %d rejected, %dms)' % (
+                    self.chunk_size, size, count, rejected, elapsed * 1000
+                )
+            )
+            self.chunk_size = size
+            self.sizes.append(size)
+
+    def fail(self, actions, writers=(), error=None):
+        """
+        Writes actions that failed permanently to the dead letter file and,
+        if the `error` failed all of them, fails them with their `writers`.
+        """
+        if self.dead_letters is not None:
+            self.dead_letters.write(actions)
+        for writer in set(writers):
+            writer.acknowledge(writers.count(writer), error=error)
+
+    def unchanged(self, actions):
+        """
+        Returns whether the document of each of the index `actions`
+        rejected with a version conflict is already indexed with the same
+        source.  Only those are up to date; a conflicting document whose
+        source differs has not been written.
+        """
+        docs = list()
+        sources = list()
+        for action in actions:
+            metadata, source = action.split('\n', 1)
+            metadata = json.loads(metadata).values()[0]
+            docs.append(dict([
+                (k, v) for k, v in metadata.iteritems()
+                if k in DOCUMENT_METADATA
+            ]))
+            sources.append(json.loads(source))
+        try:
+            response = self.es.mget(body={'docs': docs})
+        except TransportError:
+            log.error(
+                'Failed to compare %d conflicting documents' % len(actions),
+                exc_info=True
+            )
+            return [False] * len(actions)
+        return [
+            v.get('found', False) and v.get('_source') == expected
+            for v, expected in zip(response['docs'], sources)
+        ]
+
+    def request(self, actions, writers, fingerprints):
+        """
+        Sends a single bulk request, records the fingerprints of the
+        actions that were indexed and returns the actions, their writers
+        and fingerprints, that were rejected and can be retried.
+        """
+        body = ''.join(actions)
+        t0 = time.time()
+        try:
+            response = self.es.bulk(body=body)
+        except TransportError, e:
+            if e.status_code != REJECTED:
+                raise
+            self.adapt(len(actions), time.time() - t0, len(actions))
+            return actions, writers, fingerprints
+        elapsed = time.time() - t0
+        counts = dict()
+        skipped = dict()
+        failures = dict()
+        absent = dict()
+        retry = (list(), list(), list())
+        conflicts = list()
+        dead = list()
+        indexed = list()
+        for action, writer, fingerprint, item in zip(
+                actions, writers, fingerprints, response['items']):
+            _status = status(item)
+            if _status == REJECTED:
+                retry[0].append(action)
+                retry[1].append(writer)
+                retry[2].append(fingerprint)
+                continue
+            counts[writer] = counts.get(writer, 0) + 1
+            if _status == CONFLICT:
+                conflicts.append((action, writer, fingerprint, item))
+            elif missing(item):
+                absent.setdefault(writer, list()).append(item)
+            elif not 200 <= _status < 300:
+                failures.setdefault(writer, list()).append(item)
+                dead.append(action)
+            elif fingerprint is not None:
+                indexed.append(fingerprint)
+        if len(conflicts) > 0:
+            for (action, writer, fingerprint, item), unchanged in zip(
+                    conflicts, self.unchanged([v[0] for v in conflicts])):
+                if unchanged:
+                    skipped[writer] = skipped.get(writer, 0) + 1
+                    if fingerprint is not None:
+                        indexed.append(fingerprint)
+                else:
+                    failures.setdefault(writer, list()).append(item)
+                    dead.append(action)
+        if len(indexed) > 0:
+            self.fingerprints.record(indexed)
+        self.fail(dead)
+        for writer, count in counts.iteritems():
+            writer.acknowledge(
+                count, failures.get(writer, ()),
+                skipped=skipped.get(writer, 0), missing=absent.get(writer, ())
+            )
+        self.adapt(len(actions), elapsed, len(retry[0]))
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(body)
+        log.debug(
+            'Bulk request of %d actions, %d bytes, %d containers, '
+            '%d rejected (%dms)' % (
+                len(actions), len(body), len(set(writers)), len(retry[0]),
+                elapsed * 1000
+            )
+        )
+        return retry
+
+    def send(self, actions, writers, fingerprints):
+        backoff = INITIAL_BACKOFF
+        for attempt in range(self.max_retries + 1):
+            try:
+                actions, writers, fingerprints = self.request(
+                    actions, writers, fingerprints
+                )
+            except Exception, e:
+                log.error(
+                    'Bulk request of %d actions failed' % len(actions),
+                    exc_info=True
+                )
+                self.fail(actions, writers, e)
+                return
+            if len(actions) == 0:
+                return
+            if attempt == self.max_retries:
+                break
+            log.warn(
+                '%d actions rejected, retrying in %.1fs' % (
+                    len(actions), backoff
+                )
+            )
+            with self.lock:
+                self.retries += 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        self.fail(actions, writers, BulkIndexError(
+            '%i document(s) rejected %d times.' % (
+                len(actions), self.max_retries + 1
+            ), []
+        ))
+
+    def run(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is END:
+                return
+            self.send(*chunk)
+
+    def close(self):
+        """
+        Sends any buffered actions and waits for all requests to complete.
+        """
+        self.flush()
+        for thread in self.threads:
+            self.chunks.put(END)
+        for thread in self.threads:
+            thread.join()
+        if self.dead_letters is not None:
+            self.dead_letters.close()
+        if self.fingerprints is not None:
+            self.fingerprints.close()
+        log.info(
+            'Sent %d bulk requests, %d bytes, %d retries; chunk size %d '
+            '(min %d, max %d)' % (
+                self.requests, self.bytes, self.retries, self.chunk_size,
+                min(self.sizes), max(self.sizes)
+            )
+        )
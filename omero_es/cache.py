@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import logging
+import threading
+
+from collections import OrderedDict
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Default maximum number of entries in each cache
+DEFAULT_SIZE = 10000
+
+
+class LRUCache(object):
+    """
+    Bounded mapping that evicts the least recently used entry once full.
+    Safe to share between the threads of an indexing pipeline.
+    """
+
+    def __init__(self, name, maxsize=DEFAULT_SIZE):
+        self.name = name
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize < 1:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.entries) > max(maxsize, 0):
+                self.entries.popitem(last=False)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        if lookups < 1:
+            return
+        log.info(
+            '%s cache %d entries, %d hits of %d lookups (%.1f%%)' % (
+                self.name, len(self.entries), self.hits, lookups,
+                self.hits * 100.0 / lookups
+            )
+        )
+
+
+# Annotations, loaded once with their details unloaded, by
+# `(id, update event id)`
+annotations = LRUCache('Annotation')
+
+# Encoded annotations by `(id, update event id)`
+encoded_annotations = LRUCache('Encoded Annotation')
+
+# Encoded owners, groups and events of `details` by class, id, version and
+# which of them is loaded; see `omero_es.encoders.caching`
+encoded_details = LRUCache('Encoded details')
+
+CACHES = [annotations, encoded_annotations, encoded_details]
+
+
+def resize(maxsize):
+    """
+    Sets the maximum number of entries of each of this process' caches; 0
+    disables them.
+    """
+    for cache in CACHES:
+        cache.resize(maxsize)
+
+
+def report():
+    for cache in CACHES:
+        cache.report()
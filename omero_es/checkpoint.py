@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+import logging
+import os
+import threading
+import time
+
+from datetime import timedelta
+from itertools import islice
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Default number of Images or Wells of a container indexed between
+# checkpoints of its position
+CHECKPOINT_SIZE = 10000
+
+# Parent tasks of shards complete the container they are named after; see
+# `omero_es.planning.split()`
+CONTAINERS = {
+    'ProjectParent': 'Project',
+    'PlateParent': 'Plate',
+}
+
+
+def read_journal(path):
+    """
+    Returns the latest entry of a journal for each key.  A partially
+    written last line, left by a crash, is ignored.
+    """
+    state = dict()
+    if not os.path.exists(path):
+        return state
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            state[entry['key']] = entry
+    return state
+
+
+def ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == '\n'
+
+
+class Journal(object):
+    """
+    Durable, append only, NDJSON journal of the progress of a run.  Tasks,
+    and Plates within Screens, are recorded as done once all of their
+    documents have been indexed.  Large containers also record their
+    position, the Dataset if loading Dataset by Dataset and the id of the
+    last Image or Well indexed, every `CHECKPOINT_SIZE` Images or Wells.
+    Each entry is written with a single `write()` to a file opened for
+    appending, and synced, so that processes can share the journal and
+    entries survive a crash.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = read_journal(path)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.lock = threading.Lock()
+        if not ends_with_newline(path):
+            # Terminates a partially written last line
+            os.write(self.fd, '\n')
+
+    def done(self, key):
+        return self.state.get(key, {}).get('done', False)
+
+    def position(self, key):
+        position = self.state.get(key, {}).get('position')
+        if position is None:
+            return None
+        return tuple(position)
+
+    def record(self, key, **entry):
+        entry.update(key=key, time=time.time())
+        with self.lock:
+            os.write(self.fd, json.dumps(entry) + '\n')
+            os.fsync(self.fd)
+            self.state[key] = entry
+
+    def close(self):
+        os.close(self.fd)
+
+
+# This process' journal, if any; see `use()`
+journal = None
+
+
+def use(path):
+    """
+    Selects the journal of this process; none if `path` is `None`.
+    """
+    global journal
+    journal = None
+    if path is not None:
+        journal = Journal(path)
+        log.info(
+            'Using journal %s, %d entries' % (path, len(journal.state))
+        )
+
+
+def key(task):
+    kind, _id = task
+    return '%s:%s' % (CONTAINERS.get(kind, kind), _id)
+
+
+def done(key):
+    return journal is not None and journal.done(key)
+
+
+def position(key):
+    if journal is None:
+        return None
+    return journal.position(key)
+
+
+def record(key, **entry):
+    if journal is not None:
+        journal.record(key, **entry)
+
+
+def remaining(estimates):
+    """
+    Returns the estimates of the tasks that the journal does not record as
+    done.
+    """
+    if journal is None:
+        return estimates
+    left = dict([
+        (k, v) for k, v in estimates.iteritems() if not journal.done(key(k))
+    ])
+    if len(left) < len(estimates):
+        log.info(
+            'Resuming, skipping %d of %d tasks already done' % (
+                len(estimates) - len(left), len(estimates)
+            )
+        )
+    return left
+
+
+def remaining_shards(estimates, parents):
+    """
+    Returns the estimates and parents of the shard tasks, and remaining
+    tasks, that the journal does not record as done; see
+    `omero_es.planning.split()`.  The parent of shards that are all done
+    is run as a task of its own.
+    """
+    if journal is None:
+        return estimates, parents
+    left = dict()
+    skipped = 0
+    for task, estimate in estimates.iteritems():
+        parent = parents.get(task)
+        if journal.done(key(task)) or \
+                (parent is not None and journal.done(key(parent))):
+            skipped += 1
+            continue
+        left[task] = estimate
+    left_parents = dict([(k, v) for k, v in parents.iteritems() if k in left])
+    waiting = set(left_parents.values())
+    for parent in set(parents.values()):
+        if parent not in waiting and not journal.done(key(parent)):
+            left[parent] = 0
+    if skipped > 0:
+        log.info(
+            'Resuming, skipping %d of %d shard tasks already done' % (
+                skipped, len(estimates)
+            )
+        )
+    return left, left_parents
+
+
+class Segments(object):
+    """
+    Splits an iterable into consecutive segments of at most `size` items
+    so that each can be indexed, and checkpointed, in turn.  `exhausted`
+    is set once a segment comes up short.
+    """
+
+    def __init__(self, iterable, size):
+        self.iterator = iter(iterable)
+        self.size = size
+        self.exhausted = False
+
+    def __iter__(self):
+        while not self.exhausted:
+            yield self.segment()
+
+    def segment(self):
+        count = 0
+        for item in islice(self.iterator, self.size):
+            count += 1
+            yield item
+        if count < self.size:
+            self.exhausted = True
+
+
+def format_duration(seconds):
+    return str(timedelta(seconds=int(seconds)))
+
+
+class Progress(object):
+    """
+    Logs the progress of a run through its tasks, and the estimated time
+    remaining given the rate at which the estimated work has been done so
+    far.
+    """
+
+    def __init__(self, estimates):
+        self.estimates = estimates
+        self.total = sum(estimates.values())
+        self.done = 0
+        self.tasks = 0
+        self.t0 = time.time()
+
+    def update(self, task):
+        self.tasks += 1
+        self.done += self.estimates.get(task, 0)
+        elapsed = time.time() - self.t0
+        eta = 'unknown'
+        if self.done > 0:
+            eta = format_duration(
+                elapsed * (self.total - self.done) / self.done
+            )
+        log.info(
+            'Progress %d/%d tasks, %d/%d estimated documents (%.1f%%), '
+            'elapsed %s, ETA %s' % (
+                self.tasks, len(self.estimates), self.done, self.total,
+                self.done * 100.0 / max(self.total, 1),
+                format_duration(elapsed), eta
+            )
+        )
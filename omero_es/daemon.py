@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+import logging
+import os
+import signal
+import sys
+import time
+
+import omero
+import omero.clients
+assert omero.clients
+
+from elasticsearch.helpers import scan
+from getopt import getopt, GetoptError
+from omero.rtypes import rlong
+from omero.sys import ParametersI
+
+from . import incremental, serializer, transport
+from .incremental import BATCH_SIZE, LINK_TYPES, TYPES, annotation_changes, \
+    resolve
+from .index import configure, index_serial, report
+from .loader import LOADERS
+from .settings import SETTINGS, create_sink, describe_error
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Number of EventLog entries read per query
+PAGE_SIZE = 1000
+
+# Seconds after which tasks that failed are retried
+RETRY_INTERVAL = 60
+
+QUERY_LATEST_EVENT_LOG_ID = """SELECT max(log.id) FROM EventLog AS log"""
+
+QUERY_EVENT_LOG = """SELECT log.id, log.entityType, log.entityId, log.action
+FROM EventLog AS log
+WHERE log.id > :cursor
+ORDER BY log.id
+"""
+
+# Prefix of the type under which deleted objects are queued
+DELETED = 'Deleted'
+
+# Document type of the objects whose documents are deleted along with
+# them, by type.  The documents including a deleted annotation have their
+# annotations updated instead.  Deleted links, and Datasets and Screens,
+# are not followed as what they linked is no longer known.
+DELETED_TYPES = {
+    'Project': 'project',
+    'Image': 'image',
+    'Plate': 'plate',
+    'Well': 'well',
+}
+
+QUERY_LINKS = """SELECT link.parent.id, link.child.id FROM %s AS link
+WHERE link.id IN (:ids)
+"""
+
+QUERY_ANNOTATION_LINK_PARENTS = """SELECT link.parent.id
+FROM %sAnnotationLink AS link
+WHERE link.id IN (:ids)
+"""
+
+QUERY_ANNOTATED = """SELECT DISTINCT link.parent.id
+FROM %sAnnotationLink AS link
+WHERE link.child.id IN (:ids)
+"""
+
+# Type and query resolving the ids of the objects of other types whose
+# changes affect documents, by type
+RELATED = {
+    'WellSample': ('Well', """SELECT wellsample.well.id
+FROM WellSample AS wellsample
+WHERE wellsample.id IN (:ids)
+"""),
+    'Pixels': ('Image', """SELECT pixels.image.id FROM Pixels AS pixels
+WHERE pixels.id IN (:ids)
+"""),
+    'Channel': ('Image', """SELECT channel.pixels.image.id
+FROM Channel AS channel
+WHERE channel.id IN (:ids)
+"""),
+    'LogicalChannel': ('Image', """SELECT channel.pixels.image.id
+FROM Channel AS channel
+WHERE channel.logicalChannel.id IN (:ids)
+"""),
+}
+
+
+def usage(error=None):
+    """
+    Prints usage so that we don't have to. :)
+    """
+    cmd = sys.argv[0]
+    if error:
+        print error
+    print """Usage:
+  %(cmd)s <options>
+
+Continuously re-indexes the documents affected by changes recorded in the
+OMERO EventLog; requires an administrator
+
+Options:
+  -s                  server hostname
+  -p                  server port
+  -u                  username
+  -w                  password
+  -h                  display this help and exit
+  --url               Elasticsearch base URL to save documents into
+  --debug             turn debugging on
+  --index             index to write into (default: 'omero')
+  --cursor <f>        file recording the latest EventLog entry indexed;
+                      if missing indexing starts from the latest entry
+                      (default: 'cursor.json')
+  --poll <s>          seconds between polls of the EventLog when there
+                      are no new entries (default: 1)
+  --quiet <s>         seconds without new changes after which the
+                      changes collected are indexed (default: 2)
+  --max-delay <s>     maximum seconds a change waits to be indexed
+                      (default: 30)
+  --max-pending <n>   maximum number of distinct changed objects collected
+                      before they are indexed (default: 100000)
+  --retry <s>         seconds after which tasks that failed to index, or
+                      to delete the documents of deleted objects, are
+                      retried; the cursor is not advanced until they
+                      succeed (default: 60)
+  --loader <s>        loader to use (default: 'join'); annotations are
+                      only cached with 'narrow'
+  --fast-encoders     encode with the specialized encoders
+  --compress          gzip the bodies of bulk requests
+  --dead-letters <f>  NDJSON file to append documents that failed to
+                      index to
+
+Deleted Projects, Images, Plates and Wells have their documents deleted
+and the documents including deleted annotations are updated.  Removed
+links, unlinked annotations and deleted Datasets and Screens are not
+followed; use 'python -m omero_es.reconcile' to delete the documents of
+unlinked Images, and re-index to drop unlinked annotations.
+
+Examples:
+    %(cmd)s -s localhost -p 4064 -u root -w secret \\
+        --url http://localhost:9200
+
+Report bugs to support@glencoesoftware.com""" % {'cmd': cmd}
+    sys.exit(2)
+
+
+def read_cursor(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['event_log_id']
+
+
+def write_cursor(path, event_log_id):
+    # Replaced atomically so that it is never left half written
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'event_log_id': event_log_id, 'time': time.time()}, f)
+    os.rename(tmp, path)
+
+
+def queued_kind(kind, action):
+    """
+    Returns the type under which a change to an object of `kind` is
+    queued.  Deletions, of annotations of any type, are queued apart.
+    """
+    if action != 'DELETE':
+        return kind
+    if kind.endswith('Annotation'):
+        kind = 'Annotation'
+    return DELETED + kind
+
+
+def relevant(kind):
+    """
+    Whether changes to objects of the queued `kind` can affect documents.
+    """
+    if kind.startswith(DELETED):
+        kind = kind[len(DELETED):]
+        return kind in DELETED_TYPES or kind == 'Annotation'
+    return kind in TYPES or kind in LINK_TYPES or kind in RELATED or \
+        kind.endswith('Annotation') or kind.endswith('AnnotationLink')
+
+
+class ChangeQueue(object):
+    """
+    Coalesces the changes read from the EventLog into the distinct objects
+    changed, by type, so that a burst of changes to the same objects, an
+    import for example, is indexed once.  The changes are ready to be
+    indexed once none have been added for `quiet` seconds, the first has
+    waited `max_delay` seconds or there are `max_pending` of them; memory
+    use is bounded by the latter.
+    """
+
+    def __init__(self, quiet, max_delay, max_pending):
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.reset()
+
+    def reset(self):
+        self.changes = dict()
+        self.size = 0
+        self.events = 0
+        self.first = None
+        self.last = None
+
+    def add(self, kind, _id):
+        ids = self.changes.setdefault(kind, set())
+        if _id not in ids:
+            ids.add(_id)
+            self.size += 1
+        self.events += 1
+        self.last = time.time()
+        if self.first is None:
+            self.first = self.last
+
+    @property
+    def full(self):
+        return self.size >= self.max_pending
+
+    def ready(self):
+        if self.size == 0:
+            return False
+        now = time.time()
+        return self.full or now - self.last >= self.quiet or \
+            now - self.first >= self.max_delay
+
+    def take(self):
+        changes, events = self.changes, self.events
+        self.reset()
+        return changes, events
+
+
+def poll(query_service, cursor):
+    """
+    Returns the next page of `(id, type, entity_id, action)` EventLog
+    entries following `cursor`.
+    """
+    params = ParametersI()
+    params.add('cursor', rlong(cursor))
+    params.page(0, PAGE_SIZE)
+    return [
+        (r[0].val, r[1].val.rsplit('.', 1)[-1], r[2].val, r[3].val)
+        for r in query_service.projection(
+            QUERY_EVENT_LOG, params, {'omero.group': '-1'}
+        )
+    ]
+
+
+def resolve_changes(query_service, pending):
+    """
+    Resolves the changed objects collected from the EventLog, by type, to
+    the changes understood by `omero_es.incremental.plan()`.
+    """
+    changes = dict([(kind, set()) for kind in TYPES + LINK_TYPES])
+    for kind in TYPES:
+        changes[annotation_changes(kind)] = set()
+    annotation_ids = set()
+    for kind, ids in pending.iteritems():
+        if kind in TYPES:
+            changes[kind].update(ids)
+        elif kind in LINK_TYPES:
+            changes[kind].update(
+                resolve(query_service, QUERY_LINKS % kind, ids)
+            )
+        elif kind.endswith('AnnotationLink'):
+            parent = kind[:-len('AnnotationLink')]
+            if parent in TYPES:
+                changes[annotation_changes(parent)].update([
+                    r[0] for r in resolve(
+                        query_service, QUERY_ANNOTATION_LINK_PARENTS % parent,
+                        ids
+                    )
+                ])
+        elif kind.endswith('Annotation'):
+            annotation_ids.update(ids)
+        elif kind in RELATED:
+            target, query = RELATED[kind]
+            changes[target].update(
+                [r[0] for r in resolve(query_service, query, ids)]
+            )
+    if len(annotation_ids) > 0:
+        for kind in TYPES:
+            changes[annotation_changes(kind)].update([r[0] for r in resolve(
+                query_service, QUERY_ANNOTATED % kind, annotation_ids
+            )])
+    return changes
+
+
+def find_documents(es, index, doc_type, query):
+    """
+    Yields the hits, with their `@id`, of all the documents of `doc_type`
+    matching `query`.
+    """
+    return scan(
+        es, query={'query': query, '_source': ['@id']}, index=index,
+        doc_type=doc_type, size=PAGE_SIZE
+    )
+
+
+def find_annotated(es, index, annotation_ids):
+    """
+    Returns the ids of the objects whose documents include any of the
+    annotations with `annotation_ids`, by type.
+    """
+    annotation_ids = sorted(annotation_ids)
+    annotated = dict()
+    for kind, doc_type in DELETED_TYPES.iteritems():
+        ids = annotated.setdefault(kind, set())
+        for i in range(0, len(annotation_ids), BATCH_SIZE):
+            query = {'terms': {
+                'Annotations.@id': annotation_ids[i:i + BATCH_SIZE]
+            }}
+            if doc_type != 'well':
+                # Well documents are mapped dynamically, without nested
+                # annotations
+                query = {'nested': {'path': 'Annotations', 'query': query}}
+            ids.update([
+                v['_source']['@id']
+                for v in find_documents(es, index, doc_type, query)
+            ])
+    return annotated
+
+
+def delete_documents(sink, index, kind, ids):
+    """
+    Deletes the documents of the deleted objects of the queued `kind`
+    with `ids` and returns a result like `omero_es.index.finish_task()`.
+    """
+    doc_type = DELETED_TYPES[kind[len(DELETED):]]
+    ids = tuple(sorted(ids))
+    t0 = time.time()
+    writer = sink.writer('%s:%d' % (kind, len(ids)))
+    count = 0
+    error = None
+    try:
+        for i in range(0, len(ids), BATCH_SIZE):
+            hits = find_documents(
+                sink.es, index, doc_type,
+                {'terms': {'@id': list(ids[i:i + BATCH_SIZE])}}
+            )
+            count += writer.send([
+                serializer.delete_action(
+                    index, doc_type, v['_id'], v.get('_parent')
+                ) for v in hits
+            ])
+        sink.flush(writer)
+        writer.wait()
+    except Exception, e:
+        log.error('Failed to delete %s documents' % doc_type, exc_info=True)
+        error = describe_error(e)
+    return (kind, ids, count, time.time() - t0, error, 0)
+
+
+def process(client, sink, index, settings, queue, retry):
+    """
+    Indexes the changes collected by `queue`, along with the tasks to
+    `retry`, and returns the tasks that failed.  The documents of deleted
+    objects are deleted first; those tasks are `(<queued kind>, ids)`.
+    """
+    changes, events = queue.take()
+    deleted = dict([
+        (k, changes.pop(k)) for k in changes.keys() if k.startswith(DELETED)
+    ])
+    tasks = set()
+    for task in retry:
+        if task[0].startswith(DELETED):
+            deleted.setdefault(task[0], set()).update(task[1])
+        else:
+            tasks.add(task)
+    query_service = client.getSession().getQueryService()
+    t0 = time.time()
+    results = list()
+    resolved = resolve_changes(query_service, changes)
+    annotation_ids = deleted.pop(DELETED + 'Annotation', set())
+    if len(annotation_ids) > 0:
+        try:
+            for kind, ids in find_annotated(
+                    sink.es, index, annotation_ids).iteritems():
+                resolved[annotation_changes(kind)].update(ids)
+        except Exception, e:
+            log.error('Failed to find annotated documents', exc_info=True)
+            results.append((
+                DELETED + 'Annotation', tuple(sorted(annotation_ids)), 0,
+                0, describe_error(e), 0
+            ))
+    if sum([len(v) for v in resolved.values()]) > 0:
+        tasks.update(incremental.plan(query_service, resolved))
+    log.info(
+        'Coalesced %d EventLog entries into %d changed objects, %d '
+        'deleted, and %d tasks, %d retried (%dms)' % (
+            events, sum([len(v) for v in changes.values()]),
+            sum([len(v) for v in deleted.values()]) + len(annotation_ids),
+            len(tasks), len(retry), (time.time() - t0) * 1000
+        )
+    )
+    t0 = time.time()
+    for kind, ids in deleted.iteritems():
+        results.append(delete_documents(sink, index, kind, ids))
+    results += index_serial(sink, index, client, sorted(tasks), settings)
+    report(results, time.time() - t0)
+    return set([(v[0], v[1]) for v in results if v[4] is not None])
+
+
+def run(client, sink, index, settings, cursor_path, queue, interval,
+        retry_interval=RETRY_INTERVAL):
+    query_service = client.getSession().getQueryService()
+    cursor = read_cursor(cursor_path)
+    if cursor is None:
+        cursor = query_service.projection(
+            QUERY_LATEST_EVENT_LOG_ID, None, {'omero.group': '-1'}
+        )[0][0].val or 0
+        write_cursor(cursor_path, cursor)
+    log.info('Following the EventLog from EventLog:%d' % cursor)
+    # Latest EventLog entry read; all before `cursor` have been indexed
+    latest = cursor
+    # Tasks that failed, and when they are next retried.  Until they
+    # succeed the cursor stays put so that, if the daemon is restarted,
+    # the changes behind them are read again.
+    failed = set()
+    retry_at = None
+    while True:
+        entries = list()
+        if not queue.full:
+            entries = poll(query_service, latest)
+        for event_log_id, kind, _id, action in entries:
+            latest = event_log_id
+            kind = queued_kind(kind, action)
+            if relevant(kind):
+                queue.add(kind, _id)
+        retry = len(failed) > 0 and time.time() >= retry_at
+        if queue.ready() or retry:
+            failed = process(client, sink, index, settings, queue, failed)
+            if len(failed) > 0:
+                log.warn(
+                    'Not advancing cursor, %d tasks failed; retrying in '
+                    '%ds' % (len(failed), retry_interval)
+                )
+                retry_at = time.time() + retry_interval
+            else:
+                cursor = latest
+                write_cursor(cursor_path, cursor)
+        elif latest > cursor and queue.size == 0 and len(failed) == 0:
+            # Only irrelevant changes
+            cursor = latest
+            write_cursor(cursor_path, cursor)
+        if len(entries) < PAGE_SIZE:
+            time.sleep(interval)
+
+
+def terminate(signum, frame):
+    # Unwinds `main()` so that documents queued are sent and the session
+    # closed
+    raise SystemExit(0)
+
+
+def main():
+    try:
+        options, args = getopt(
+            sys.argv[1:], "s:p:u:w:h", [
+                "debug", "url=", "index=", "cursor=", "poll=", "quiet=",
+                "max-delay=", "max-pending=", "retry=", "loader=",
+                "fast-encoders", "compress", "dead-letters="
+            ]
+        )
+    except GetoptError, (msg, _opt):
+        usage(msg)
+
+    level = logging.INFO
+    server = username = password = url = None
+    port = 4064
+    index = 'omero'
+    cursor_path = 'cursor.json'
+    interval = 1.0
+    quiet = 2.0
+    max_delay = 30.0
+    max_pending = 100000
+    retry_interval = RETRY_INTERVAL
+    settings = dict(SETTINGS)
+    for option, argument in options:
+        if option == "-s":
+            server = argument
+        if option == "-p":
+            port = int(argument)
+        if option == "-u":
+            username = argument
+        if option == "-w":
+            password = argument
+        if option == "-h":
+            usage()
+        if option == "--debug":
+            level = logging.DEBUG
+        if option == "--url":
+            url = argument
+        if option == "--index":
+            index = argument
+        if option == "--cursor":
+            cursor_path = argument
+        if option == "--poll":
+            interval = float(argument)
+        if option == "--quiet":
+            quiet = float(argument)
+        if option == "--max-delay":
+            max_delay = float(argument)
+        if option == "--max-pending":
+            max_pending = int(argument)
+        if option == "--retry":
+            retry_interval = float(argument)
+        if option == "--loader":
+            if argument not in LOADERS:
+                usage('Invalid loader: %s' % argument)
+            settings['loader'] = argument
+        if option == "--fast-encoders":
+            settings['fast_encoders'] = True
+        if option == "--compress":
+            settings['compress'] = True
+        if option == "--dead-letters":
+            settings['dead_letters'] = argument
+
+    if server is None or username is None or password is None:
+        usage('Server, username and password required!')
+    if url is None:
+        usage('Elasticsearch URL required!')
+
+    format = "%(asctime)s %(levelname)-7s [%(name)16s] %(message)s"
+    logging.basicConfig(level=level, format=format)
+    configure(settings)
+    signal.signal(signal.SIGTERM, terminate)
+
+    sink = create_sink(url, settings)
+    client = omero.client(server, port)
+    client.createSession(username, password)
+    client.enableKeepAlive(60)
+    try:
+        run(
+            client, sink, index, settings, cursor_path,
+            ChangeQueue(quiet, max_delay, max_pending), interval,
+            retry_interval
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.close()
+        transport.sent.report()
+        client.closeSession()
+
+
+if __name__ == '__main__':
+    main()
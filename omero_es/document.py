@@ -15,6 +15,7 @@ import math
 import sys
 import time
 
+from copy import copy
 from pprint import pformat
 
 from mx.DateTime import gmtime
@@ -23,12 +24,16 @@ import omero.clients
 assert omero.clients
 
 from omero import UnloadedEntityException
+from omero.rtypes import rlist, rlong
 from omero.sys import ParametersI
 from omero_marshal import get_encoder
 
 # Override various `omero_marshal` encoders with our own
 import omero_es.encoders
 
+from . import prune, serializer
+from .loader import LOADERS, QUERY_DATASET_FILTER
+
 
 # Package scoped logger
 log = logging.getLogger(__name__)
@@ -43,45 +48,37 @@ WHERE project.id = :id
 GROUP BY dataset.id
 """
 
-QUERY_IMAGES = """SELECT image FROM Image AS image
-LEFT OUTER JOIN FETCH image.annotationLinks AS i_a_link
-LEFT OUTER JOIN FETCH i_a_link.child
-JOIN FETCH image.details.creationEvent as c_event
-JOIN FETCH c_event.type
-JOIN FETCH image.details.updateEvent as u_event
-JOIN FETCH u_event.type
-JOIN FETCH image.details.owner
-JOIN FETCH image.details.group AS eg
-JOIN FETCH eg.groupExperimenterMap AS eg_e_map
-JOIN FETCH eg_e_map.child
-JOIN FETCH image.pixels AS pixels
-JOIN FETCH pixels.channels AS channel
-JOIN FETCH channel.logicalChannel
-JOIN FETCH image.datasetLinks AS i_d_link
+QUERY_IMAGE_IDS = """SELECT image.id FROM Image AS image
+JOIN image.datasetLinks AS i_d_link
+WHERE i_d_link.parent.id = :id
+"""
+
+QUERY_PROJECT_IMAGE_IDS = """SELECT DISTINCT image.id FROM Image AS image
+JOIN image.datasetLinks AS i_d_link
 JOIN i_d_link.parent AS dataset
-WHERE dataset.id = :id
+JOIN dataset.projectLinks AS p_d_link
+WHERE p_d_link.parent.id = :id
+"""
+
+QUERY_WELL_IDS = """SELECT well.id FROM Well AS well
+WHERE well.plate.id = :id
+"""
+
+# Appended to `QUERY_IMAGE_IDS` or `QUERY_WELL_IDS` to restrict them to a
+# range of Image or Well ids respectively
+QUERY_ID_RANGE = """AND %s.id BETWEEN :first AND :last
+"""
+
+# Appended to `QUERY_IMAGE_IDS` or `QUERY_WELL_IDS` to restrict them to a
+# set of Image or Well ids respectively
+QUERY_ID_FILTER = """AND %s.id IN (:filter_ids)
 """
 
-QUERY_WELLS = """SELECT well FROM Well AS well
-LEFT OUTER JOIN FETCH well.annotationLinks AS w_a_link
-LEFT OUTER JOIN FETCH w_a_link.child
-LEFT OUTER JOIN FETCH well.wellSamples as wellsample
-LEFT OUTER JOIN FETCH wellsample.image as image
-LEFT OUTER JOIN FETCH image.annotationLinks as i_a_link
-LEFT OUTER JOIN FETCH i_a_link.child
-LEFT OUTER JOIN FETCH image.pixels AS pixels
-LEFT OUTER JOIN FETCH pixels.channels AS channel
-LEFT OUTER JOIN FETCH channel.logicalChannel
-JOIN FETCH well.details.creationEvent as c_event
-JOIN FETCH c_event.type
-JOIN FETCH well.details.updateEvent as u_event
-JOIN FETCH u_event.type
-JOIN FETCH well.details.owner
-JOIN FETCH well.details.group AS eg
-JOIN FETCH eg.groupExperimenterMap AS eg_e_map
-JOIN FETCH eg_e_map.child
-JOIN well.plate AS plate
-WHERE plate.id = :id
+# Appended to `QUERY_IMAGE_IDS` or `QUERY_WELL_IDS` to retrieve the page of
+# ids following `:last_id`.  Seeking by id rather than paging with an offset
+# keeps the cost of each page constant however deep into the results it is.
+QUERY_ID_PAGE = """AND %s.id > :last_id
+ORDER BY %s.id
 """
 
 
@@ -115,19 +112,68 @@ Report bugs to support@glencoesoftware.com""" % {'cmd': cmd}
     sys.exit(2)
 
 
+def object_id(obj):
+    return obj.id.val
+
+
 class BaseDocument(object):
 
+    # Serialized `document`, see `source`
+    _source = None
+
+    # Id of the latest Event that updated any of the objects encoded in
+    # `document`; see `omero_es.prune.Pruner.prune()`
+    version = None
+
+    # `(dataset_id, id)` of the last child Image or Well found; the
+    # Dataset only when loading Images Dataset by Dataset
+    position = None
+
     def __init__(self, client):
         self.client = client
 
+    @property
+    def source(self):
+        """
+        The document serialized as JSON.  Only serialized once.
+        """
+        if self._source is None:
+            self._source = serializer.dumps(self.document)
+        return self._source
+
+    def restrict(self, query, params, alias, id_range, ids=None):
+        if ids is not None:
+            params.add('filter_ids', rlist([rlong(v) for v in ids]))
+            query += QUERY_ID_FILTER % alias
+        if id_range is None:
+            return query
+        first, last = id_range
+        params.add('first', rlong(first))
+        params.add('last', rlong(last))
+        return query + QUERY_ID_RANGE % alias
+
+    def find_id_pages(self, query_service, query, params, alias,
+                      last_id=-1):
+        """
+        Yields consecutive pages of at most `page_size` ids, in ascending
+        order, returned by an id projection `query`; those after `last_id`.
+        """
+        query += QUERY_ID_PAGE % (alias, alias)
+        while True:
+            params.add('last_id', rlong(last_id))
+            params.page(0, self.page_size)
+            ids = [r[0].val for r in query_service.projection(
+                query, params, {'omero.group': '-1'}
+            )]
+            if len(ids) > 0:
+                yield ids
+            if len(ids) < self.page_size:
+                return
+            last_id = ids[-1]
+
     def __str__(self):
         return json.dumps(self.document, sort_keys=True, indent=2)
 
-    def unload_annotation_details(self, obj):
-        if obj.isAnnotationLinksLoaded():
-            for annotation_link in obj.copyAnnotationLinks():
-                annotation_link.child.unloadDetails()
-
 
 class ImageDocument(BaseDocument):
 
@@ -138,48 +184,57 @@ class ImageDocument(BaseDocument):
         self.document = self.encode_image(image)
 
     def encode_image(self, obj):
-        obj.details.owner.unloadDetails()
-        obj.details.group.unloadDetails()
-        obj.details.creationEvent.unloadDetails()
-        obj.details.creationEvent.type.unloadDetails()
-        obj.details.updateEvent.unloadDetails()
-        obj.details.updateEvent.type.unloadDetails()
-        if obj.isPixelsLoaded() and obj.sizeOfPixels() > 0:
-            pixels = obj.getPrimaryPixels()
-            pixels.unloadDetails()
-            if pixels.isChannelsLoaded() and pixels.sizeOfChannels() > 0:
-                for channel in pixels.copyChannels():
-                    channel.unloadDetails()
-                    self.unload_annotation_details(channel)
-        self.unload_annotation_details(obj)
+        self.version = prune.IMAGE.prune(obj)
 
         encoder = get_encoder(obj.__class__)
         v = encoder.encode(obj)
         return v
 
+    def for_dataset(self, dataset_id):
+        """
+        Returns a document for this Image as linked to another Dataset.
+        The encoded and serialized document is shared rather than being
+        recomputed as only the document id differs.
+        """
+        self.source
+        other = copy(self)
+        other.dataset_id = dataset_id
+        return other
+
 
 class ProjectDocument(BaseDocument):
 
-    def __init__(self, client, project):
+    def __init__(self, client, project, dataset_ids=None, id_range=None,
+                 page_size=100, loading='project', loader='join',
+                 image_ids=None, resume=None):
+        """
+        When `dataset_ids` and/or `id_range` are specified only Images
+        linked to those Datasets and with ids in the inclusive
+        `(first, last)` range are found; a shard of the Project.  When
+        `image_ids` are specified only those Images are found.  Images
+        are found `page_size` at a time either in a single stream for the
+        whole Project (`loading='project'`) or Dataset by Dataset
+        (`loading='dataset'`), in ascending id order, starting after the
+        `resume` position if specified; see `position`.  Their object
+        graphs are loaded by the named `loader`; see
+        `omero_es.loader.LOADERS`.
+        """
         super(ProjectDocument, self).__init__(client)
         self.project = project
+        self.page_size = page_size
+        self.loading = loading
+        self.loader = LOADERS[loader]()
+        # Ids of the Images linked to more than one Dataset that have had
+        # documents created; they can be found more than once
+        self.seen_image_ids = set()
+        self.dataset_ids = dataset_ids
+        self.id_range = id_range
+        self.image_ids = image_ids
+        self.resume = resume
         self.document = self.encode_project(project)
 
     def encode_project(self, obj):
-        obj.details.owner.unloadDetails()
-        obj.details.group.unloadDetails()
-        obj.details.creationEvent.unloadDetails()
-        obj.details.creationEvent.type.unloadDetails()
-        obj.details.updateEvent.unloadDetails()
-        obj.details.updateEvent.type.unloadDetails()
-        for _map in obj.details.group.copyGroupExperimenterMap():
-            _map.child.unloadDetails()
-        if obj.isDatasetLinksLoaded() and obj.sizeOfDatasetLinks() > 0:
-            for dataset_link in obj.copyDatasetLinks():
-                dataset = dataset_link.child
-                dataset.unloadDetails()
-                self.unload_annotation_details(dataset)
-        self.unload_annotation_details(obj)
+        self.version = prune.PROJECT.prune(obj)
 
         encoder = get_encoder(obj.__class__)
         v = encoder.encode(obj)
@@ -203,9 +258,72 @@ class ProjectDocument(BaseDocument):
         return image_counts
 
     def find_images(self):
+        if self.loading == 'dataset':
+            return self.find_images_per_dataset()
+        return self.find_images_per_project()
+
+    def find_images_per_project(self):
+        """
+        Finds all the Images of the Project in a single stream ordered by
+        id.  Each Image carries its links to the Project's Datasets so an
+        Image linked to several of them is loaded only once.
+        """
         session = self.client.getSession()
         query_service = session.getQueryService()
-        dataset_ids = [v.id.val for v in self.project.linkedDatasetList()]
+        project_id = self.project.id.val
+
+        params = ParametersI().addId(project_id)
+        query = QUERY_PROJECT_IMAGE_IDS
+        if self.dataset_ids is not None:
+            params.add('dataset_ids', self.rdataset_ids())
+            query += QUERY_DATASET_FILTER
+        query = self.restrict(
+            query, params, 'image', self.id_range, self.image_ids
+        )
+        last_id = -1
+        # Positions within a Dataset were recorded loading Dataset by
+        # Dataset
+        if self.resume is not None and self.resume[0] is None:
+            last_id = self.resume[1]
+        for ids in self.find_id_pages(
+                query_service, query, params, 'image', last_id):
+            t0 = time.time()
+            images = self.load_images(query_service, ids)
+            log.info(
+                'Found %d Images in Project:%d (%dms)' % (
+                    len(images), project_id, (time.time() - t0) * 1000
+                )
+            )
+            # Loaded in no particular order; positions assume id order
+            for image in sorted(images, key=object_id):
+                self.position = (None, image.id.val)
+                yield image
+
+    def rdataset_ids(self):
+        return rlist([rlong(v) for v in self.dataset_ids])
+
+    def load_images(self, query_service, ids):
+        """
+        Loads the Images with the specified ids along with their links to
+        the Project's Datasets (restricted to `dataset_ids` if set).
+        """
+        return self.loader.load_images(
+            query_service, self.project.id.val, ids, self.dataset_ids
+        )
+
+    def find_images_per_dataset(self):
+        session = self.client.getSession()
+        query_service = session.getQueryService()
+        dataset_ids = self.dataset_ids
+        if dataset_ids is None:
+            dataset_ids = [
+                v.id.val for v in self.project.linkedDatasetList()
+            ]
+        # Ordered so that a position is meaningful
+        dataset_ids = sorted(dataset_ids)
+        resume_dataset_id, last_id = self.resume or (None, -1)
+        if resume_dataset_id is not None:
+            dataset_ids = [v for v in dataset_ids if v >= resume_dataset_id]
 
         image_counts_per_dataset = self.get_image_counts_per_dataset(
             query_service
@@ -220,24 +338,30 @@ class ProjectDocument(BaseDocument):
                 )
                 continue
 
-            offset = 0
-            count = limit = 100
-            params = ParametersI().addId(dataset_id).page(offset, limit)
-            while count == limit:
+            params = ParametersI().addId(dataset_id)
+            query = self.restrict(
+                QUERY_IMAGE_IDS, params, 'image', self.id_range,
+                self.image_ids
+            )
+            first_id = -1
+            if dataset_id == resume_dataset_id:
+                first_id = last_id
+            for ids in self.find_id_pages(
+                    query_service, query, params, 'image', first_id):
+                # Already found via another Dataset
+                ids = [v for v in ids if v not in self.seen_image_ids]
+                if len(ids) < 1:
+                    continue
                 t0 = time.time()
-                images = query_service.findAllByQuery(
-                    QUERY_IMAGES, params, {'omero.group': '-1'}
-                )
+                images = self.load_images(query_service, ids)
                 log.info(
                     'Found %d Images in Dataset:%d Project:%d (%dms)' % (
                         len(images), dataset_id, self.project.id.val,
                         (time.time() - t0) * 1000
                     )
                 )
-                count = len(images)
-                offset += count
-                params.page(offset, limit)
-                for image in images:
+                for image in sorted(images, key=object_id):
+                    self.position = (dataset_id, image.id.val)
                     yield image
 
     @property
@@ -249,37 +373,58 @@ class ProjectDocument(BaseDocument):
         except UnloadedEntityException:
             return self.find_images()
 
+    def create_image_documents(self, image):
+        """
+        Creates a document for each Dataset the Image is linked to.  The
+        Image is only encoded once and is skipped if it has been seen
+        before.
+        """
+        dataset_links = image.copyDatasetLinks()
+        if len(dataset_links) < 1:
+            return []
+        if len(dataset_links) > 1:
+            image_id = image.id.val
+            if image_id in self.seen_image_ids:
+                return []
+            self.seen_image_ids.add(image_id)
+        image_document = ImageDocument(
+            self.client, image, dataset_links[0].parent.id.val
+        )
+        return [image_document] + [
+            image_document.for_dataset(v.parent.id.val)
+            for v in dataset_links[1:]
+        ]
+
     @property
     def image_documents(self):
         for image in self.images:
-            for dataset_link in image.copyDatasetLinks():
-                yield ImageDocument(
-                    self.client, image, dataset_link.parent.id.val
-                )
+            for image_document in self.create_image_documents(image):
+                yield image_document
 
 
 class PlateDocument(BaseDocument):
 
-    def __init__(self, client, plate):
+    def __init__(self, client, plate, id_range=None, page_size=100,
+                 loader='join', well_ids=None, resume=None):
+        """
+        When `id_range` is specified only Wells with ids in the inclusive
+        `(first, last)` range are found; a shard of the Plate.  When
+        `well_ids` are specified only those Wells are found.  Wells are
+        found `page_size` at a time, in ascending id order, starting after
+        the `resume` position if specified, and their object graphs loaded
+        by the named `loader`; see `omero_es.loader.LOADERS`.
+        """
         super(PlateDocument, self).__init__(client)
         self.plate = plate
+        self.page_size = page_size
+        self.loader = LOADERS[loader]()
+        self.id_range = id_range
+        self.well_ids = well_ids
+        self.resume = resume
         self.document = self.encode_plate(plate)
 
     def encode_plate(self, obj):
-        obj.details.owner.unloadDetails()
-        obj.details.group.unloadDetails()
-        obj.details.creationEvent.unloadDetails()
-        obj.details.creationEvent.type.unloadDetails()
-        obj.details.updateEvent.unloadDetails()
-        obj.details.updateEvent.type.unloadDetails()
-        for _map in obj.details.group.copyGroupExperimenterMap():
-            _map.child.unloadDetails()
-        if obj.isScreenLinksLoaded() and obj.sizeOfScreenLinks() > 0:
-            for screen_link in obj.copyScreenLinks():
-                screen = screen_link.parent
-                screen.unloadDetails()
-                self.unload_annotation_details(screen)
-        self.unload_annotation_details(obj)
+        self.version = prune.PLATE.prune(obj)
 
         encoder = get_encoder(obj.__class__)
         v = encoder.encode(obj)
@@ -288,24 +433,25 @@ class PlateDocument(BaseDocument):
     def find_wells(self):
         session = self.client.getSession()
         query_service = session.getQueryService()
-        offset = 0
-        count = limit = 100
-        params = ParametersI().addId(self.plate.id.val).page(offset, limit)
-        while count == limit:
+        params = ParametersI().addId(self.plate.id.val)
+        query = self.restrict(
+            QUERY_WELL_IDS, params, 'well', self.id_range, self.well_ids
+        )
+        last_id = -1
+        if self.resume is not None:
+            last_id = self.resume[1]
+        for ids in self.find_id_pages(
+                query_service, query, params, 'well', last_id):
             t0 = time.time()
-            wells = query_service.findAllByQuery(
-                QUERY_WELLS, params, {'omero.group': '-1'}
-            )
+            wells = self.loader.load_wells(query_service, ids)
             log.info(
                 'Found %d Wells in Plate:%d (%dms)' % (
                     len(wells), self.plate.id.val,
                     (time.time() - t0) * 1000
                 )
             )
-            count = len(wells)
-            offset += count
-            params.page(offset, limit)
-            for well in wells:
+            for well in sorted(wells, key=object_id):
+                self.position = (None, well.id.val)
                 yield well
 
     @property
@@ -315,12 +461,14 @@ class PlateDocument(BaseDocument):
         except UnloadedEntityException:
             return self.find_wells()
 
+    def create_well_documents(self, well):
+        return [WellDocument(self.client, well)]
+
     @property
     def well_documents(self):
         for well in self.wells:
-            yield WellDocument(
-                self.client, well
-            )
+            for well_document in self.create_well_documents(well):
+                yield well_document
 
 
 class WellDocument(ImageDocument):
@@ -331,27 +479,7 @@ class WellDocument(ImageDocument):
         self.document = self.encode_well(well)
 
     def encode_well(self, obj):
-        obj.details.owner.unloadDetails()
-        obj.details.group.unloadDetails()
-        obj.details.creationEvent.unloadDetails()
-        obj.details.creationEvent.type.unloadDetails()
-        obj.details.updateEvent.unloadDetails()
-        obj.details.updateEvent.type.unloadDetails()
-        if obj.isWellSamplesLoaded() and obj.sizeOfWellSamples() > 0:
-            for wellsample in obj.copyWellSamples():
-                wellsample.unloadDetails()
-                image = wellsample.image
-                if image is not None and image.isLoaded():
-                    image.unloadDetails()
-                    self.unload_annotation_details(image)
-                    if image.isPixelsLoaded():
-                        pixels = image.getPrimaryPixels()
-                        pixels.unloadDetails()
-                        if pixels.isChannelsLoaded():
-                            for channel in pixels.copyChannels():
-                                channel.unloadDetails()
-                                self.unload_annotation_details(channel)
-        self.unload_annotation_details(obj)
+        self.version = prune.WELL.prune(obj)
 
         encoder = get_encoder(obj.__class__)
         v = encoder.encode(obj)
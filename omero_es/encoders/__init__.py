@@ -29,3 +29,6 @@ from . import boolean_annotation, \
     text_annotation, \
     timestamp_annotation, \
     xml_annotation
+
+# Must follow the annotation encoder overrides it wraps
+from . import caching
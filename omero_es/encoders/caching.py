@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import omero_marshal
+
+from omero.model import Annotation, EventI, EventTypeI, ExperimenterI, \
+    ExperimenterGroupI
+from omero.rtypes import unwrap
+
+from .. import cache
+
+# Distinguishes a cache miss from an object that encodes to `None`
+MISSING = object()
+
+
+def annotation_key(obj):
+    """
+    Annotations carry a `_cache_key` when loaded by the annotation
+    prefetch; others are not cached.
+    """
+    return getattr(obj, '_cache_key', None)
+
+
+def shape(obj):
+    """
+    Identifies an object, by class, id and version, along with which of it
+    is loaded.  The encoding of `details` sub-objects, all of which are
+    either immutable or versioned, depends only on these.
+    """
+    key = (obj.__class__, unwrap(obj._id), obj._loaded)
+    if not obj._loaded:
+        return key
+    return key + (
+        unwrap(getattr(obj, '_version', None)), obj._details is None
+    )
+
+
+def event_key(obj):
+    key = shape(obj)
+    if obj._loaded and obj._type is not None:
+        key += shape(obj._type)
+    return key
+
+
+def group_key(obj):
+    key = shape(obj)
+    if obj._loaded and obj._groupExperimenterMapLoaded:
+        key += tuple([
+            shape(v._child) for v in obj._groupExperimenterMapSeq
+        ])
+    return key
+
+
+class CachingEncoder(object):
+    """
+    Wraps an encoder so that objects are only encoded once while the key
+    returned for them by `key` stays in `cache`.  Objects for which `key`
+    returns `None` are always encoded.  The encoded dictionaries are shared
+    between documents and must not be modified.
+    """
+
+    def __init__(self, encoder, cache, key):
+        self.encoder = encoder
+        self.cache = cache
+        self.key = key
+
+    def encode(self, obj):
+        key = self.key(obj)
+        if key is None:
+            return self.encoder.encode(obj)
+        v = self.cache.get(key, MISSING)
+        if v is MISSING:
+            v = self.encoder.encode(obj)
+            self.cache.put(key, v)
+        return v
+
+
+for t, encoder in omero_marshal.ENCODERS.items():
+    if issubclass(t, Annotation):
+        omero_marshal.ENCODERS[t] = CachingEncoder(
+            encoder, cache.encoded_annotations, annotation_key
+        )
+
+# The owner, group (with all of its members) and events of `details` are
+# shared by every object created by the same user in the same session
+for t, key in (
+        (ExperimenterI, shape),
+        (ExperimenterGroupI, group_key),
+        (EventI, event_key),
+        (EventTypeI, shape)):
+    if t in omero_marshal.ENCODERS:
+        omero_marshal.ENCODERS[t] = CachingEncoder(
+            omero_marshal.ENCODERS[t], cache.encoded_details, key
+        )
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import omero_marshal
+
+from omero import RType
+from omero.model import BooleanAnnotationI, ChannelI, CommentAnnotationI, \
+    DoubleAnnotationI, ImageI, LongAnnotationI, MapAnnotationI, PixelsI, \
+    TagAnnotationI, TermAnnotationI, TimestampAnnotationI, XmlAnnotationI
+from omero_model_UnitBase import UnitBase
+
+from .caching import CachingEncoder
+
+
+def set_if_not_none(v, key, value):
+    if value is None:
+        return
+    if isinstance(value, RType):
+        v[key] = value.getValue()
+    elif isinstance(value, UnitBase):
+        v[key] = {
+            '@type': 'TBD#%s' % value.__class__.__name__,
+            'Unit': value.getUnit().name,
+            'Symbol': value.getSymbol(),
+            'Value': value.getValue()
+        }
+    else:
+        v[key] = value
+
+
+def encode_with(ctx, obj):
+    return ctx.get_encoder(obj.__class__).encode(obj)
+
+
+def rgba(v, obj):
+    set_if_not_none(v, 'Red', obj._red)
+    set_if_not_none(v, 'Green', obj._green)
+    set_if_not_none(v, 'Blue', obj._blue)
+    set_if_not_none(v, 'Alpha', obj._alpha)
+
+
+class FastEncoder(object):
+    """
+    Produces the same dictionaries as the `omero_marshal` encoder it
+    replaces, and takes its `TYPE` from, but reads the model objects'
+    fields directly.  This skips the `__getattr__` rerouting of every field
+    access and the per field encoder dispatch.  Only safe for loaded
+    objects, which is all that is ever encoded while indexing.
+    """
+
+    def __init__(self, ctx, encoder):
+        self.ctx = ctx
+        self.TYPE = encoder.TYPE
+
+    def encode(self, obj):
+        v = {'@type': self.TYPE}
+        if obj._id is not None:
+            v['@id'] = obj._id.getValue()
+        if obj._details is not None:
+            v['omero:details'] = encode_with(self.ctx, obj._details)
+        return v
+
+
+class FastAnnotatableEncoder(FastEncoder):
+
+    def encode(self, obj):
+        v = super(FastAnnotatableEncoder, self).encode(obj)
+        if obj._annotationLinksLoaded and len(obj._annotationLinksSeq) > 0:
+            v['Annotations'] = [
+                encode_with(self.ctx, link._child)
+                for link in obj._annotationLinksSeq
+            ]
+        return v
+
+
+class FastImageEncoder(FastAnnotatableEncoder):
+
+    def encode(self, obj):
+        v = super(FastImageEncoder, self).encode(obj)
+        set_if_not_none(v, 'AcquisitionDate', obj._acquisitionDate)
+        set_if_not_none(v, 'omero:archived', obj._archived)
+        set_if_not_none(v, 'Description', obj._description)
+        set_if_not_none(v, 'Name', obj._name)
+        set_if_not_none(v, 'omero:partial', obj._partial)
+        set_if_not_none(v, 'omero:series', obj._series)
+        _format = obj._format
+        if _format is not None and _format._loaded:
+            set_if_not_none(v, 'omero:format', encode_with(self.ctx, _format))
+        if obj._pixelsLoaded and len(obj._pixelsSeq) > 0:
+            v['Pixels'] = encode_with(self.ctx, obj._pixelsSeq[0])
+        return v
+
+
+class FastPixelsEncoder(FastEncoder):
+
+    def encode(self, obj):
+        v = super(FastPixelsEncoder, self).encode(obj)
+        set_if_not_none(v, 'omero:methodology', obj._methodology)
+        set_if_not_none(v, 'PhysicalSizeX', obj._physicalSizeX)
+        set_if_not_none(v, 'PhysicalSizeY', obj._physicalSizeY)
+        set_if_not_none(v, 'PhysicalSizeZ', obj._physicalSizeZ)
+        set_if_not_none(v, 'omero:sha1', obj._sha1)
+        set_if_not_none(v, 'SignificantBits', obj._significantBits)
+        set_if_not_none(v, 'SizeX', obj._sizeX)
+        set_if_not_none(v, 'SizeY', obj._sizeY)
+        set_if_not_none(v, 'SizeZ', obj._sizeZ)
+        set_if_not_none(v, 'SizeC', obj._sizeC)
+        set_if_not_none(v, 'SizeT', obj._sizeT)
+        set_if_not_none(v, 'TimeIncrement', obj._timeIncrement)
+        set_if_not_none(v, 'omero:waveIncrement', obj._waveIncrement)
+        set_if_not_none(v, 'omero:waveStart', obj._waveStart)
+        for key, child in (
+                ('DimensionOrder', obj._dimensionOrder),
+                ('Type', obj._pixelsType)):
+            if child is not None and child._loaded:
+                v[key] = encode_with(self.ctx, child)
+        if obj._channelsLoaded and len(obj._channelsSeq) > 0:
+            v['Channels'] = [
+                encode_with(self.ctx, channel) for channel in obj._channelsSeq
+            ]
+        return v
+
+
+class FastChannelEncoder(FastAnnotatableEncoder):
+    """
+    Channels are encoded along with their LogicalChannel, which is
+    flattened into the Channel's dictionary.
+    """
+
+    def encode(self, obj):
+        v = super(FastChannelEncoder, self).encode(obj)
+        rgba(v, obj)
+        set_if_not_none(v, 'omero:lookupTable', obj._lookupTable)
+        logical_channel = obj._logicalChannel
+        if logical_channel is None or not logical_channel._loaded:
+            return v
+        set_if_not_none(v, 'omero:LogicalChannelId', logical_channel._id)
+        set_if_not_none(
+            v, 'EmissionWavelength', logical_channel._emissionWave
+        )
+        set_if_not_none(
+            v, 'ExcitationWavelength', logical_channel._excitationWave
+        )
+        set_if_not_none(v, 'Fluor', logical_channel._fluor)
+        set_if_not_none(v, 'Name', logical_channel._name)
+        set_if_not_none(v, 'NDFilter', logical_channel._ndFilter)
+        set_if_not_none(v, 'PinholeSize', logical_channel._pinHoleSize)
+        set_if_not_none(
+            v, 'PockelCellSetting', logical_channel._pockelCellSetting
+        )
+        set_if_not_none(
+            v, 'SamplesPerPixel', logical_channel._samplesPerPixel
+        )
+        for key, child in (
+                ('ContrastMethod', logical_channel._contrastMethod),
+                ('Illumination', logical_channel._illumination),
+                ('AcquisitionMode', logical_channel._mode),
+                ('omero:photometricInterpretation',
+                 logical_channel._photometricInterpretation)):
+            if child is not None and child._loaded:
+                v[key] = encode_with(self.ctx, child)
+        return v
+
+
+class FastAnnotationEncoder(FastEncoder):
+    """
+    Replaces the `Invariant*AnnotationEncoder`s; `FIELDS` are the
+    `(key, field)` pairs each of them sets.
+    """
+
+    FIELDS = ()
+
+    def encode(self, obj):
+        v = super(FastAnnotationEncoder, self).encode(obj)
+        set_if_not_none(v, 'Description', obj._description)
+        set_if_not_none(v, 'Namespace', obj._ns)
+        for key, field in self.FIELDS:
+            set_if_not_none(v, key, getattr(obj, field))
+        return v
+
+
+def annotation_encoder(*fields):
+    return type('FastAnnotationEncoder', (FastAnnotationEncoder,), {
+        'FIELDS': fields
+    })
+
+
+class FastMapAnnotationEncoder(FastAnnotationEncoder):
+
+    def encode(self, obj):
+        v = super(FastMapAnnotationEncoder, self).encode(obj)
+        if obj._mapValue is None:
+            return None
+        v['MapValue'] = [[nv.name, nv.value] for nv in obj._mapValue]
+        return v
+
+
+# Fast encoder for each hot type
+ENCODERS = {
+    ImageI: FastImageEncoder,
+    PixelsI: FastPixelsEncoder,
+    ChannelI: FastChannelEncoder,
+    BooleanAnnotationI: annotation_encoder(('BoolValue', '_boolValue')),
+    CommentAnnotationI: annotation_encoder(('TextValue', '_textValue')),
+    DoubleAnnotationI: annotation_encoder(('DoubleValue', '_doubleValue')),
+    LongAnnotationI: annotation_encoder(('LongValue', '_longValue')),
+    MapAnnotationI: FastMapAnnotationEncoder,
+    TagAnnotationI: annotation_encoder(('TextValue', '_textValue')),
+    TermAnnotationI: annotation_encoder(('TermValue', '_termValue')),
+    TimestampAnnotationI: annotation_encoder(('Value', '_timeValue')),
+    XmlAnnotationI: annotation_encoder(('Value', '_textValue')),
+}
+
+
+def install():
+    """
+    Replaces the registered encoders of the hot types with their fast
+    equivalents.  Caching wrappers are kept.
+    """
+    for t, fast_encoder in ENCODERS.items():
+        encoder = omero_marshal.ENCODERS.get(t)
+        if encoder is None:
+            continue
+        if isinstance(getattr(encoder, 'encoder', encoder), FastEncoder):
+            # Already installed
+            continue
+        if isinstance(encoder, CachingEncoder):
+            encoder = CachingEncoder(
+                fast_encoder(omero_marshal._ctx, encoder.encoder),
+                encoder.cache, encoder.key
+            )
+        else:
+            encoder = fast_encoder(omero_marshal._ctx, encoder)
+        omero_marshal.ENCODERS[t] = encoder
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import gzip
+import logging
+import os
+import threading
+
+from .bulk import Writer
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Bytes of NDJSON, before compression, after which output files rotate
+MAX_FILE_BYTES = 1024 * 1024 * 1024
+
+# Files are written once and read many times; favour size over speed
+COMPRESS_LEVEL = 6
+
+# Suffix of output files still being written
+PARTIAL = '.part'
+
+
+def sync_directory(path):
+    """
+    Makes the renames in the directory `path` durable.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileSink(object):
+    """
+    Bulk sink, with the same interface as `omero_es.bulk.Sink`, that
+    writes the actions of all containers to NDJSON files ready to be
+    loaded into Elasticsearch with `omero_es.load`.  Files are named
+    `<prefix>-<pid>-<n>.json`, with a `.gz` suffix if `compress`ed, so
+    that the processes of a pool do not collide, and rotate once
+    `max_bytes` bytes of actions have been written to them.  Each is
+    written with a `.part` suffix, which is only dropped once it is
+    complete and synced to disk.
+
+    If `durable` actions are only acknowledged once the file they were
+    written to is complete, so that a journal never records a container
+    whose actions could still be lost; waiting for a writer completes the
+    current file if it holds any of its actions.  Otherwise they are
+    acknowledged as soon as they are written.
+    """
+
+    def __init__(self, prefix, max_bytes=MAX_FILE_BYTES, compress=False,
+                 durable=False):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.durable = durable
+        # Actions are written as is; see `omero_es.bulk.Writer.send()`
+        self.fingerprints = None
+        self.lock = threading.Lock()
+        self.raw = None
+        self.file = None
+        self.path = None
+        self.size = 0
+        # Number of actions in the current file, by writer, acknowledged
+        # once it is complete if `durable`
+        self.pending = dict()
+        self.files = 0
+        self.actions = 0
+        self.bytes = 0
+
+    def writer(self, name):
+        return Writer(self, name)
+
+    def open(self):
+        self.files += 1
+        self.path = '%s-%d-%05d.json' % (self.prefix, os.getpid(), self.files)
+        if self.compress:
+            self.path += '.gz'
+        self.raw = open(self.path + PARTIAL, 'wb')
+        self.file = self.raw
+        if self.compress:
+            self.file = gzip.GzipFile(
+                self.path, 'wb', COMPRESS_LEVEL, self.raw
+            )
+        self.size = 0
+
+    def rotate(self):
+        """
+        Completes the current file, if any, and returns the number of its
+        actions still to acknowledge by writer.
+        """
+        if self.file is None:
+            return dict()
+        if self.file is not self.raw:
+            # Does not close the underlying file
+            self.file.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.rename(self.path + PARTIAL, self.path)
+        sync_directory(os.path.dirname(os.path.abspath(self.path)))
+        log.info('Wrote %s, %d bytes of actions' % (self.path, self.size))
+        self.raw = self.file = None
+        pending = self.pending
+        self.pending = dict()
+        return pending
+
+    def acknowledge(self, pending):
+        for writer, count in pending.iteritems():
+            writer.acknowledge(count)
+
+    def add(self, writer, action, fingerprint=None):
+        pending = dict()
+        with self.lock:
+            if self.file is None:
+                self.open()
+            self.file.write(action)
+            self.size += len(action)
+            self.actions += 1
+            self.bytes += len(action)
+            if self.durable:
+                self.pending[writer] = self.pending.get(writer, 0) + 1
+            if self.size >= self.max_bytes:
+                pending = self.rotate()
+        if not self.durable:
+            writer.acknowledge(1)
+        self.acknowledge(pending)
+
+    def flush(self, writer=None):
+        """
+        Completes the current file if `durable` and, if `writer` is
+        specified, it holds some of its actions.
+        """
+        pending = dict()
+        with self.lock:
+            if self.file is None:
+                return
+            if not self.durable:
+                self.file.flush()
+                return
+            if writer is not None and writer not in self.pending:
+                return
+            pending = self.rotate()
+        self.acknowledge(pending)
+
+    def close(self):
+        with self.lock:
+            pending = self.rotate()
+        self.acknowledge(pending)
+        log.info(
+            'Exported %d actions, %d bytes, to %d files' % (
+                self.actions, self.bytes, self.files
+            )
+        )
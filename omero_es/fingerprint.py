@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from getopt import getopt, GetoptError
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS fingerprint (
+    key TEXT PRIMARY KEY,
+    digest BLOB NOT NULL
+)"""
+
+SELECT_DIGEST = """SELECT digest FROM fingerprint WHERE key = ?"""
+
+REPLACE_DIGEST = """INSERT OR REPLACE INTO fingerprint (key, digest)
+VALUES (?, ?)"""
+
+DELETE_DIGEST = """DELETE FROM fingerprint WHERE key = ?"""
+
+DELETE_INDEX = """DELETE FROM fingerprint WHERE substr(key, 1, ?) = ?"""
+
+COUNT = """SELECT count(*) FROM fingerprint"""
+
+
+def usage(error=None):
+    """
+    Prints usage so that we don't have to. :)
+    """
+    cmd = sys.argv[0]
+    if error:
+        print error
+    print """Usage:
+  %(cmd)s <options> <store>
+
+Compacts a document fingerprint store, optionally forgetting the
+fingerprints of whole indexes first
+
+Options:
+  -h                  display this help and exit
+  --debug             turn debugging on
+  --forget <index>    forget the fingerprints of the documents of <index>,
+                      so that they are all sent again; for example after
+                      it has been deleted
+
+Examples:
+    %(cmd)s fingerprints.db
+    %(cmd)s --forget omero fingerprints.db
+
+Report bugs to support@glencoesoftware.com""" % {'cmd': cmd}
+    sys.exit(2)
+
+
+def fingerprint(action):
+    """
+    Returns the `(key, digest)` fingerprint of a bulk API action.  The key
+    is `<index>/<type>/<id>/<parent>` as child documents with the same id
+    and different parents are distinct.  The digest covers the action and
+    the serialized document; deletes have none.
+    """
+    op, metadata = json.loads(action[:action.index('\n')]).items()[0]
+    key = u'%s/%s/%s/%s' % (
+        metadata['_index'], metadata['_type'], metadata['_id'],
+        metadata.get('_parent', '')
+    )
+    if op == 'delete':
+        return key, None
+    return key, hashlib.sha1(action).digest()
+
+
+class FingerprintStore(object):
+    """
+    Local SQLite store of the fingerprint of each document last indexed,
+    so that actions for documents that have not changed can be dropped
+    before they are sent.  Fingerprints are only recorded once their
+    actions have been indexed; see `omero_es.bulk.Sink`.  The store can
+    be shared by processes; each has its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(
+            path, timeout=60, check_same_thread=False
+        )
+        # Readers do not block the writer of another process
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(CREATE_TABLE)
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self.lock = threading.Lock()
+
+    def check(self, action):
+        """
+        Returns the fingerprint of `action` to record once it has been
+        indexed, or `None` if the document is unchanged and the action
+        can be dropped.
+        """
+        key, digest = fingerprint(action)
+        if digest is None:
+            return key, digest
+        with self.lock:
+            row = self.connection.execute(SELECT_DIGEST, (key,)).fetchone()
+            if row is not None and str(row[0]) == digest:
+                self.hits += 1
+                return None
+            self.misses += 1
+        return key, digest
+
+    def record(self, fingerprints):
+        """
+        Records the `(key, digest)` fingerprints of indexed actions in a
+        single transaction.  A `None` digest, that of a delete, removes
+        the fingerprint.
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(REPLACE_DIGEST, [
+                    (k, buffer(v)) for k, v in fingerprints if v is not None
+                ])
+                self.connection.executemany(DELETE_DIGEST, [
+                    (k,) for k, v in fingerprints if v is None
+                ])
+            self.recorded += len(fingerprints)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        if lookups < 1:
+            return
+        log.info(
+            'Fingerprints %d unchanged of %d documents (%.1f%%), %d '
+            'recorded' % (
+                self.hits, lookups, self.hits * 100.0 / lookups,
+                self.recorded
+            )
+        )
+
+    def close(self):
+        self.connection.close()
+        self.report()
+
+
+def vacuum(path, forget=()):
+    """
+    Forgets the fingerprints of the indexes in `forget` and compacts the
+    store.
+    """
+    t0 = time.time()
+    size = os.path.getsize(path)
+    connection = sqlite3.connect(path, timeout=60)
+    try:
+        with connection:
+            for index in forget:
+                prefix = u'%s/' % index
+                deleted = connection.execute(
+                    DELETE_INDEX, (len(prefix), prefix)
+                ).rowcount
+                log.info(
+                    'Forgot %d fingerprints of index %s' % (deleted, index)
+                )
+        connection.execute('VACUUM')
+        count = connection.execute(COUNT).fetchone()[0]
+    finally:
+        connection.close()
+    log.info(
+        'Compacted %d fingerprints from %d to %d bytes (%dms)' % (
+            count, size, os.path.getsize(path), (time.time() - t0) * 1000
+        )
+    )
+
+
+def main():
+    try:
+        options, args = getopt(sys.argv[1:], "h", ["debug", "forget="])
+    except GetoptError, (msg, _opt):
+        usage(msg)
+
+    level = logging.INFO
+    forget = list()
+    for option, argument in options:
+        if option == "-h":
+            usage()
+        if option == "--debug":
+            level = logging.DEBUG
+        if option == "--forget":
+            forget.append(argument)
+
+    if len(args) != 1:
+        usage('Fingerprint store required!')
+    if not os.path.exists(args[0]):
+        usage('No fingerprint store: %s' % args[0])
+
+    format = "%(asctime)s %(levelname)-7s [%(name)16s] %(message)s"
+    logging.basicConfig(level=level, format=format)
+    vacuum(args[0], forget)
+
+
+if __name__ == '__main__':
+    main()
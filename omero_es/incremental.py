@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+import logging
+import os
+import time
+
+from omero.rtypes import rlong
+from omero.sys import ParametersI
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Maximum number of ids in a single `IN (:ids)` clause and of Images or
+# Wells in a single task
+BATCH_SIZE = 1000
+
+# Types of the objects whose changes affect documents, all annotatable
+TYPES = ('Project', 'Dataset', 'Image', 'Screen', 'Plate', 'Well')
+
+# Types of the links whose changes affect documents
+LINK_TYPES = ('ProjectDatasetLink', 'DatasetImageLink', 'ScreenPlateLink')
+
+# Types of the objects whose documents can have just their annotations
+# updated when nothing else about them changed; see `omero_es.partial`
+ANNOTATION_TYPES = ('Project', 'Image', 'Plate', 'Well')
+
+# Number of Events before the watermark that incremental runs re-scan.
+# Event ids are allocated as transactions start but are only visible once
+# they commit, so a long transaction, an import for example, can commit
+# Events below a watermark recorded while it was running
+OVERLAP = 10000
+
+QUERY_LATEST_EVENT_ID = """SELECT max(event.id) FROM Event AS event"""
+
+# Objects of a type updated or created after `:since`
+QUERY_CHANGED = """SELECT DISTINCT obj.id FROM %s AS obj
+WHERE obj.details.updateEvent.id > :since
+"""
+
+# Parents of the links to annotations of a type that were created after
+# `:since`, or whose annotations have been updated since
+QUERY_CHANGED_ANNOTATIONS = """SELECT DISTINCT link.parent.id
+FROM %sAnnotationLink AS link
+JOIN link.child AS annotation
+WHERE link.details.updateEvent.id > :since
+OR annotation.details.updateEvent.id > :since
+"""
+
+QUERY_CHANGED_LINKS = """SELECT DISTINCT link.parent.id, link.child.id
+FROM %s AS link
+WHERE link.details.updateEvent.id > :since
+"""
+
+QUERY_CHANGED_WELL_SAMPLES = """SELECT DISTINCT wellsample.well.id
+FROM WellSample AS wellsample
+WHERE wellsample.details.updateEvent.id > :since
+"""
+
+QUERY_DATASET_PROJECTS = """SELECT DISTINCT p_d_link.parent.id
+FROM ProjectDatasetLink AS p_d_link
+WHERE p_d_link.child.id IN (:ids)
+"""
+
+QUERY_DATASET_IMAGES = """SELECT DISTINCT p_d_link.parent.id,
+i_d_link.child.id
+FROM DatasetImageLink AS i_d_link
+JOIN i_d_link.parent AS dataset
+JOIN dataset.projectLinks AS p_d_link
+WHERE dataset.id IN (:ids)
+"""
+
+QUERY_IMAGE_PROJECTS = """SELECT DISTINCT p_d_link.parent.id,
+i_d_link.child.id
+FROM DatasetImageLink AS i_d_link
+JOIN i_d_link.parent AS dataset
+JOIN dataset.projectLinks AS p_d_link
+WHERE i_d_link.child.id IN (:ids)
+"""
+
+QUERY_IMAGE_WELLS = """SELECT DISTINCT well.plate.id, well.id
+FROM WellSample AS wellsample
+JOIN wellsample.well AS well
+WHERE wellsample.image.id IN (:ids)
+"""
+
+QUERY_SCREEN_PLATES = """SELECT DISTINCT s_p_link.child.id
+FROM ScreenPlateLink AS s_p_link
+WHERE s_p_link.parent.id IN (:ids)
+"""
+
+QUERY_WELL_PLATES = """SELECT DISTINCT well.plate.id, well.id
+FROM Well AS well
+WHERE well.id IN (:ids)
+"""
+
+
+def latest_event_id(client):
+    query_service = client.getSession().getQueryService()
+    r = query_service.projection(
+        QUERY_LATEST_EVENT_ID, None, {'omero.group': '-1'}
+    )
+    return r[0][0].val
+
+
+def read_watermark(path):
+    """
+    Returns the id of the latest event indexed as recorded in the
+    watermark file at `path`, or `None` if there is none.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['event_id']
+
+
+def since_watermark(event_id, overlap=OVERLAP):
+    """
+    Returns the Event after which an incremental run from the watermark
+    `event_id` finds changes; `overlap` Events before it.
+    """
+    return max(event_id - overlap, 0)
+
+
+def write_watermark(path, event_id):
+    """
+    Records `event_id` as the latest event indexed.  The file is replaced
+    atomically so that it is never left half written.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'event_id': event_id, 'time': time.time()}, f)
+    os.rename(tmp, path)
+    log.info('Recorded watermark Event:%d in %s' % (event_id, path))
+
+
+def find(query_service, query, since):
+    params = ParametersI()
+    params.add('since', rlong(since))
+    return [
+        tuple([v.val for v in r]) for r in query_service.projection(
+            query, params, {'omero.group': '-1'}
+        )
+    ]
+
+
+def find_ids(query_service, query, since):
+    return set([r[0] for r in find(query_service, query, since)])
+
+
+def resolve(query_service, query, ids):
+    """
+    Returns the rows of a projection `query` over `ids`, in batches.
+    """
+    ids = sorted(ids)
+    rows = list()
+    for i in range(0, len(ids), BATCH_SIZE):
+        params = ParametersI()
+        params.addIds(ids[i:i + BATCH_SIZE])
+        rows.extend([
+            tuple([v.val for v in r]) for r in query_service.projection(
+                query, params, {'omero.group': '-1'}
+            )
+        ])
+    return rows
+
+
+def annotation_changes(kind):
+    """
+    Returns the key of the changes to the annotations of objects of
+    `kind`; that of changes to the objects themselves unless their
+    documents can have just their annotations updated.
+    """
+    if kind in ANNOTATION_TYPES:
+        return kind + 'Annotations'
+    return kind
+
+
+def find_changes_since(query_service, since):
+    """
+    Finds the objects and links changed after Event `since`.  Returns the
+    ids of the changed objects, those whose annotations changed, and the
+    `(parent_id, child_id)` pairs of the changed links, by type; see
+    `resolve()` and `annotation_changes()`.
+    """
+    changes = dict()
+    for kind in TYPES:
+        changes[kind] = find_ids(query_service, QUERY_CHANGED % kind, since)
+    for kind in TYPES:
+        changes.setdefault(annotation_changes(kind), set()).update(find_ids(
+            query_service, QUERY_CHANGED_ANNOTATIONS % kind, since
+        ))
+    for kind in LINK_TYPES:
+        changes[kind] = set(
+            find(query_service, QUERY_CHANGED_LINKS % kind, since)
+        )
+    changes['Well'].update(
+        find_ids(query_service, QUERY_CHANGED_WELL_SAMPLES, since)
+    )
+    return changes
+
+
+def resolve_project_changes(query_service, changes):
+    """
+    Returns the ids of the Projects whose documents are affected by
+    `changes` and the `(project_id, image_id)` pairs of the affected Image
+    documents, along with the ids of the affected Images.
+    """
+    project_ids = set(changes.get('Project', ()))
+    image_ids = set(changes.get('Image', ()))
+    # A Dataset newly linked to a Project brings all of its Images
+    dataset_links = changes.get('ProjectDatasetLink', ())
+    project_ids.update([v[0] for v in dataset_links])
+    new_dataset_ids = set([v[1] for v in dataset_links])
+    image_ids.update([v[1] for v in changes.get('DatasetImageLink', ())])
+    project_ids.update([
+        r[0] for r in resolve(
+            query_service, QUERY_DATASET_PROJECTS,
+            changes.get('Dataset', ())
+        )
+    ])
+    images = set(resolve(query_service, QUERY_IMAGE_PROJECTS, image_ids))
+    images.update(resolve(
+        query_service, QUERY_DATASET_IMAGES, new_dataset_ids
+    ))
+    return project_ids, images, image_ids
+
+
+def resolve_plate_changes(query_service, changes, image_ids):
+    """
+    Returns the ids of the Plates whose documents are affected by
+    `changes` and the `(plate_id, well_id)` pairs of the affected Well
+    documents, including those of the Wells containing `image_ids`.
+    """
+    plate_ids = set(changes.get('Plate', ()))
+    plate_ids.update([v[1] for v in changes.get('ScreenPlateLink', ())])
+    plate_ids.update([
+        r[0] for r in resolve(
+            query_service, QUERY_SCREEN_PLATES, changes.get('Screen', ())
+        )
+    ])
+    wells = set(resolve(
+        query_service, QUERY_WELL_PLATES, changes.get('Well', ())
+    ))
+    wells.update(resolve(query_service, QUERY_IMAGE_WELLS, image_ids))
+    return plate_ids, wells
+
+
+def group(pairs):
+    """
+    Groups `(parent_id, child_id)` pairs into `(parent_id, child_ids)`
+    tuples of at most `BATCH_SIZE` ordered child ids.
+    """
+    children = dict()
+    for parent_id, child_id in pairs:
+        children.setdefault(parent_id, list()).append(child_id)
+    groups = list()
+    for parent_id, child_ids in sorted(children.items()):
+        child_ids.sort()
+        for i in range(0, len(child_ids), BATCH_SIZE):
+            groups.append((parent_id, tuple(child_ids[i:i + BATCH_SIZE])))
+    return groups
+
+
+def plan_annotations(changes, indexed):
+    """
+    Returns the estimated work of the tasks that only update the
+    annotations of documents, of at most `BATCH_SIZE` objects each.
+    Objects whose documents are re-indexed, their ids in `indexed` by
+    type, are left out.
+    """
+    estimates = dict()
+    for kind in ANNOTATION_TYPES:
+        key = annotation_changes(kind)
+        ids = sorted(set(changes.get(key, ())) - indexed[kind])
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch = tuple(ids[i:i + BATCH_SIZE])
+            estimates[(key, batch)] = len(batch)
+    return estimates
+
+
+def plan(query_service, changes):
+    """
+    Resolves `changes` to the documents they affect.  Returns the
+    estimated work of the tasks that re-index just those documents, or
+    only update their annotations; see `omero_es.planning`.
+    """
+    t0 = time.time()
+    project_ids, images, image_ids = resolve_project_changes(
+        query_service, changes
+    )
+    # Images are nested in Well documents, which are always re-indexed
+    plate_ids, wells = resolve_plate_changes(
+        query_service, changes,
+        image_ids | set(changes.get(annotation_changes('Image'), ()))
+    )
+    estimates = plan_annotations(changes, {
+        'Project': project_ids,
+        'Image': set([v[1] for v in images]),
+        'Plate': plate_ids,
+        'Well': set([v[1] for v in wells]),
+    })
+    updates = sum(estimates.values())
+    for project_id in project_ids:
+        estimates[('ProjectParent', project_id)] = 1
+    for task in group(images):
+        estimates[('ProjectImages', task)] = len(task[1])
+    for plate_id in plate_ids:
+        estimates[('PlateParent', plate_id)] = 1
+    for task in group(wells):
+        estimates[('PlateWells', task)] = len(task[1])
+    log.info(
+        'Changes affect %d Projects, %d Image documents, %d Plates and '
+        '%d Wells, and the annotations of %d more objects (%dms)' % (
+            len(project_ids), len(images), len(plate_ids), len(wells),
+            updates, (time.time() - t0) * 1000
+        )
+    )
+    return estimates
+
+
+def find_changes(client, since):
+    """
+    Finds the changes to Projects, Datasets, Images, Plates, Screens and
+    Wells, and their annotations, after Event `since` and resolves them
+    to the tasks that re-index the documents they affect.
+    """
+    query_service = client.getSession().getQueryService()
+    t0 = time.time()
+    changes = find_changes_since(query_service, since)
+    log.info(
+        'Found %d changes after Event:%d (%dms)' % (
+            sum([len(v) for v in changes.values()]), since,
+            (time.time() - t0) * 1000
+        )
+    )
+    return plan(query_service, changes)
@@ -9,19 +9,26 @@
 # jason@glencoesoftware.com.
 #
 
-import json
 import logging
+import os
 import sys
 import time
 
 import omero
 
 from getopt import getopt, GetoptError
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
 
-from elasticsearch import Elasticsearch, helpers
 from omero.sys import ParametersI
 
+from . import bulk, cache, checkpoint, incremental, partial, planning, \
+    serializer, transport
+from .settings import SETTINGS, create_sink, describe_error
 from .document import ProjectDocument, PlateDocument
+from .encoders import fast
+from .loader import LOADERS
+from .pipeline import Pipeline
 
 # Package scoped logger
 log = logging.getLogger(__name__)
@@ -66,6 +73,24 @@ LEFT OUTER JOIN FETCH s_a_link.child
 WHERE screen.id = :id
 """
 
+QUERY_PLATE = """SELECT plate FROM Plate AS plate
+JOIN FETCH plate.details.creationEvent as c_event
+JOIN FETCH c_event.type
+JOIN FETCH plate.details.updateEvent as u_event
+JOIN FETCH u_event.type
+JOIN FETCH plate.details.owner
+JOIN FETCH plate.details.group AS eg
+JOIN FETCH eg.groupExperimenterMap AS eg_e_map
+JOIN FETCH eg_e_map.child
+LEFT OUTER JOIN FETCH plate.annotationLinks AS p_a_link
+LEFT OUTER JOIN FETCH p_a_link.child
+JOIN FETCH plate.screenLinks AS p_s_link
+JOIN FETCH p_s_link.parent AS screen
+LEFT OUTER JOIN FETCH screen.annotationLinks AS s_a_link
+LEFT OUTER JOIN FETCH s_a_link.child
+WHERE plate.id = :id
+"""
+
 
 def usage(error=None):
     """
@@ -89,14 +114,119 @@ Options:
   --screen <id>       create document for Screen hierarchy
   --project <id>      create document for Project hierarchy
   --url               Elasticsearch base URL to save documents into
+  --output <prefix>   write documents, as bulk API actions, to NDJSON files
+                      named <prefix>-<pid>-<n>.json instead; load them
+                      with 'python -m omero_es.load'.  With --journal a
+                      file is completed whenever a container it holds
+                      actions of finishes
+  --output-bytes <n>  bytes of actions after which output files rotate
+                      (default: 1073741824)
   --debug             turn debugging on
   --index             index to write into (default: 'dv')
+  --workers <n>       number of worker processes, each with its own OMERO
+                      session, to index containers with (default: 1)
+  --shard-size <n>    with --workers, split containers estimated to produce
+                      more than <n> documents into shards that are indexed
+                      concurrently (default: no splitting)
+  --queue-size <n>    capacity of the queues between the fetch, encode,
+                      serialize and ship stages of the indexing pipeline
+                      (default: 100)
+  --page-size <n>     number of Images or Wells to load from OMERO per
+                      query (default: 100)
+  --image-loading <s> load the Images of a Project in a single stream
+                      ('project') or Dataset by Dataset ('dataset')
+                      (default: 'project')
+  --loader <s>        load Image and Well graphs with a single JOIN FETCH
+                      query per page ('join') or with a query per
+                      association assembled client side ('narrow')
+                      (default: 'join').  Only 'narrow' loads each
+                      distinct annotation once and caches it, and its
+                      encoding, across containers
+  --cache-size <n>    number of entries in each per process cache of
+                      loaded and encoded annotations ('narrow' loader
+                      only), owners, groups and events (default: 10000)
+  --fast-encoders     encode Images, Pixels, Channels and annotations with
+                      specialized encoders that read fields directly
+  --json <s>          JSON backend to serialize documents with; one of
+                      'ujson', 'simplejson' or 'json' (default:
+                      'simplejson' if installed, otherwise 'json').
+                      'ujson' is fastest but rounds doubles to 15
+                      significant digits
+  --bulk-size <n>     initial number of documents per bulk request; the
+                      documents of all containers share requests
+                      (default: 500)
+  --bulk-bytes <n>    maximum size of a bulk request in bytes
+                      (default: 104857600)
+  --bulk-requests <n> number of bulk requests in flight at once, per
+                      process (default: 2)
+  --bulk-latency <n>  bulk request latency in milliseconds to adapt the
+                      number of documents per request to; 0 to disable
+                      (default: 1000)
+  --bulk-retries <n>  number of times to retry documents rejected by an
+                      overloaded cluster, with exponential backoff
+                      (default: 8)
+  --dead-letters <f>  NDJSON file to append documents that failed to
+                      index to
+  --replay-dead-letters <f>
+                      resubmit the documents of a dead letter file
+  --compress          gzip the bodies of bulk requests, or output files
+  --connections <n>   number of connections to keep open to each
+                      Elasticsearch node, per process (default: 10)
+  --keep-alive <s>    send TCP keepalive probes on connections to
+                      Elasticsearch that have been idle for <s> seconds
+  --http <s>          HTTP backend of the Elasticsearch client; one of
+                      'urllib3' or 'requests' (default: 'urllib3')
+  --versioning        version documents by the latest OMERO Event that
+                      updated any of their objects and only write newer
+                      ones; removing annotations or links does not
+                      advance the version, so an older document whose
+                      source differs fails rather than being skipped
+                      (default: overwrite documents)
+  --fingerprints <f>  SQLite file recording a hash of each document
+                      indexed; documents that have not changed since are
+                      not sent again.  Compact it, or forget an index,
+                      with 'python -m omero_es.fingerprint'
+  --journal <f>       NDJSON file to record the progress of the run to,
+                      replacing any previous one, so that it can be
+                      resumed if interrupted
+  --resume <f>        resume the run recorded in journal <f>; containers
+                      already indexed are skipped and large ones continue
+                      from their last checkpoint
+  --checkpoint-size <n>
+                      number of Images or Wells of a container indexed
+                      between checkpoints of its position in the journal
+                      (default: 10000)
+  --since <id>        only re-index the documents affected by changes
+                      after OMERO Event <id>
+  --incremental       only re-index the documents affected by changes
+                      since the last complete run, as recorded in the
+                      watermark file
+  --watermark <f>     file recording the latest OMERO Event indexed by
+                      complete (-a or --incremental) runs
+                      (default: 'watermark.json')
+  --overlap <n>       number of Events before the watermark that
+                      --incremental re-scans for changes committed late,
+                      by long transactions (default: 10000)
 
 Examples:
     %(cmd)s -s localhost -p 4064 -u jsmith -w secret -a
     %(cmd)s -s localhost -p 4064 -u jsmith -w secret --project 1 --project 2
     %(cmd)s -s localhost -p 4064 -u jsmith -w secret --screen 1 --screen 2
     %(cmd)s -s localhost -p 4064 -u jsmith -w secret --project 1 --screen 2
+    %(cmd)s -s localhost -p 4064 -u jsmith -w secret -a --workers 8
+    %(cmd)s -s localhost -p 4064 -u jsmith -w secret -a --workers 8 \
+        --shard-size 10000
+    %(cmd)s -s localhost -p 4064 -u jsmith -w secret -a \
+        --url http://localhost:9200
+    %(cmd)s -s localhost -p 4064 -u jsmith -w secret --incremental \
+        --url http://localhost:9200
+    %(cmd)s -s localhost -p 4064 -u jsmith -w secret -a \
+        --url http://localhost:9200 --journal journal.json
+    %(cmd)s -s localhost -p 4064 -u jsmith -w secret -a \
+        --url http://localhost:9200 --resume journal.json
+    %(cmd)s -s localhost -p 4064 -u jsmith -w secret -a --workers 8 \
+        --output export/omero --compress
+    %(cmd)s --url http://localhost:9200 --replay-dead-letters failed.json
 
 Report bugs to support@glencoesoftware.com""" % {'cmd': cmd}
     sys.exit(2)
@@ -122,157 +252,606 @@ def find_screen_ids(client):
     return ids
 
 
+def document_version(document, settings):
+    """
+    Returns the external version to index `document` with, if versioning
+    is enabled.
+    """
+    if settings['versioning']:
+        return document.version
+    return None
+
+
+def image_document_index_action(image_document, project_id, index,
+                                version=None):
+    _id = image_document.image.id.val
+    if image_document.dataset_id is not None:
+        _id = '%d_%d' % (image_document.dataset_id, _id)
+    return serializer.index_action(
+        index, 'image', _id, project_id, image_document.source, version
+    )
+
+
 def image_document_index_actions(project_document, index):
+    project_id = project_document.project.id.val
     for image_document in project_document.image_documents:
-        _id = image_document.image.id.val
-        if image_document.dataset_id is not None:
-            _id = '%d_%d' % (image_document.dataset_id, _id)
-        yield {
-            '_index': index,
-            '_type': 'image',
-            '_parent': project_document.project.id.val,
-            '_id': _id,
-            '_source': json.dumps(image_document.document)
-        }
-
-
-def index_projects(es, index, client, project_ids):
+        yield image_document_index_action(image_document, project_id, index)
+
+
+def load_project(client, project_id):
     session = client.getSession()
     query_service = session.getQueryService()
 
-    for project_id in project_ids:
-        log.info('Processing Project:%d' % project_id)
-
-        params = ParametersI()
-        params.addId(project_id)
-        t0 = time.time()
-        project = query_service.findByQuery(
-            QUERY_PROJECT, params, {'omero.group': '-1'}
-        )
-        log.info(
-            'Loaded Project:%d (%dms)' % (
-                project_id, (time.time() - t0) * 1000
-            )
+    params = ParametersI()
+    params.addId(project_id)
+    t0 = time.time()
+    project = query_service.findByQuery(
+        QUERY_PROJECT, params, {'omero.group': '-1'}
+    )
+    log.info(
+        'Loaded Project:%d (%dms)' % (
+            project_id, (time.time() - t0) * 1000
         )
+    )
 
-        if project is None:
-            log.warn('Project:%d has no Datasets or Images!' % project_id)
-            continue
+    if project is None:
+        log.warn('Project:%d has no Datasets or Images!' % project_id)
+    return project
 
-        t0 = time.time()
-        document = ProjectDocument(client, project)
-        log.info(
-            'Created document from Project:%d (%dms)' % (
-                project_id, (time.time() - t0) * 1000
-            )
+
+def create_project_document(client, project, settings, **kwargs):
+    t0 = time.time()
+    document = ProjectDocument(
+        client, project, page_size=settings['page_size'],
+        loading=settings['image_loading'], loader=settings['loader'],
+        **kwargs
+    )
+    log.info(
+        'Created document from Project:%d (%dms)' % (
+            project.id.val, (time.time() - t0) * 1000
         )
-        if es is None:
-            print document
-            for image_document in document.image_documents:
-                print image_document
-            continue
+    )
+    return document
+
+
+def index_project_document(writer, index, document, settings):
+    if writer is None:
+        print document
+        return 1
 
-        logging.info('Using Elasticsearch index: %s' % index)
+    writer.send([serializer.index_action(
+        index, 'project', document.project.id.val, None, document.source,
+        document_version(document, settings)
+    )])
+    return 1
 
+
+def run_pipelines(writer, create_pipeline, items, document, key, settings):
+    """
+    Runs `items` through a pipeline, created by `create_pipeline`, to
+    `writer`.  With a checkpoint `key`, if there is a journal, they are run
+    in segments instead and the `document`'s position is recorded once the
+    documents of each have been indexed; see `omero_es.checkpoint`.
+    """
+    if key is None or checkpoint.journal is None:
+        return create_pipeline().run(items, writer.send)
+    count = 0
+    segments = checkpoint.Segments(items, settings['checkpoint_size'])
+    for segment in segments:
+        count += create_pipeline().run(segment, writer.send)
+        if segments.exhausted:
+            break
         t0 = time.time()
-        result = es.index(
-            index=index,
-            doc_type='project',
-            id=project_id,
-            body=json.dumps(document.document)
-        )
+        writer.wait()
+        checkpoint.record(key, position=document.position)
         log.info(
-            'Index complete: %r (%dms)' % (
-                result, (time.time() - t0) * 1000
+            'Checkpointed %s at %r, %d documents (%dms)' % (
+                key, document.position, count, (time.time() - t0) * 1000
             )
         )
+    return count
 
-        t0 = time.time()
-        result = helpers.bulk(
-            es, image_document_index_actions(document, index)
+
+def index_image_documents(writer, index, document, settings, key=None):
+    if writer is None:
+        count = 0
+        for image_document in document.image_documents:
+            print image_document
+            count += 1
+        return count
+
+    project_id = document.project.id.val
+
+    def create_pipeline():
+        pipeline = Pipeline(
+            'Project:%d' % project_id, settings['queue_size']
         )
-        log.info(
-            'Index complete: %r (%dms)' % (
-                result, (time.time() - t0) * 1000
+        pipeline.stage('encode', document.create_image_documents)
+        pipeline.stage('serialize', lambda v: [
+            image_document_index_action(
+                v, project_id, index, document_version(v, settings)
             )
+        ])
+        return pipeline
+
+    t0 = time.time()
+    result = run_pipelines(
+        writer, create_pipeline, document.images, document, key, settings
+    )
+    log.info(
+        'Queued %d documents for indexing (%dms)' % (
+            result, (time.time() - t0) * 1000
         )
+    )
+    return result
+
+
+def index_project(writer, index, client, project_id, settings):
+    log.info('Processing Project:%d' % project_id)
+    project = load_project(client, project_id)
+    if project is None:
+        return 0
+    key = 'Project:%d' % project_id
+    resume = checkpoint.position(key)
+    if resume is not None:
+        log.info('Resuming %s after %r' % (key, resume))
+    document = create_project_document(
+        client, project, settings, resume=resume
+    )
+    count = index_project_document(writer, index, document, settings)
+    return count + index_image_documents(
+        writer, index, document, settings, key
+    )
+
+
+def index_project_shard(writer, index, client, shard, settings):
+    project_id, dataset_ids, first, last = shard
+    log.info('Processing Project:%d shard %r' % (project_id, shard))
+    project = load_project(client, project_id)
+    if project is None:
+        return 0
+    id_range = None
+    if first is not None:
+        id_range = (first, last)
+    document = create_project_document(
+        client, project, settings, dataset_ids=dataset_ids,
+        id_range=id_range
+    )
+    return index_image_documents(writer, index, document, settings)
+
+
+def index_project_parent(writer, index, client, project_id, settings):
+    project = load_project(client, project_id)
+    if project is None:
+        return 0
+    document = create_project_document(client, project, settings)
+    return index_project_document(writer, index, document, settings)
+
+
+def index_project_images(writer, index, client, task, settings):
+    project_id, image_ids = task
+    log.info(
+        'Processing %d Images of Project:%d' % (len(image_ids), project_id)
+    )
+    project = load_project(client, project_id)
+    if project is None:
+        return 0
+    document = create_project_document(
+        client, project, settings, image_ids=image_ids
+    )
+    return index_image_documents(writer, index, document, settings)
+
+
+def index_projects(sink, index, client, project_ids, settings):
+    return index_serial(
+        sink, index, client, [('Project', v) for v in project_ids], settings
+    )
+
+
+def well_document_index_action(well_document, plate_id, index,
+                               version=None):
+    return serializer.index_action(
+        index, 'well', well_document.well.id.val, plate_id,
+        well_document.source, version
+    )
 
 
 def well_document_index_actions(plate_document, index):
+    plate_id = plate_document.plate.id.val
     for well_document in plate_document.well_documents:
-        yield {
-            '_index': index,
-            '_type': 'well',
-            '_parent': plate_document.plate.id.val,
-            '_id': well_document.well.id.val,
-            '_source': json.dumps(well_document.document)
-        }
+        yield well_document_index_action(well_document, plate_id, index)
 
 
-def index_screens(es, index, client, screen_ids):
+def load_plates(client, query, _id):
     session = client.getSession()
     query_service = session.getQueryService()
 
-    for screen_id in screen_ids:
-        log.info('Processing Screen:%d' % screen_id)
+    params = ParametersI()
+    params.addId(_id)
+    t0 = time.time()
+    plates = query_service.findAllByQuery(
+        query, params, {'omero.group': '-1'}
+    )
+    log.info(
+        'Loaded %d Plates (%dms)' % (
+            len(plates), (time.time() - t0) * 1000
+        )
+    )
+    return plates
 
-        params = ParametersI()
-        params.addId(screen_id)
-        t0 = time.time()
-        plates = query_service.findAllByQuery(
-            QUERY_PLATES, params, {'omero.group': '-1'}
+
+def create_plate_document(client, plate, settings, **kwargs):
+    t0 = time.time()
+    document = PlateDocument(
+        client, plate, page_size=settings['page_size'],
+        loader=settings['loader'], **kwargs
+    )
+    log.info(
+        'Created document from Plate:%d (%dms)' % (
+            plate.id.val, (time.time() - t0) * 1000
         )
-        log.info(
-            'Loaded %d Plates from Screen:%d (%dms)' % (
-                len(plates), screen_id, (time.time() - t0) * 1000
+    )
+    return document
+
+
+def index_plate_document(writer, index, document, settings):
+    if writer is None:
+        print document
+        return 1
+
+    writer.send([serializer.index_action(
+        index, 'plate', document.plate.id.val, None, document.source,
+        document_version(document, settings)
+    )])
+    return 1
+
+
+def index_well_documents(writer, index, document, settings, key=None):
+    if writer is None:
+        count = 0
+        for well_document in document.well_documents:
+            print well_document
+            count += 1
+        return count
+
+    plate_id = document.plate.id.val
+
+    def create_pipeline():
+        pipeline = Pipeline('Plate:%d' % plate_id, settings['queue_size'])
+        pipeline.stage('encode', document.create_well_documents)
+        pipeline.stage('serialize', lambda v: [
+            well_document_index_action(
+                v, plate_id, index, document_version(v, settings)
             )
+        ])
+        return pipeline
+
+    t0 = time.time()
+    result = run_pipelines(
+        writer, create_pipeline, document.wells, document, key, settings
+    )
+    log.info(
+        'Queued %d documents for indexing (%dms)' % (
+            result, (time.time() - t0) * 1000
         )
-        for plate in plates:
-            plate_id = plate.id.val
-            t0 = time.time()
-            document = PlateDocument(client, plate)
-            log.info(
-                'Created document from Plate:%d (%dms)' % (
-                    plate_id, (time.time() - t0) * 1000
-                )
-            )
-            if es is None:
-                print document
-                for well_document in document.well_documents:
-                    print well_document
-                continue
-
-            logging.info('Using Elasticsearch index: %s' % index)
-
-            t0 = time.time()
-            result = es.index(
-                index=index,
-                doc_type='plate',
-                id=plate_id,
-                body=json.dumps(document.document)
-            )
-            log.info(
-                'Index complete: %r (%dms)' % (
-                    result, (time.time() - t0) * 1000
-                )
-            )
+    )
+    return result
+
+
+def index_screen(writer, index, client, screen_id, settings):
+    log.info('Processing Screen:%d' % screen_id)
+    count = 0
+    for plate in load_plates(client, QUERY_PLATES, screen_id):
+        key = 'Plate:%d' % plate.id.val
+        if checkpoint.done(key):
+            log.info('Skipping %s, already done' % key)
+            continue
+        resume = checkpoint.position(key)
+        if resume is not None:
+            log.info('Resuming %s after %r' % (key, resume))
+        document = create_plate_document(
+            client, plate, settings, resume=resume
+        )
+        count += index_plate_document(writer, index, document, settings)
+        count += index_well_documents(
+            writer, index, document, settings, key
+        )
+        if writer is not None and checkpoint.journal is not None:
+            # Each Plate is checkpointed as done once indexed
+            writer.wait()
+            checkpoint.record(key, done=True)
+    return count
+
+
+def index_plate_shard(writer, index, client, shard, settings):
+    plate_id, first, last = shard
+    log.info('Processing Plate:%d shard %r' % (plate_id, shard))
+    id_range = None
+    if first is not None:
+        id_range = (first, last)
+    count = 0
+    for plate in load_plates(client, QUERY_PLATE, plate_id):
+        document = create_plate_document(
+            client, plate, settings, id_range=id_range
+        )
+        count += index_well_documents(writer, index, document, settings)
+    return count
+
+
+def index_plate_parent(writer, index, client, plate_id, settings):
+    count = 0
+    for plate in load_plates(client, QUERY_PLATE, plate_id):
+        document = create_plate_document(client, plate, settings)
+        count += index_plate_document(writer, index, document, settings)
+    return count
+
+
+def index_plate_wells(writer, index, client, task, settings):
+    plate_id, well_ids = task
+    log.info('Processing %d Wells of Plate:%d' % (len(well_ids), plate_id))
+    count = 0
+    for plate in load_plates(client, QUERY_PLATE, plate_id):
+        document = create_plate_document(
+            client, plate, settings, well_ids=well_ids
+        )
+        count += index_well_documents(writer, index, document, settings)
+    return count
+
+
+def index_screens(sink, index, client, screen_ids, settings):
+    return index_serial(
+        sink, index, client, [('Screen', v) for v in screen_ids], settings
+    )
+
+
+# Indexing function for a single task, by task type.  Shards only index
+# child documents; their parent tasks index the container document once
+# all of its shards are complete.  Incremental indexing re-indexes a set
+# of child documents of a container with `ProjectImages` and `PlateWells`
+# tasks, and only updates the annotations of a batch of documents with
+# `<type>Annotations` tasks, falling back to the indexing function of the
+# objects for documents that do not exist yet; see `omero_es.incremental`.
+INDEXERS = {
+    'Project': index_project,
+    'ProjectShard': index_project_shard,
+    'ProjectParent': index_project_parent,
+    'ProjectImages': index_project_images,
+    'Screen': index_screen,
+    'PlateShard': index_plate_shard,
+    'PlateParent': index_plate_parent,
+    'PlateWells': index_plate_wells,
+    'ProjectAnnotations': partial.annotation_indexer(
+        'Project', index_project_parent
+    ),
+    'ImageAnnotations': partial.annotation_indexer(
+        'Image', index_project_images
+    ),
+    'PlateAnnotations': partial.annotation_indexer(
+        'Plate', index_plate_parent
+    ),
+    'WellAnnotations': partial.annotation_indexer('Well', index_plate_wells),
+}
+
+
+def start_task(sink, index, client, task, settings):
+    """
+    Queues the documents of the container described by a `(kind, id)`
+    task with the bulk `sink` and returns the pending task that
+    `finish_task()` completes.
+    """
+    kind, _id = task
+    t0 = time.time()
+    writer = None
+    if sink is not None:
+        writer = sink.writer('%s:%s' % task)
+    try:
+        count = INDEXERS[kind](writer, index, client, _id, settings)
+        return (kind, _id, count, writer, t0, time.time(), None)
+    except Exception, e:
+        log.error('Failed to index %s:%s' % (kind, _id), exc_info=True)
+        return (kind, _id, 0, writer, t0, time.time(), describe_error(e))
+
+
+def finish_task(pending):
+    """
+    Waits for the documents of a pending task to be indexed and returns a
+    `(kind, id, documents, elapsed, error, skipped)` result; `skipped` of
+    the documents were already indexed at the same or a newer version.
+    Failures are logged and reported in the result so that one container
+    cannot abort a run.
+    """
+    kind, _id, count, writer, t0, t1, error = pending
+    if writer is None or error is not None:
+        return (kind, _id, count, t1 - t0, error, 0)
+    try:
+        writer.wait()
+        checkpoint.record(checkpoint.key((kind, _id)), done=True)
+    except Exception, e:
+        log.error('Failed to index %s:%s' % (kind, _id), exc_info=True)
+        count = 0
+        error = describe_error(e)
+    return (
+        kind, _id, count, max(t1, writer.completed) - t0, error,
+        writer.skipped
+    )
 
-            t0 = time.time()
-            result = helpers.bulk(
-                es, well_document_index_actions(document, index)
+
+def run_task(sink, index, client, task, settings):
+    """
+    Indexes the container described by a `(kind, id)` task and waits for
+    its documents to be indexed; see `finish_task()`.
+    """
+    return finish_task(start_task(sink, index, client, task, settings))
+
+
+def replay_dead_letters(sink, path):
+    """
+    Resubmits the actions of a dead letter file and returns the number
+    that were indexed.
+    """
+    log.info('Replaying dead letters from %s' % path)
+    t0 = time.time()
+    writer = sink.writer(path)
+    count = writer.send(bulk.read_actions(path))
+    sink.flush()
+    try:
+        success = writer.wait()
+    except Exception:
+        log.error('Failed to replay dead letters', exc_info=True)
+        success = writer.success
+    log.info(
+        'Replayed %d of %d dead letters (%dms)' % (
+            success, count, (time.time() - t0) * 1000
+        )
+    )
+    return success
+
+
+# Per process state of pool workers, populated by `init_worker()`
+_worker = dict()
+
+
+def configure(settings):
+    """
+    Applies the process wide settings; those of the caches, encoders and
+    journal.
+    """
+    cache.resize(settings['cache_size'])
+    if settings['fast_encoders']:
+        fast.install()
+    serializer.use(settings['json'])
+    checkpoint.use(settings['journal'])
+
+
+def init_worker(server, port, username, password, url, index, settings):
+    """
+    Pool worker initializer.  Each worker owns an OMERO session and an
+    Elasticsearch client for the lifetime of the pool.  Failures are kept
+    and fail each of the worker's tasks instead; raising would have the
+    pool start a new worker, which would fail too, forever.
+    """
+    try:
+        client = omero.client(server, port)
+        client.createSession(username, password)
+        # Runs when the worker exits following `Pool.close()`
+        Finalize(client, client.closeSession, exitpriority=10)
+        configure(settings)
+        Finalize(None, cache.report, exitpriority=20)
+        sink = create_sink(url, settings)
+        if sink is not None:
+            Finalize(sink, sink.close, exitpriority=15)
+            Finalize(None, transport.sent.report, exitpriority=14)
+    except Exception, e:
+        log.error('Failed to initialize worker', exc_info=True)
+        _worker.update(error=describe_error(e))
+        return
+    _worker.update(
+        client=client, sink=sink, index=index, settings=settings
+    )
+
+
+def work(task):
+    error = _worker.get('error')
+    if error is not None:
+        kind, _id = task
+        return (kind, _id, 0, 0, error, 0)
+    return run_task(
+        _worker['sink'], _worker['index'], _worker['client'], task,
+        _worker['settings']
+    )
+
+
+def index_serial(sink, index, client, tasks, settings, progress=None):
+    """
+    Indexes `tasks` one after the other.  The documents of all of them
+    stream through the bulk `sink` and the results are only collected
+    once the last task has been queued, so that small containers share
+    bulk requests.
+    """
+    pending = list()
+    for task in tasks:
+        pending.append(start_task(sink, index, client, task, settings))
+        if progress is not None:
+            progress.update(task)
+    if sink is not None:
+        sink.flush()
+    return [finish_task(v) for v in pending]
+
+
+def index_parallel(sink, index, client, pool, tasks, parents, settings,
+                   progress=None):
+    """
+    Indexes `tasks` with the worker `pool`.  Parent tasks of shards are
+    run here, by the parent process, as soon as their last shard
+    completes.  If any of the shards failed the parent task is not run
+    and is reported as failed.  Like `index_serial()` the results of the
+    parent tasks are only collected at the end.
+    """
+    remaining = dict()
+    failed = set()
+    for shard, parent in parents.iteritems():
+        remaining[parent] = remaining.get(parent, 0) + 1
+    results = list()
+    pending = list()
+    # One task at a time so that the longest first ordering is preserved
+    for result in pool.imap_unordered(work, tasks, 1):
+        kind, _id, count, elapsed, error, skipped = result
+        results.append(result)
+        log.info(
+            'Finished %s:%s (%d/%d) with %d documents (%dms)' % (
+                kind, _id, len(results), len(tasks), count, elapsed * 1000
             )
-            log.info(
-                'Index complete: %r (%dms)' % (
-                    result, (time.time() - t0) * 1000
-                )
+        )
+        if progress is not None:
+            progress.update((kind, _id))
+        parent = parents.get((kind, _id))
+        if parent is None:
+            continue
+        if error is not None:
+            failed.add(parent)
+        remaining[parent] -= 1
+        if remaining[parent] > 0:
+            continue
+        if parent in failed:
+            results.append(
+                parent + (0, 0, 'One or more shards failed to index', 0)
             )
+            continue
+        pending.append(start_task(sink, index, client, parent, settings))
+    if sink is not None:
+        sink.flush()
+    return results + [finish_task(v) for v in pending]
+
+
+def report(results, elapsed):
+    failures = [v for v in results if v[4] is not None]
+    skipped = sum([v[5] for v in results])
+    log.info(
+        'Indexed %d tasks, %d documents, %d skipped as up to date, '
+        '%d failures (%dms)' % (
+            len(results) - len(failures),
+            sum([v[2] for v in results]) - skipped, skipped,
+            len(failures), elapsed * 1000
+        )
+    )
+    for kind, _id, count, _elapsed, error, _skipped in failures:
+        log.error('Failed to index %s:%s %s' % (kind, _id, error))
 
 
 def main():
     try:
         options, args = getopt(
             sys.argv[1:], "s:p:u:w:a", [
-                "debug", "url=", "index=", "screen=", "project="
+                "debug", "url=", "index=", "screen=", "project=",
+                "workers=", "shard-size=", "queue-size=",
+                "page-size=", "image-loading=", "loader=", "cache-size=",
+                "fast-encoders", "json=", "bulk-size=", "bulk-bytes=",
+                "bulk-requests=", "bulk-latency=", "bulk-retries=",
+                "dead-letters=", "replay-dead-letters=", "compress",
+                "connections=", "keep-alive=", "http=", "since=",
+                "incremental", "watermark=", "overlap=", "versioning",
+                "fingerprints=", "journal=", "resume=", "checkpoint-size=",
+                "output=", "output-bytes="
             ]
         )
     except GetoptError, (msg, _opt):
@@ -284,8 +863,17 @@ def main():
     _all = False
     project_ids = list()
     screen_ids = list()
-    es = None
+    sink = url = None
     index = 'omero'
+    workers = 1
+    shard_size = None
+    settings = dict(SETTINGS)
+    replay = None
+    since = None
+    _incremental = False
+    watermark = 'watermark.json'
+    overlap = incremental.OVERLAP
+    resume = False
     for option, argument in options:
         if option == "-s":
             server = argument
@@ -300,32 +888,216 @@ def main():
         if option == "--debug":
             level = logging.DEBUG
         if option == "--url":
-            es = Elasticsearch([argument], verify_certs=True, timeout=60)
+            url = argument
         if option == "--index":
             index = argument
         if option == "--screen":
             screen_ids.append(long(argument))
         if option == "--project":
             project_ids.append(long(argument))
+        if option == "--workers":
+            workers = int(argument)
+        if option == "--shard-size":
+            shard_size = int(argument)
+        if option == "--queue-size":
+            settings['queue_size'] = int(argument)
+        if option == "--page-size":
+            settings['page_size'] = int(argument)
+        if option == "--image-loading":
+            if argument not in ('project', 'dataset'):
+                usage('Invalid Image loading strategy: %s' % argument)
+            settings['image_loading'] = argument
+        if option == "--loader":
+            if argument not in LOADERS:
+                usage('Invalid loader: %s' % argument)
+            settings['loader'] = argument
+        if option == "--cache-size":
+            settings['cache_size'] = int(argument)
+        if option == "--fast-encoders":
+            settings['fast_encoders'] = True
+        if option == "--json":
+            if argument not in dict(serializer.BACKENDS):
+                usage('Invalid JSON backend: %s' % argument)
+            try:
+                dict(serializer.BACKENDS)[argument]()
+            except ImportError:
+                usage('No JSON backend: %s' % argument)
+            settings['json'] = argument
+        if option == "--bulk-size":
+            settings['bulk_size'] = int(argument)
+        if option == "--bulk-bytes":
+            settings['bulk_bytes'] = int(argument)
+        if option == "--bulk-requests":
+            settings['bulk_requests'] = int(argument)
+        if option == "--bulk-latency":
+            # Zero disables adapting the chunk size
+            settings['bulk_latency'] = int(argument) / 1000.0 or None
+        if option == "--bulk-retries":
+            settings['bulk_retries'] = int(argument)
+        if option == "--dead-letters":
+            settings['dead_letters'] = argument
+        if option == "--replay-dead-letters":
+            replay = argument
+        if option == "--compress":
+            settings['compress'] = True
+        if option == "--connections":
+            settings['connections'] = int(argument)
+        if option == "--keep-alive":
+            settings['keep_alive'] = int(argument)
+        if option == "--http":
+            if argument not in transport.BACKENDS:
+                usage('Invalid HTTP backend: %s' % argument)
+            settings['http'] = argument
+        if option == "--since":
+            since = long(argument)
+        if option == "--incremental":
+            _incremental = True
+        if option == "--watermark":
+            watermark = argument
+        if option == "--overlap":
+            overlap = long(argument)
+        if option == "--versioning":
+            settings['versioning'] = True
+        if option == "--fingerprints":
+            settings['fingerprints'] = argument
+        if option == "--journal":
+            settings['journal'] = argument
+            resume = False
+        if option == "--resume":
+            settings['journal'] = argument
+            resume = True
+        if option == "--checkpoint-size":
+            settings['checkpoint_size'] = int(argument)
+        if option == "--output":
+            settings['output'] = argument
+        if option == "--output-bytes":
+            settings['output_bytes'] = int(argument)
+
+    if replay is not None:
+        if url is None:
+            usage('Elasticsearch URL required with --replay-dead-letters!')
+        if replay == settings['dead_letters']:
+            usage('Cannot replay dead letters into the same file!')
 
-    if _all is False and len(screen_ids) < 1 and len(project_ids) < 1:
+    elif _incremental:
+        since = incremental.read_watermark(watermark)
+        if since is None:
+            usage('No watermark in %s, index with -a first!' % watermark)
+        since = incremental.since_watermark(since, overlap)
+    elif _all is False and since is None and \
+            len(screen_ids) < 1 and len(project_ids) < 1:
         usage('Either -a, Project or Screen hierarchy specification required!')
+    if resume and not os.path.exists(settings['journal']):
+        usage('No journal to resume: %s' % settings['journal'])
+    if settings['output'] is not None:
+        if url is not None:
+            usage('Either an Elasticsearch URL or --output, not both!')
+        if settings['fingerprints'] is not None:
+            usage('Fingerprints cannot be recorded with --output!')
+    elif settings['journal'] is not None and url is None:
+        usage('Elasticsearch URL required with a journal!')
+    if settings['journal'] is not None and not resume:
+        # A fresh run; the previous one, if any, is forgotten
+        open(settings['journal'], 'w').close()
 
     format = "%(asctime)s %(levelname)-7s [%(name)16s] %(message)s"
     logging.basicConfig(level=level, format=format)
+    configure(settings)
+
+    if replay is not None:
+        sink = create_sink(url, settings)
+        try:
+            replay_dead_letters(sink, replay)
+        finally:
+            sink.close()
+        transport.sent.report()
+        return
+
+    pool = None
+    if workers > 1:
+        # Fork before the parent creates its own Ice communicator so that
+        # workers do not inherit its threads and connections
+        pool = Pool(workers, init_worker, (
+            server, port, username, password, url, index, settings
+        ))
+    # Created after forking so that workers do not inherit its threads
+    sink = create_sink(url, settings)
 
     client = omero.client(server, port)
     client.createSession(username, password)
     try:
-
-        if _all:
-            project_ids = find_project_ids(client)
-            screen_ids = find_screen_ids(client)
-        log.info('Found %d Projects' % len(project_ids))
-        log.info('Found %d Screens' % len(screen_ids))
-        index_projects(es, index, client, project_ids)
-        index_screens(es, index, client, screen_ids)
+        # Changes from here on are picked up by the next incremental run;
+        # that of the interrupted run if resuming so that those made
+        # since to containers it already indexed are not missed
+        run = None
+        if resume:
+            run = checkpoint.journal.state.get('run')
+        if run is not None:
+            event_id = run['event_id']
+            log.info('Resuming run as of Event:%d' % event_id)
+        else:
+            event_id = incremental.latest_event_id(client)
+            checkpoint.record('run', event_id=event_id)
+        if since is not None:
+            estimates = incremental.find_changes(client, since)
+        else:
+            if _all:
+                project_ids = find_project_ids(client)
+                screen_ids = find_screen_ids(client)
+            log.info('Found %d Projects' % len(project_ids))
+            log.info('Found %d Screens' % len(screen_ids))
+            tasks = [('Project', v) for v in project_ids] + \
+                [('Screen', v) for v in screen_ids]
+            estimates = planning.estimate_work(client, tasks)
+        # Whole tasks done by the interrupted run, if any, are skipped
+        estimates = checkpoint.remaining(estimates)
+        parents = dict()
+        if pool is not None and shard_size is not None:
+            estimates, parents = planning.split(
+                client, estimates, shard_size
+            )
+            estimates, parents = checkpoint.remaining_shards(
+                estimates, parents
+            )
+        progress = checkpoint.Progress(estimates)
+        tasks, loads = planning.schedule(estimates, workers)
+        log.info('Predicted documents per worker: %r' % loads)
+        t0 = time.time()
+        if pool is None:
+            results = index_serial(
+                sink, index, client, tasks, settings, progress
+            )
+        else:
+            log.info('Indexing with %d workers' % workers)
+            results = index_parallel(
+                sink, index, client, pool, tasks, parents, settings,
+                progress
+            )
+        elapsed = time.time() - t0
+        report(results, elapsed)
+        planning.report(estimates, results, loads, elapsed)
+        cache.report()
+        # Only complete runs into Elasticsearch advance the watermark,
+        # and only if nothing failed so that failed changes are retried;
+        # exported documents may never be loaded
+        failures = [v for v in results if v[4] is not None]
+        if url is not None and (_all or _incremental):
+            if len(failures) > 0:
+                log.warn('Not advancing watermark, %d failures' % (
+                    len(failures)
+                ))
+            else:
+                incremental.write_watermark(watermark, event_id)
+        if len(failures) > 0:
+            # So that scripts, `omero_es.rebuild` for one, can tell
+            sys.exit(1)
     finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if sink is not None:
+            sink.close()
+            transport.sent.report()
         client.closeSession()
 
 
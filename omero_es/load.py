@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import logging
+import os
+import sys
+import time
+
+from getopt import getopt, GetoptError
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+
+from . import bulk, transport
+from .settings import SETTINGS, create_sink, describe_error
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Per process state of pool workers, populated by `init_worker()`
+_worker = dict()
+
+
+def usage(error=None):
+    """
+    Prints usage so that we don't have to. :)
+    """
+    cmd = sys.argv[0]
+    if error:
+        print error
+    print """Usage:
+  %(cmd)s <options> <file> [<file> ...]
+
+Loads NDJSON files of bulk API actions, such as those exported with
+'python -m omero_es.index --output', into Elasticsearch
+
+Options:
+  -h                  display this help and exit
+  --url               Elasticsearch base URL to load documents into
+  --debug             turn debugging on
+  --workers <n>       number of files to load concurrently, each by its
+                      own process (default: 1)
+  --bulk-size <n>     initial number of documents per bulk request
+                      (default: 500)
+  --bulk-requests <n> number of bulk requests in flight at once, per
+                      process (default: 2)
+  --bulk-retries <n>  number of times to retry documents rejected by an
+                      overloaded cluster, with exponential backoff
+                      (default: 8)
+  --dead-letters <f>  NDJSON file to append documents that failed to
+                      load to
+  --compress          gzip the bodies of bulk requests
+  --http <s>          HTTP backend of the Elasticsearch client; one of
+                      'urllib3' or 'requests' (default: 'urllib3')
+
+Examples:
+    %(cmd)s --url http://localhost:9200 export/omero-*.json.gz
+    %(cmd)s --url http://localhost:9200 --workers 8 export/omero-*.json.gz
+
+Report bugs to support@glencoesoftware.com""" % {'cmd': cmd}
+    sys.exit(2)
+
+
+def load(sink, path):
+    """
+    Loads the actions of an NDJSON file and waits for them to be indexed.
+    Returns a `(path, count, success, skipped, error)` result.
+    """
+    log.info('Loading %s' % path)
+    t0 = time.time()
+    writer = sink.writer(path)
+    error = None
+    count = writer.send(bulk.read_actions(path))
+    sink.flush()
+    try:
+        success = writer.wait()
+    except Exception, e:
+        log.error('Failed to load %s' % path, exc_info=True)
+        success = writer.success
+        error = describe_error(e)
+    log.info(
+        'Loaded %d of %d actions from %s (%dms)' % (
+            success, count, path, (time.time() - t0) * 1000
+        )
+    )
+    return (path, count, success, writer.skipped, error)
+
+
+def init_worker(url, settings):
+    """
+    Pool worker initializer.  Each worker owns a bulk sink for the
+    lifetime of the pool.
+    """
+    sink = create_sink(url, settings)
+    Finalize(sink, sink.close, exitpriority=15)
+    Finalize(None, transport.sent.report, exitpriority=14)
+    _worker.update(sink=sink)
+
+
+def work(path):
+    return load(_worker['sink'], path)
+
+
+def report(results, elapsed):
+    failures = [v for v in results if v[4] is not None]
+    log.info(
+        'Loaded %d files, %d documents, %d skipped as up to date, '
+        '%d failures (%dms)' % (
+            len(results) - len(failures), sum([v[2] for v in results]),
+            sum([v[3] for v in results]), len(failures), elapsed * 1000
+        )
+    )
+    for path, count, success, skipped, error in failures:
+        log.error('Failed to load %s %s' % (path, error))
+    return failures
+
+
+def main():
+    try:
+        options, args = getopt(
+            sys.argv[1:], "h", [
+                "debug", "url=", "workers=", "bulk-size=", "bulk-requests=",
+                "bulk-retries=", "dead-letters=", "compress", "http="
+            ]
+        )
+    except GetoptError, (msg, _opt):
+        usage(msg)
+
+    level = logging.INFO
+    url = None
+    workers = 1
+    settings = dict(SETTINGS)
+    for option, argument in options:
+        if option == "-h":
+            usage()
+        if option == "--debug":
+            level = logging.DEBUG
+        if option == "--url":
+            url = argument
+        if option == "--workers":
+            workers = int(argument)
+        if option == "--bulk-size":
+            settings['bulk_size'] = int(argument)
+        if option == "--bulk-requests":
+            settings['bulk_requests'] = int(argument)
+        if option == "--bulk-retries":
+            settings['bulk_retries'] = int(argument)
+        if option == "--dead-letters":
+            settings['dead_letters'] = argument
+        if option == "--compress":
+            settings['compress'] = True
+        if option == "--http":
+            if argument not in transport.BACKENDS:
+                usage('Invalid HTTP backend: %s' % argument)
+            settings['http'] = argument
+
+    if url is None:
+        usage('Elasticsearch URL required!')
+    if len(args) < 1:
+        usage('At least one file required!')
+    for path in args:
+        if not os.path.exists(path):
+            usage('No such file: %s' % path)
+
+    format = "%(asctime)s %(levelname)-7s [%(name)16s] %(message)s"
+    logging.basicConfig(level=level, format=format)
+
+    # Largest first so that the last files loaded are small ones
+    paths = sorted(args, key=os.path.getsize, reverse=True)
+    t0 = time.time()
+    if workers > 1:
+        pool = Pool(workers, init_worker, (url, settings))
+        try:
+            results = list(pool.imap_unordered(work, paths, 1))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        sink = create_sink(url, settings)
+        try:
+            results = [load(sink, v) for v in paths]
+        finally:
+            sink.close()
+            transport.sent.report()
+    if len(report(results, time.time() - t0)) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
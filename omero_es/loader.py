@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import logging
+import time
+
+import omero.model
+
+from omero.rtypes import rlist, rlong
+from omero.sys import ParametersI
+
+from . import cache
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Maximum number of ids in a single `IN (:ids)` clause
+BATCH_SIZE = 1000
+
+
+QUERY_PROJECT_IMAGES = """SELECT image FROM Image AS image
+LEFT OUTER JOIN FETCH image.annotationLinks AS i_a_link
+LEFT OUTER JOIN FETCH i_a_link.child
+JOIN FETCH image.details.creationEvent as c_event
+JOIN FETCH c_event.type
+JOIN FETCH image.details.updateEvent as u_event
+JOIN FETCH u_event.type
+JOIN FETCH image.details.owner
+JOIN FETCH image.details.group AS eg
+JOIN FETCH eg.groupExperimenterMap AS eg_e_map
+JOIN FETCH eg_e_map.child
+JOIN FETCH image.pixels AS pixels
+JOIN FETCH pixels.channels AS channel
+JOIN FETCH channel.logicalChannel
+JOIN FETCH image.datasetLinks AS i_d_link
+JOIN i_d_link.parent AS dataset
+JOIN dataset.projectLinks AS p_d_link
+WHERE p_d_link.parent.id = :id
+AND image.id IN (:ids)
+"""
+
+QUERY_WELLS = """SELECT well FROM Well AS well
+LEFT OUTER JOIN FETCH well.annotationLinks AS w_a_link
+LEFT OUTER JOIN FETCH w_a_link.child
+LEFT OUTER JOIN FETCH well.wellSamples as wellsample
+LEFT OUTER JOIN FETCH wellsample.image as image
+LEFT OUTER JOIN FETCH image.annotationLinks as i_a_link
+LEFT OUTER JOIN FETCH i_a_link.child
+LEFT OUTER JOIN FETCH image.pixels AS pixels
+LEFT OUTER JOIN FETCH pixels.channels AS channel
+LEFT OUTER JOIN FETCH channel.logicalChannel
+JOIN FETCH well.details.creationEvent as c_event
+JOIN FETCH c_event.type
+JOIN FETCH well.details.updateEvent as u_event
+JOIN FETCH u_event.type
+JOIN FETCH well.details.owner
+JOIN FETCH well.details.group AS eg
+JOIN FETCH eg.groupExperimenterMap AS eg_e_map
+JOIN FETCH eg_e_map.child
+WHERE well.id IN (:ids)
+"""
+
+# Appended to queries joining `dataset` to restrict them to a subset of a
+# Project's Datasets
+QUERY_DATASET_FILTER = """AND dataset.id IN (:dataset_ids)
+"""
+
+QUERY_IMAGES_CORE = """SELECT image FROM Image AS image
+JOIN FETCH image.details.creationEvent as c_event
+JOIN FETCH c_event.type
+JOIN FETCH image.details.updateEvent as u_event
+JOIN FETCH u_event.type
+JOIN FETCH image.details.owner
+WHERE image.id IN (:ids)
+"""
+
+QUERY_WELLS_CORE = """SELECT well FROM Well AS well
+JOIN FETCH well.details.creationEvent as c_event
+JOIN FETCH c_event.type
+JOIN FETCH well.details.updateEvent as u_event
+JOIN FETCH u_event.type
+JOIN FETCH well.details.owner
+WHERE well.id IN (:ids)
+"""
+
+QUERY_DATASET_IMAGE_LINKS = """SELECT i_d_link
+FROM DatasetImageLink AS i_d_link
+JOIN i_d_link.parent AS dataset
+JOIN dataset.projectLinks AS p_d_link
+WHERE p_d_link.parent.id = :id
+AND i_d_link.child.id IN (:ids)
+"""
+
+QUERY_WELL_SAMPLES = """SELECT wellsample FROM WellSample AS wellsample
+LEFT OUTER JOIN FETCH wellsample.image
+WHERE wellsample.well.id IN (:ids)
+ORDER BY wellsample.id
+"""
+
+QUERY_PIXELS = """SELECT DISTINCT pixels FROM Pixels AS pixels
+LEFT OUTER JOIN FETCH pixels.channels AS channel
+LEFT OUTER JOIN FETCH channel.logicalChannel
+WHERE pixels.image.id IN (:ids)
+ORDER BY pixels.id
+"""
+
+QUERY_ANNOTATION_LINK_KEYS = """SELECT link.id, link.parent.id,
+annotation.id, annotation.details.updateEvent.id,
+link.details.updateEvent.id
+FROM %s AS link
+JOIN link.child AS annotation
+WHERE link.parent.id IN (:ids)
+ORDER BY link.id
+"""
+
+QUERY_ANNOTATIONS = """SELECT annotation FROM Annotation AS annotation
+WHERE annotation.id IN (:ids)
+"""
+
+QUERY_GROUPS = """SELECT DISTINCT eg FROM ExperimenterGroup AS eg
+JOIN FETCH eg.groupExperimenterMap AS eg_e_map
+JOIN FETCH eg_e_map.child
+WHERE eg.id IN (:ids)
+"""
+
+
+class JoinFetchLoader(object):
+    """
+    Loads Image and Well graphs with a single query that JOIN FETCHes
+    every association.
+    """
+
+    def load_images(self, query_service, project_id, ids, dataset_ids=None):
+        """
+        Loads the Images with the specified ids along with their links to
+        the Project's Datasets (restricted to `dataset_ids` if set).
+        """
+        params = ParametersI().addId(project_id).addIds(ids)
+        query = QUERY_PROJECT_IMAGES
+        if dataset_ids is not None:
+            params.add('dataset_ids', rlist([rlong(v) for v in dataset_ids]))
+            query += QUERY_DATASET_FILTER
+        return query_service.findAllByQuery(
+            query, params, {'omero.group': '-1'}
+        )
+
+    def load_wells(self, query_service, ids):
+        return query_service.findAllByQuery(
+            QUERY_WELLS, ParametersI().addIds(ids), {'omero.group': '-1'}
+        )
+
+
+class NarrowLoader(object):
+    """
+    Loads the same Image and Well graphs as `JoinFetchLoader` but with a
+    separate, id batched, query for each association which are then
+    assembled client side.  This avoids the cartesian product of
+    annotations, channels and group members that a single JOIN FETCH
+    query returns rows for.  Groups, with their members, are only loaded
+    once per loader and annotations once per process while they remain in
+    `omero_es.cache.annotations`.
+    """
+
+    def __init__(self):
+        self.groups = dict()
+
+    def find(self, query_service, query, params):
+        return query_service.findAllByQuery(
+            query, params, {'omero.group': '-1'}
+        )
+
+    def group_by_parent(self, query_service, query, ids, parent):
+        """
+        Returns the results of `query` for the batch of parent `ids`
+        grouped by the id of their `parent` property; in result order.
+        """
+        grouped = dict([(v, list()) for v in ids])
+        if len(ids) < 1:
+            return grouped
+        for obj in self.find(query_service, query, ParametersI().addIds(ids)):
+            grouped[getattr(obj, parent).id.val].append(obj)
+        return grouped
+
+    def load_annotations(self, query_service, keys):
+        """
+        Returns the annotations with the specified `(id, update event id)`
+        keys by id.  Only those not already in the annotation cache are
+        loaded, each once, and are added to it.
+        """
+        annotations = dict()
+        misses = set()
+        for key in keys:
+            annotation = cache.annotations.get(key)
+            if annotation is None:
+                misses.add(key[0])
+            else:
+                annotations[key[0]] = annotation
+        misses = sorted(misses)
+        t0 = time.time()
+        for i in range(0, len(misses), BATCH_SIZE):
+            params = ParametersI().addIds(misses[i:i + BATCH_SIZE])
+            for annotation in self.find(
+                    query_service, QUERY_ANNOTATIONS, params):
+                key = (
+                    annotation.id.val,
+                    annotation.details.updateEvent.id.val
+                )
+                annotation.unloadDetails()
+                annotation._cache_key = key
+                annotations[key[0]] = annotation
+                cache.annotations.put(key, annotation)
+        log.debug(
+            'Loaded %d of %d distinct Annotations (%dms)' % (
+                len(misses), len(keys), (time.time() - t0) * 1000
+            )
+        )
+        return annotations
+
+    def load_annotation_links(self, query_service, link_type, objects):
+        """
+        Prefetches the annotations linked to a batch of objects.  Each
+        distinct annotation is shared by all of the links to it so it is
+        only loaded, and encoded, once.  Links only have their update
+        event, part of the document's version as when JOIN FETCHed.
+        """
+        ids = [v.id.val for v in objects]
+        rows = list()
+        if len(ids) > 0:
+            rows = [
+                [v.val for v in r] for r in query_service.projection(
+                    QUERY_ANNOTATION_LINK_KEYS % link_type,
+                    ParametersI().addIds(ids), {'omero.group': '-1'}
+                )
+            ]
+        annotations = self.load_annotations(
+            query_service, set([(r[2], r[3]) for r in rows])
+        )
+        link_class = getattr(omero.model, link_type + 'I')
+        links = dict([(v, list()) for v in ids])
+        for link_id, parent_id, annotation_id, _, event_id in rows:
+            annotation = annotations.get(annotation_id)
+            if annotation is None:
+                # Deleted since the links were found
+                continue
+            link = link_class(rlong(link_id), True)
+            link.details.setUpdateEvent(omero.model.EventI(event_id, False))
+            link.setChild(annotation)
+            links[parent_id].append(link)
+        for obj in objects:
+            obj._setAnnotationLinks(links[obj.id.val])
+
+    def load_pixels(self, query_service, images):
+        pixels = self.group_by_parent(
+            query_service, QUERY_PIXELS, [v.id.val for v in images], 'image'
+        )
+        for image in images:
+            image._setPixels(pixels[image.id.val])
+
+    def load_groups(self, query_service, objects):
+        ids = set([v.details.group.id.val for v in objects])
+        ids = list(ids.difference(self.groups))
+        if len(ids) > 0:
+            for group in self.find(
+                    query_service, QUERY_GROUPS, ParametersI().addIds(ids)):
+                self.groups[group.id.val] = group
+        for obj in objects:
+            obj.details.setGroup(self.groups[obj.details.group.id.val])
+
+    def load_images(self, query_service, project_id, ids, dataset_ids=None):
+        images = self.find(
+            query_service, QUERY_IMAGES_CORE, ParametersI().addIds(ids)
+        )
+        params = ParametersI().addId(project_id).addIds(ids)
+        query = QUERY_DATASET_IMAGE_LINKS
+        if dataset_ids is not None:
+            params.add('dataset_ids', rlist([rlong(v) for v in dataset_ids]))
+            query += QUERY_DATASET_FILTER
+        dataset_links = dict([(v.id.val, list()) for v in images])
+        for link in self.find(query_service, query, params):
+            dataset_links[link.child.id.val].append(link)
+        for image in images:
+            image._setDatasetLinks(dataset_links[image.id.val])
+        self.load_pixels(query_service, images)
+        # Consistent with the inner JOIN FETCHes of `QUERY_PROJECT_IMAGES`
+        images = [
+            v for v in images if v.sizeOfDatasetLinks() > 0
+            and v.sizeOfPixels() > 0
+            and v.getPrimaryPixels().sizeOfChannels() > 0
+        ]
+        self.load_annotation_links(
+            query_service, 'ImageAnnotationLink', images
+        )
+        self.load_groups(query_service, images)
+        return images
+
+    def load_wells(self, query_service, ids):
+        wells = self.find(
+            query_service, QUERY_WELLS_CORE, ParametersI().addIds(ids)
+        )
+        wellsamples = self.group_by_parent(
+            query_service, QUERY_WELL_SAMPLES, [v.id.val for v in wells],
+            'well'
+        )
+        images = list()
+        for well in wells:
+            well._setWellSamples(wellsamples[well.id.val])
+            images.extend([
+                v.image for v in wellsamples[well.id.val]
+                if v.image is not None and v.image.isLoaded()
+            ])
+        self.load_pixels(query_service, images)
+        self.load_annotation_links(
+            query_service, 'ImageAnnotationLink', images
+        )
+        self.load_annotation_links(query_service, 'WellAnnotationLink', wells)
+        self.load_groups(query_service, wells)
+        return wells
+
+
+# Available loaders by name
+LOADERS = {
+    'join': JoinFetchLoader,
+    'narrow': NarrowLoader,
+}
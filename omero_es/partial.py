@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import logging
+import time
+
+from omero_marshal import get_encoder
+
+# Override various `omero_marshal` encoders with our own
+import omero_es.encoders
+
+from . import serializer
+from .incremental import resolve
+from .loader import NarrowLoader, QUERY_ANNOTATION_LINK_KEYS
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Only Projects with Datasets have documents; see
+# `omero_es.index.QUERY_PROJECT`
+QUERY_PROJECT_DOCUMENTS = """SELECT DISTINCT p_d_link.parent.id
+FROM ProjectDatasetLink AS p_d_link
+WHERE p_d_link.parent.id IN (:ids)
+"""
+
+# Only Plates in Screens have documents; see `omero_es.index.QUERY_PLATES`
+QUERY_PLATE_DOCUMENTS = """SELECT DISTINCT s_p_link.child.id
+FROM ScreenPlateLink AS s_p_link
+WHERE s_p_link.child.id IN (:ids)
+"""
+
+# An Image has a document for each Dataset, in a Project, it is linked to
+# as long as it has Pixels and Channels; see
+# `omero_es.loader.QUERY_PROJECT_IMAGES`
+QUERY_IMAGE_DOCUMENTS = """SELECT DISTINCT image.id, p_d_link.parent.id,
+dataset.id
+FROM Image AS image
+JOIN image.pixels AS pixels
+JOIN pixels.channels AS channel
+JOIN image.datasetLinks AS i_d_link
+JOIN i_d_link.parent AS dataset
+JOIN dataset.projectLinks AS p_d_link
+WHERE image.id IN (:ids)
+"""
+
+QUERY_WELL_DOCUMENTS = """SELECT DISTINCT well.id, plate.id
+FROM Well AS well
+JOIN well.plate AS plate
+JOIN plate.screenLinks AS s_p_link
+WHERE well.id IN (:ids)
+"""
+
+# Fully encoded documents have no `Annotations` rather than an empty list
+REMOVE_ANNOTATIONS = {
+    'script': {
+        'lang': 'painless',
+        'inline': "ctx._source.remove('Annotations')"
+    }
+}
+
+
+def container_document(row):
+    return row[0], str(row[0]), None
+
+
+def image_document(row):
+    image_id, project_id, dataset_id = row
+    return image_id, '%d_%d' % (dataset_id, image_id), project_id
+
+
+def well_document(row):
+    return row[0], str(row[0]), row[1]
+
+
+# Document type, query finding the documents of a batch of objects and
+# function returning the `(object id, document id, parent)` of each of
+# its rows, by type.  Document ids are strings, as in bulk API responses
+DOCUMENTS = {
+    'Project': ('project', QUERY_PROJECT_DOCUMENTS, container_document),
+    'Image': ('image', QUERY_IMAGE_DOCUMENTS, image_document),
+    'Plate': ('plate', QUERY_PLATE_DOCUMENTS, container_document),
+    'Well': ('well', QUERY_WELL_DOCUMENTS, well_document),
+}
+
+
+def encode_annotations(query_service, kind, ids):
+    """
+    Returns the encoded annotations of the objects of `kind` with `ids`,
+    in link order, by id.  Each distinct annotation is loaded and encoded
+    once, and not at all while it remains in the annotation caches.
+    """
+    rows = resolve(
+        query_service, QUERY_ANNOTATION_LINK_KEYS % (kind + 'AnnotationLink'),
+        ids
+    )
+    annotations = NarrowLoader().load_annotations(
+        query_service, set([(r[2], r[3]) for r in rows])
+    )
+    encoded = dict([(v, list()) for v in ids])
+    for link_id, parent_id, annotation_id, _, _ in rows:
+        annotation = annotations.get(annotation_id)
+        if annotation is None:
+            # Deleted since the links were found
+            continue
+        encoded[parent_id].append(
+            get_encoder(annotation.__class__).encode(annotation)
+        )
+    return encoded
+
+
+def partial_document(annotations):
+    """
+    Returns the partial document, or script, replacing the `Annotations`
+    of a document with the encoded `annotations`.
+    """
+    if len(annotations) == 0:
+        return REMOVE_ANNOTATIONS
+    return {'doc': {'Annotations': annotations}}
+
+
+def update_annotations(writer, index, client, kind, ids, fallback,
+                       settings):
+    """
+    Replaces the `Annotations` of the documents of the objects of `kind`
+    with `ids` with partial document updates.  Only the annotations are
+    loaded and encoded, rather than the objects' whole graphs.  Documents
+    that do not exist yet, as their objects have not been indexed, are
+    indexed in full with `fallback`, the indexing function of the objects
+    or of a batch of them in the same parent.  Returns the number of
+    documents updated or indexed.
+    """
+    query_service = client.getSession().getQueryService()
+    doc_type, query, document = DOCUMENTS[kind]
+    t0 = time.time()
+    documents = [document(r) for r in resolve(query_service, query, ids)]
+    encoded = encode_annotations(
+        query_service, kind, set([v[0] for v in documents])
+    )
+    # Serialized once per object; an Image can have several documents
+    sources = dict([
+        (k, serializer.dumps(partial_document(v)))
+        for k, v in encoded.iteritems()
+    ])
+    log.info(
+        'Encoded the annotations of %d %ss, %d documents (%dms)' % (
+            len(sources), kind, len(documents), (time.time() - t0) * 1000
+        )
+    )
+    actions = [
+        serializer.update_action(
+            index, doc_type, _id, parent, sources[object_id]
+        ) for object_id, _id, parent in documents
+    ]
+    if writer is None:
+        for action in actions:
+            print action,
+        return len(actions)
+    # Waited for separately to find the documents of these updates that
+    # do not exist
+    updates = writer.sink.writer(writer.name)
+    count = updates.send(actions)
+    updates.wait()
+    if len(updates.missing) == 0:
+        return count
+    missing_ids = set([v.items()[0][1]['_id'] for v in updates.missing])
+    tasks = dict()
+    for object_id, _id, parent in documents:
+        if _id in missing_ids:
+            tasks.setdefault(parent, set()).add(object_id)
+    log.info(
+        'Indexing %d %ss whose documents do not exist yet' % (
+            sum([len(v) for v in tasks.values()]), kind
+        )
+    )
+    count -= len(updates.missing)
+    for parent, object_ids in tasks.iteritems():
+        if parent is None:
+            for object_id in object_ids:
+                count += fallback(writer, index, client, object_id, settings)
+        else:
+            count += fallback(
+                writer, index, client, (parent, sorted(object_ids)),
+                settings
+            )
+    return count
+
+
+def annotation_indexer(kind, fallback):
+    """
+    Returns the indexing function of the tasks that update the annotations
+    of the documents of a batch of objects of `kind`, indexing those that
+    do not exist yet with `fallback`; see `omero_es.index.INDEXERS`.
+    """
+    def index_annotations(writer, index, client, ids, settings):
+        log.info('Processing the annotations of %d %ss' % (len(ids), kind))
+        return update_annotations(
+            writer, index, client, kind, ids, fallback, settings
+        )
+    return index_annotations
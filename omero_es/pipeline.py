@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import logging
+import threading
+import time
+
+from Queue import Queue, Empty, Full
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Marks the end of the items flowing through a queue
+END = object()
+
+# Seconds between queue depth samples
+SAMPLE_INTERVAL = 0.5
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class Stage(object):
+
+    def __init__(self, name, function, threads):
+        self.name = name
+        self.function = function
+        self.threads = threads
+        self.busy = 0.0
+        self.items = 0
+        self.lock = threading.Lock()
+
+
+class Pipeline(object):
+    """
+    Streams items from a source iterable through a series of stages to a
+    sink.  The source and each stage run in their own threads and are
+    connected by bounded queues so that, for example, OMERO queries,
+    encoding and Elasticsearch requests overlap while memory use stays
+    bounded.  The depth of each queue is sampled while the pipeline runs;
+    a queue that is always full sits in front of the bottleneck.
+    """
+
+    def __init__(self, name, maxsize=100):
+        self.name = name
+        self.maxsize = maxsize
+        self.stages = list()
+        self.queues = list()
+        self.error = None
+        self.aborted = threading.Event()
+        self.samples = list()
+
+    def stage(self, name, function, threads=1):
+        """
+        Adds a stage; `function` is called with each item and returns an
+        iterable of zero or more items for the next stage.
+        """
+        self.stages.append(Stage(name, function, threads))
+        return self
+
+    def put(self, queue, item):
+        while True:
+            if self.aborted.is_set():
+                raise PipelineAborted()
+            try:
+                queue.put(item, True, SAMPLE_INTERVAL)
+                return
+            except Full:
+                pass
+
+    def get(self, queue):
+        while True:
+            if self.aborted.is_set():
+                raise PipelineAborted()
+            try:
+                return queue.get(True, SAMPLE_INTERVAL)
+            except Empty:
+                pass
+
+    def abort(self, e):
+        if self.error is None:
+            self.error = e
+        self.aborted.set()
+
+    def run_source(self, source, queue):
+        try:
+            for item in source:
+                self.put(queue, item)
+            self.put(queue, END)
+        except PipelineAborted:
+            pass
+        except Exception, e:
+            log.error('%s source failed' % self.name, exc_info=True)
+            self.abort(e)
+
+    def run_stage(self, stage, remaining, queue_in, queue_out):
+        try:
+            while True:
+                item = self.get(queue_in)
+                if item is END:
+                    # Let sibling threads of this stage see the end too
+                    self.put(queue_in, END)
+                    break
+                t0 = time.time()
+                items = list(stage.function(item))
+                with stage.lock:
+                    stage.busy += time.time() - t0
+                    stage.items += 1
+                for item in items:
+                    self.put(queue_out, item)
+            with stage.lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.put(queue_out, END)
+        except PipelineAborted:
+            pass
+        except Exception, e:
+            log.error(
+                '%s stage %s failed' % (self.name, stage.name),
+                exc_info=True
+            )
+            self.abort(e)
+
+    def drain(self, queue):
+        while True:
+            item = self.get(queue)
+            if item is END:
+                return
+            yield item
+
+    def sample(self):
+        while not self.aborted.wait(SAMPLE_INTERVAL):
+            depths = [v.qsize() for v in self.queues]
+            self.samples.append(depths)
+            log.debug('%s queue depths: %r' % (self.name, depths))
+
+    def run(self, source, sink):
+        """
+        Runs the pipeline, feeding it from `source`, and returns the result
+        of calling `sink` with an iterator over the items leaving the last
+        stage.  The sink runs in the calling thread.
+        """
+        self.queues = [
+            Queue(self.maxsize) for v in range(len(self.stages) + 1)
+        ]
+        threads = [threading.Thread(
+            target=self.run_source, args=(source, self.queues[0])
+        )]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.threads]
+            for j in range(stage.threads):
+                threads.append(threading.Thread(
+                    target=self.run_stage,
+                    args=(stage, remaining, self.queues[i],
+                          self.queues[i + 1])
+                ))
+        threads.append(threading.Thread(target=self.sample))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        t0 = time.time()
+        try:
+            result = sink(self.drain(self.queues[-1]))
+        except PipelineAborted:
+            result = None
+        except Exception, e:
+            self.abort(e)
+        finally:
+            # Stops the sampler and any stage still running
+            self.aborted.set()
+        for thread in threads:
+            thread.join()
+        self.report(time.time() - t0)
+        if self.error is not None:
+            raise self.error
+        return result
+
+    def report(self, elapsed):
+        names = [v.name for v in self.stages] + ['sink']
+        for i, name in enumerate(names):
+            depths = [v[i] for v in self.samples] or [0]
+            log.info(
+                '%s queue to %s depth mean %.1f max %d of %d' % (
+                    self.name, name, float(sum(depths)) / len(depths),
+                    max(depths), self.maxsize
+                )
+            )
+        for stage in self.stages:
+            log.info(
+                '%s stage %s processed %d items, busy %dms of %dms' % (
+                    self.name, stage.name, stage.items, stage.busy * 1000,
+                    elapsed * 1000
+                )
+            )
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import heapq
+import logging
+import time
+
+from omero.sys import ParametersI
+
+from .document import QUERY_IMAGE_COUNTS
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Maximum number of ids in a single `IN (:ids)` clause
+BATCH_SIZE = 1000
+
+QUERY_PROJECT_IMAGE_COUNTS = """SELECT project.id, count(d_i_link.id)
+FROM Project AS project
+JOIN project.datasetLinks AS p_d_link
+JOIN p_d_link.child AS dataset
+JOIN dataset.imageLinks as d_i_link
+WHERE project.id IN (:ids)
+GROUP BY project.id
+"""
+
+QUERY_SCREEN_WELL_COUNTS = """SELECT screen.id, count(well.id)
+FROM Screen AS screen
+JOIN screen.plateLinks AS s_p_link
+JOIN s_p_link.child AS plate
+JOIN plate.wells AS well
+WHERE screen.id IN (:ids)
+GROUP BY screen.id
+"""
+
+QUERY_SCREEN_PLATE_COUNTS = """SELECT s_p_link.parent.id, count(s_p_link.id)
+FROM ScreenPlateLink AS s_p_link
+WHERE s_p_link.parent.id IN (:ids)
+GROUP BY s_p_link.parent.id
+"""
+
+# Plates without Wells still have a document, written by their parent task
+QUERY_PLATE_WELL_COUNTS = """SELECT plate.id, count(well.id)
+FROM Plate AS plate
+JOIN plate.screenLinks AS s_p_link
+LEFT OUTER JOIN plate.wells AS well
+WHERE s_p_link.parent.id = :id
+GROUP BY plate.id
+"""
+
+QUERY_DATASET_IMAGE_IDS = """SELECT d_i_link.child.id
+FROM DatasetImageLink AS d_i_link
+WHERE d_i_link.parent.id = :id
+ORDER BY d_i_link.child.id
+"""
+
+QUERY_PLATE_WELL_IDS = """SELECT well.id FROM Well AS well
+WHERE well.plate.id = :id
+ORDER BY well.id
+"""
+
+# Count queries, whose counts are summed, used to estimate the work for
+# each container type
+COUNT_QUERIES = {
+    'Project': (QUERY_PROJECT_IMAGE_COUNTS,),
+    'Screen': (QUERY_SCREEN_WELL_COUNTS, QUERY_SCREEN_PLATE_COUNTS),
+}
+
+# Number of documents of the container itself, by container type
+CONTAINER_DOCUMENTS = {
+    'Project': 1,
+    'Screen': 0,
+}
+
+
+def count_children(query_service, kind, ids):
+    counts = dict()
+    for i in range(0, len(ids), BATCH_SIZE):
+        params = ParametersI()
+        params.addIds(ids[i:i + BATCH_SIZE])
+        for query in COUNT_QUERIES[kind]:
+            for r in query_service.projection(
+                    query, params, {'omero.group': '-1'}):
+                counts[r[0].val] = counts.get(r[0].val, 0) + r[1].val
+    return counts
+
+
+def estimate_work(client, tasks):
+    """
+    Estimates the work for each `(kind, id)` task as the number of
+    documents it will produce; one for each Image of a Project (per
+    Dataset it is linked to) plus the Project itself, or one for each
+    Plate and Well of a Screen.
+    """
+    session = client.getSession()
+    query_service = session.getQueryService()
+    t0 = time.time()
+    estimates = dict()
+    for kind in COUNT_QUERIES:
+        ids = [_id for _kind, _id in tasks if _kind == kind]
+        counts = count_children(query_service, kind, ids)
+        for _id in ids:
+            estimates[(kind, _id)] = \
+                counts.get(_id, 0) + CONTAINER_DOCUMENTS[kind]
+    log.info(
+        'Estimated %d documents for %d containers (%dms)' % (
+            sum(estimates.values()), len(estimates),
+            (time.time() - t0) * 1000
+        )
+    )
+    return estimates
+
+
+def find_counts(query_service, query, _id):
+    params = ParametersI().addId(_id)
+    return sorted([
+        (r[0].val, r[1].val) for r in query_service.projection(
+            query, params, {'omero.group': '-1'}
+        )
+    ])
+
+
+def find_id_ranges(query_service, query, _id, shard_size):
+    """
+    Returns `(first, last, count)` tuples covering the ids returned by
+    `query` in consecutive ranges of at most `shard_size` ids.
+    """
+    params = ParametersI().addId(_id)
+    ids = [r[0].val for r in query_service.projection(
+        query, params, {'omero.group': '-1'}
+    )]
+    return [
+        (ids[i], ids[i:i + shard_size][-1], len(ids[i:i + shard_size]))
+        for i in range(0, len(ids), shard_size)
+    ]
+
+
+def split_project(query_service, project_id, shard_size):
+    """
+    Shards a Project into groups of Datasets of up to `shard_size`
+    Images.  Datasets larger than that are sharded by Image id range.
+    """
+    shards = dict()
+    dataset_ids = list()
+    size = 0
+    for dataset_id, count in find_counts(
+            query_service, QUERY_IMAGE_COUNTS, project_id):
+        if count > shard_size:
+            for first, last, count in find_id_ranges(
+                    query_service, QUERY_DATASET_IMAGE_IDS, dataset_id,
+                    shard_size):
+                shard = (project_id, (dataset_id,), first, last)
+                shards[('ProjectShard', shard)] = count
+            continue
+        if size + count > shard_size:
+            shard = (project_id, tuple(dataset_ids), None, None)
+            shards[('ProjectShard', shard)] = size
+            dataset_ids = list()
+            size = 0
+        dataset_ids.append(dataset_id)
+        size += count
+    if len(dataset_ids) > 0:
+        shard = (project_id, tuple(dataset_ids), None, None)
+        shards[('ProjectShard', shard)] = size
+    return dict([(v, ('ProjectParent', project_id)) for v in shards]), shards
+
+
+def split_screen(query_service, screen_id, shard_size):
+    """
+    Shards a Screen by Plate.  Plates larger than `shard_size` Wells are
+    sharded by Well id range.
+    """
+    shards = dict()
+    parents = dict()
+    for plate_id, count in find_counts(
+            query_service, QUERY_PLATE_WELL_COUNTS, screen_id):
+        ranges = [(None, None, count)]
+        if count > shard_size:
+            ranges = find_id_ranges(
+                query_service, QUERY_PLATE_WELL_IDS, plate_id, shard_size
+            )
+        for first, last, count in ranges:
+            shard = ('PlateShard', (plate_id, first, last))
+            shards[shard] = count
+            parents[shard] = ('PlateParent', plate_id)
+    return parents, shards
+
+
+# Function that shards a container, by container type
+SPLITTERS = {
+    'Project': split_project,
+    'Screen': split_screen,
+}
+
+
+def split(client, estimates, shard_size):
+    """
+    Replaces each task estimated to produce more than `shard_size`
+    documents with shard tasks that can be indexed concurrently.  Returns
+    the new estimates and a dictionary of shard task to the parent task
+    which must run once all of its shards have completed.
+    """
+    session = client.getSession()
+    query_service = session.getQueryService()
+    t0 = time.time()
+    parents = dict()
+    split_estimates = dict()
+    for task, estimate in estimates.iteritems():
+        kind, _id = task
+        if estimate <= shard_size or kind not in SPLITTERS:
+            split_estimates[task] = estimate
+            continue
+        _parents, shards = SPLITTERS[kind](query_service, _id, shard_size)
+        if len(shards) < 1:
+            split_estimates[task] = estimate
+            continue
+        log.info('Split %s:%d into %d shards' % (kind, _id, len(shards)))
+        parents.update(_parents)
+        split_estimates.update(shards)
+    log.info(
+        'Split into %d tasks (%dms)' % (
+            len(split_estimates), (time.time() - t0) * 1000
+        )
+    )
+    return split_estimates, parents
+
+
+def schedule(estimates, workers):
+    """
+    Orders tasks longest first.  Handing them out in that order to
+    whichever worker becomes free next is the LPT (longest processing
+    time) heuristic; the returned per-worker loads are the bin packing
+    that results if the estimates are accurate.
+    """
+    tasks = sorted(estimates, key=lambda v: estimates[v], reverse=True)
+    loads = [0] * workers
+    for task in tasks:
+        load = heapq.heappop(loads)
+        heapq.heappush(loads, load + estimates[task])
+    return tasks, sorted(loads, reverse=True)
+
+
+def report(estimates, results, loads, elapsed):
+    """
+    Logs the predicted versus actual cost of each container.  Predicted
+    times are derived from the estimates using the mean time per document
+    observed during the run.  Both are counted in documents; the parent
+    tasks of shards, which are not estimated, index one.
+    """
+    units = sum([estimates.get((v[0], v[1]), 1) for v in results])
+    busy = sum([v[3] for v in results])
+    if units < 1 or busy <= 0:
+        return
+    rate = busy / units
+    log.info(
+        'Predicted %d documents, actual %d (%.2fms per document)' % (
+            units, sum([v[2] for v in results]), rate * 1000
+        )
+    )
+    log.info(
+        'Predicted makespan %dms, actual %dms' % (
+            loads[0] * rate * 1000, elapsed * 1000
+        )
+    )
+    # Worst predictions first
+    results = sorted(results, key=lambda v: abs(
+        v[3] - estimates.get((v[0], v[1]), 1) * rate
+    ), reverse=True)
+    for i, (kind, _id, count, _elapsed, error, skipped) in enumerate(
+            results):
+        estimate = estimates.get((kind, _id), 1)
+        level = logging.INFO if i < 10 else logging.DEBUG
+        log.log(
+            level, '%s:%s predicted %d documents (%dms) actual %d (%dms)' % (
+                kind, _id, estimate, estimate * rate * 1000, count,
+                _elapsed * 1000
+            )
+        )
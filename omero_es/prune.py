@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import logging
+
+from omero.model import Annotation, Channel, ChannelAnnotationLink, \
+    Dataset, DatasetAnnotationLink, DetailsI, Event, EventType, \
+    Experimenter, ExperimenterGroup, GroupExperimenterMap, Image, \
+    ImageAnnotationLink, LogicalChannel, Pixels, PlateAnnotationLink, \
+    Project, ProjectAnnotationLink, ProjectDatasetLink, Plate, Screen, \
+    ScreenAnnotationLink, ScreenPlateLink, Well, WellAnnotationLink, \
+    WellSample
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# How an edge is followed; to the object held by an attribute, to each
+# object of a collection or to the first object of a collection
+ONE, MANY, FIRST = range(3)
+
+# Follows an object's details to its owner, group and events
+DETAILS = ('_details', ONE)
+
+ANNOTATIONS = ('_annotationLinksSeq', MANY)
+
+# Links, group memberships and details are passed through without being
+# unloaded themselves
+LINK_TO_CHILD = (False, [('_child', ONE)])
+
+LINK_TO_PARENT = (False, [('_parent', ONE)])
+
+# Rules common to every document; the details sub-objects of anything
+# reached are unloaded as are any annotations' details
+COMMON_RULES = {
+    DetailsI: (False, [
+        ('_owner', ONE), ('_group', ONE), ('_creationEvent', ONE),
+        ('_updateEvent', ONE)
+    ]),
+    Experimenter: (True, []),
+    ExperimenterGroup: (True, []),
+    Event: (True, [('_type', ONE)]),
+    EventType: (True, []),
+    Annotation: (True, []),
+    ChannelAnnotationLink: LINK_TO_CHILD,
+    DatasetAnnotationLink: LINK_TO_CHILD,
+    ImageAnnotationLink: LINK_TO_CHILD,
+    PlateAnnotationLink: LINK_TO_CHILD,
+    ProjectAnnotationLink: LINK_TO_CHILD,
+    ScreenAnnotationLink: LINK_TO_CHILD,
+    WellAnnotationLink: LINK_TO_CHILD,
+}
+
+IMAGE_RULES = dict(COMMON_RULES)
+IMAGE_RULES.update({
+    Image: (True, [DETAILS, ('_pixelsSeq', FIRST), ANNOTATIONS]),
+    Pixels: (True, [('_channelsSeq', MANY)]),
+    Channel: (True, [('_logicalChannel', ONE), ANNOTATIONS]),
+    # Only walked for its update event; its details are kept
+    LogicalChannel: (False, []),
+})
+
+WELL_RULES = dict(IMAGE_RULES)
+WELL_RULES.update({
+    Well: (True, [DETAILS, ('_wellSamplesSeq', MANY), ANNOTATIONS]),
+    WellSample: (True, [('_image', ONE)]),
+})
+
+# Container documents also unload the details of each group member
+CONTAINER_RULES = dict(COMMON_RULES)
+CONTAINER_RULES.update({
+    ExperimenterGroup: (True, [('_groupExperimenterMapSeq', MANY)]),
+    GroupExperimenterMap: LINK_TO_CHILD,
+})
+
+PROJECT_RULES = dict(CONTAINER_RULES)
+PROJECT_RULES.update({
+    Project: (True, [DETAILS, ('_datasetLinksSeq', MANY), ANNOTATIONS]),
+    ProjectDatasetLink: LINK_TO_CHILD,
+    Dataset: (True, [ANNOTATIONS]),
+})
+
+PLATE_RULES = dict(CONTAINER_RULES)
+PLATE_RULES.update({
+    Plate: (True, [DETAILS, ('_screenLinksSeq', MANY), ANNOTATIONS]),
+    # Walked from the Plate, its child, to the Screen
+    ScreenPlateLink: LINK_TO_PARENT,
+    Screen: (True, [ANNOTATIONS]),
+})
+
+
+def update_event_id(obj):
+    """
+    Returns the id of the Event that last updated `obj`, or `None` if it
+    is not known.
+    """
+    details = getattr(obj, '_details', None)
+    event = getattr(details, '_updateEvent', None)
+    if event is not None and event._id is not None:
+        return event._id.val
+    # Annotations loaded by `omero_es.loader.NarrowLoader` have had their
+    # details unloaded but keep the update event in their cache key
+    key = getattr(obj, '_cache_key', None)
+    if key is not None:
+        return key[1]
+    return None
+
+
+class Pruner(object):
+    """
+    Unloads the parts of an object graph that are not to be indexed before
+    it is encoded.  The graph is walked once from the root, following only
+    the edges given by the rules for each type, and each object is visited
+    at most once.  A rule is `(unload, edges)`; whether the object's own
+    details are unloaded and the `(attribute, ONE|MANY|FIRST)` edges to
+    follow.  Rules are looked up by the most specific class.  The root
+    always keeps its details.  Collections are read directly rather than
+    copied.  Returns the id of the latest Event that updated any of the
+    objects walked; see `update_event_id()`.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        # Rule by concrete class, resolved on first use
+        self.resolved = dict()
+
+    def rule(self, t):
+        try:
+            return self.resolved[t]
+        except KeyError:
+            pass
+        rule = None
+        for base in t.__mro__:
+            if base in self.rules:
+                rule = self.rules[base]
+                break
+        self.resolved[t] = rule
+        return rule
+
+    def prune(self, root):
+        visited = set()
+        stack = [(root, False)]
+        version = None
+        while len(stack) > 0:
+            obj, unload = stack.pop()
+            if obj is None or id(obj) in visited:
+                continue
+            visited.add(id(obj))
+            if not getattr(obj, '_loaded', True):
+                continue
+            # Read before its details are unloaded
+            version = max(version, update_event_id(obj))
+            rule = self.rule(obj.__class__)
+            if rule is None:
+                continue
+            _unload, edges = rule
+            if unload and _unload:
+                obj.unloadDetails()
+            for attribute, kind in edges:
+                if kind == ONE:
+                    stack.append((getattr(obj, attribute), True))
+                    continue
+                # Collections are `_<name>Seq` with a `_<name>Loaded` flag
+                seq = getattr(obj, attribute)
+                if seq is None or \
+                        not getattr(obj, attribute[:-3] + 'Loaded'):
+                    continue
+                if kind == FIRST:
+                    seq = seq[:1]
+                stack.extend((v, True) for v in seq)
+        return version
+
+
+IMAGE = Pruner(IMAGE_RULES)
+
+WELL = Pruner(WELL_RULES)
+
+PROJECT = Pruner(PROJECT_RULES)
+
+PLATE = Pruner(PLATE_RULES)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from getopt import getopt, GetoptError
+
+from elasticsearch import NotFoundError
+
+from .settings import SETTINGS, create_elasticsearch
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Document mapping files, by document type
+MAPPINGS = {
+    'project': 'mapping_project.json',
+    'image': 'mapping_image.json',
+    'plate': 'mapping_plate.json',
+    'well': 'mapping_well.json',
+}
+
+# Index settings while documents are bulk loaded; nothing is refreshed or
+# replicated and the translog is only synced periodically
+LOAD_SETTINGS = {
+    'refresh_interval': '-1',
+    'number_of_replicas': 0,
+    'translog.durability': 'async',
+}
+
+# Index settings once loaded, other than the number of replicas
+SEARCH_SETTINGS = {
+    'refresh_interval': '1s',
+    'translog.durability': 'request',
+}
+
+# Seconds to wait for a force merge, or for replicas to be allocated
+TIMEOUT = 3600
+
+
+def usage(error=None):
+    """
+    Prints usage so that we don't have to. :)
+    """
+    cmd = sys.argv[0]
+    if error:
+        print error
+    print """Usage:
+  %(cmd)s <options> -- <indexing options>
+
+Rebuilds the search index without downtime.  A new, timestamped, index is
+created from the document mappings and all of OMERO is indexed into it
+with 'python -m omero_es.index -a' and the <indexing options>.  The alias
+searched is then switched to the new index and the indexes it previously
+pointed to deleted.
+
+Options:
+  -h                  display this help and exit
+  --url               Elasticsearch base URL
+  --debug             turn debugging on
+  --alias             alias searched; ELASTICSEARCH_INDEX of the search
+                      server (default: 'omero')
+  --mappings <d>      directory of the mapping_*.json document mappings
+                      (default: '.')
+  --shards <n>        number of primary shards of the new index
+                      (default: Elasticsearch's)
+  --replicas <n>      number of replicas of the new index once loaded
+                      (default: 1)
+  --max-segments <n>  number of segments per shard to force merge the new
+                      index down to once loaded (default: 1)
+  --keep-old          do not delete the indexes previously aliased
+
+Examples:
+    %(cmd)s --url http://localhost:9200 -- \\
+        -s localhost -p 4064 -u root -w secret --workers 8
+    %(cmd)s --url http://localhost:9200 --replicas 0 -- \\
+        -s localhost -p 4064 -u root -w secret
+
+Report bugs to support@glencoesoftware.com""" % {'cmd': cmd}
+    sys.exit(2)
+
+
+def read_mappings(path):
+    mappings = dict()
+    for doc_type, name in MAPPINGS.iteritems():
+        with open(os.path.join(path, name)) as f:
+            mappings[doc_type] = json.load(f)
+    return mappings
+
+
+def create_index(es, alias, mappings, shards=None):
+    """
+    Creates a new, timestamped, index for `alias` with all the document
+    mappings and bulk load settings.  Creating the index and mappings in
+    a single request sidesteps the ordering of child and parent mappings.
+    """
+    name = '%s-%s' % (alias, time.strftime('%Y%m%d%H%M%S'))
+    settings = dict(LOAD_SETTINGS)
+    if shards is not None:
+        settings['number_of_shards'] = shards
+    es.indices.create(index=name, body={
+        'settings': {'index': settings},
+        'mappings': mappings,
+    })
+    log.info('Created index %s with bulk load settings' % name)
+    return name
+
+
+def finish_index(es, name, replicas, max_segments):
+    """
+    Restores the search settings of a loaded index, force merges it and
+    waits for its replicas to be allocated.
+    """
+    t0 = time.time()
+    es.indices.put_settings(index=name, body={'index': SEARCH_SETTINGS})
+    es.indices.refresh(index=name)
+    es.indices.forcemerge(
+        index=name, max_num_segments=max_segments, request_timeout=TIMEOUT
+    )
+    log.info(
+        'Force merged %s to %d segments per shard (%dms)' % (
+            name, max_segments, (time.time() - t0) * 1000
+        )
+    )
+    t0 = time.time()
+    es.indices.put_settings(
+        index=name, body={'index': {'number_of_replicas': replicas}}
+    )
+    health = es.cluster.health(
+        index=name, wait_for_status='green', timeout='%ds' % TIMEOUT,
+        request_timeout=TIMEOUT + 60
+    )
+    if health['timed_out']:
+        raise Exception(
+            'Timed out waiting for %d replicas of %s, status %s' % (
+                replicas, name, health['status']
+            )
+        )
+    log.info(
+        'Allocated %d replicas of %s (%dms)' % (
+            replicas, name, (time.time() - t0) * 1000
+        )
+    )
+
+
+def aliased(es, alias):
+    """
+    Returns the indexes `alias` points to.
+    """
+    try:
+        return es.indices.get_alias(name=alias).keys()
+    except NotFoundError:
+        return list()
+
+
+def switch_alias(es, alias, name):
+    """
+    Points `alias` to the index `name` alone and returns the indexes it
+    pointed to before.  The switch is atomic unless `alias` is still a
+    concrete index, from before rebuilds, which has to be deleted first.
+    """
+    old = aliased(es, alias)
+    if len(old) < 1 and es.indices.exists(index=alias):
+        log.warn('Deleting index %s to replace it with an alias' % alias)
+        es.indices.delete(index=alias)
+    actions = [{'remove': {'index': v, 'alias': alias}} for v in old]
+    actions.append({'add': {'index': name, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    log.info('Switched alias %s from %r to %s' % (alias, old, name))
+    return old
+
+
+def rebuild(es, url, alias, mappings, arguments, shards, replicas,
+            max_segments, keep_old):
+    """
+    Rebuilds the index behind `alias`; see `usage()`.  Returns the name of
+    the new index.  If indexing fails the alias is left untouched, and the
+    new index in place for inspection.
+    """
+    name = create_index(es, alias, mappings, shards)
+    t0 = time.time()
+    status = subprocess.call([
+        sys.executable, '-m', 'omero_es.index', '-a', '--url', url,
+        '--index', name
+    ] + arguments)
+    if status != 0:
+        raise Exception(
+            'Indexing into %s failed with status %d' % (name, status)
+        )
+    log.info('Indexed into %s (%dms)' % (name, (time.time() - t0) * 1000))
+    finish_index(es, name, replicas, max_segments)
+    old = switch_alias(es, alias, name)
+    if not keep_old:
+        for index in old:
+            es.indices.delete(index=index)
+            log.info('Deleted index %s' % index)
+    return name
+
+
+def main():
+    try:
+        options, args = getopt(
+            sys.argv[1:], "h", [
+                "debug", "url=", "alias=", "mappings=", "shards=",
+                "replicas=", "max-segments=", "keep-old"
+            ]
+        )
+    except GetoptError, (msg, _opt):
+        usage(msg)
+
+    level = logging.INFO
+    url = None
+    alias = 'omero'
+    path = '.'
+    shards = None
+    replicas = 1
+    max_segments = 1
+    keep_old = False
+    for option, argument in options:
+        if option == "-h":
+            usage()
+        if option == "--debug":
+            level = logging.DEBUG
+        if option == "--url":
+            url = argument
+        if option == "--alias":
+            alias = argument
+        if option == "--mappings":
+            path = argument
+        if option == "--shards":
+            shards = int(argument)
+        if option == "--replicas":
+            replicas = int(argument)
+        if option == "--max-segments":
+            max_segments = int(argument)
+        if option == "--keep-old":
+            keep_old = True
+
+    if url is None:
+        usage('Elasticsearch URL required!')
+    for name in MAPPINGS.values():
+        if not os.path.exists(os.path.join(path, name)):
+            usage('No document mapping: %s' % os.path.join(path, name))
+
+    format = "%(asctime)s %(levelname)-7s [%(name)16s] %(message)s"
+    logging.basicConfig(level=level, format=format)
+
+    es = create_elasticsearch(url, SETTINGS)
+    rebuild(
+        es, url, alias, read_mappings(path), args, shards, replicas,
+        max_segments, keep_old
+    )
+
+
+if __name__ == '__main__':
+    main()
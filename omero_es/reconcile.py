@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import heapq
+import logging
+import sys
+import tempfile
+import time
+
+from array import array
+from getopt import getopt, GetoptError
+
+import omero
+import omero.clients
+assert omero.clients
+
+from elasticsearch.helpers import scan
+from omero.rtypes import rlong
+from omero.sys import ParametersI
+
+from . import serializer, transport
+from .index import configure
+from .settings import SETTINGS, create_elasticsearch, create_sink
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Number of keys per OMERO query and Elasticsearch scroll page
+PAGE_SIZE = 10000
+
+# Number of keys sorted in memory at once; sorted runs are spilled to disk
+RUN_SIZE = 1000000
+
+# Ids of the objects, a page after `:id` at a time; only their primary
+# key is read
+QUERY_IDS = """SELECT obj.id FROM %s AS obj
+WHERE obj.id > :id
+ORDER BY obj.id
+"""
+
+# Project, Dataset and Image ids of the Images linked to Datasets in
+# Projects by the DatasetImageLinks of an id range, the parents and ids of
+# their documents; in no particular order
+QUERY_IMAGE_KEYS = """SELECT p_d_link.parent.id, i_d_link.parent.id,
+i_d_link.child.id
+FROM DatasetImageLink AS i_d_link
+JOIN i_d_link.parent AS dataset
+JOIN dataset.projectLinks AS p_d_link
+WHERE i_d_link.id >= :first AND i_d_link.id <= :last
+"""
+
+# Plate and Well ids of the Wells of an id range, the parents and ids of
+# their documents; in no particular order
+QUERY_WELL_KEYS = """SELECT well.plate.id, well.id FROM Well AS well
+WHERE well.id >= :first AND well.id <= :last
+"""
+
+
+def usage(error=None):
+    """
+    Prints usage so that we don't have to. :)
+    """
+    cmd = sys.argv[0]
+    if error:
+        print error
+    print """Usage:
+  %(cmd)s <options>
+
+Deletes the Elasticsearch documents of Projects, Images, Plates and Wells
+that no longer exist in OMERO, or whose parent they are no longer in
+
+Options:
+  -s                  server hostname
+  -p                  server port
+  -u                  username
+  -w                  password
+  -h                  display this help and exit
+  --url               Elasticsearch base URL to reconcile
+  --debug             turn debugging on
+  --index             index to reconcile (default: 'omero')
+  --type <s>          only reconcile documents of this type; one of
+                      'project', 'image', 'plate' or 'well' (default: all)
+  --dry-run           only report the orphaned documents
+  --fingerprints <f>  fingerprint store of the runs indexing into the
+                      index; the fingerprints of the documents deleted
+                      are forgotten so that they are sent again if their
+                      objects come back
+
+Examples:
+    %(cmd)s -s localhost -p 4064 -u root -w secret \\
+        --url http://localhost:9200
+    %(cmd)s -s localhost -p 4064 -u root -w secret \\
+        --url http://localhost:9200 --type image --dry-run
+    %(cmd)s -s localhost -p 4064 -u root -w secret \\
+        --url http://localhost:9200 --fingerprints fingerprints.db
+
+Report bugs to support@glencoesoftware.com""" % {'cmd': cmd}
+    sys.exit(2)
+
+
+def parse_container(hit):
+    return (long(hit['_id']),)
+
+
+def format_container(key):
+    return str(key[0]), None
+
+
+def parse_image(hit):
+    dataset_id, image_id = hit['_id'].split('_')
+    return (long(hit['_parent']), long(dataset_id), long(image_id))
+
+
+def format_image(key):
+    return '%d_%d' % key[1:], str(key[0])
+
+
+def parse_well(hit):
+    return (long(hit['_parent']), long(hit['_id']))
+
+
+def format_well(key):
+    return str(key[1]), str(key[0])
+
+
+# Type of the objects paged through by id, query returning the keys of
+# the expected documents of a page of them, or `None` if their ids are the
+# keys, the number of ids in a key and functions converting Elasticsearch
+# hits to keys and keys to `(_id, _parent)`, by document type.  The keys of
+# child documents start with their parent so that a document left under a
+# parent that its object is no longer in is an orphan too.
+TYPES = {
+    'project': ('Project', None, 1, parse_container, format_container),
+    'image': (
+        'DatasetImageLink', QUERY_IMAGE_KEYS, 3, parse_image, format_image
+    ),
+    'plate': ('Plate', None, 1, parse_container, format_container),
+    'well': ('Well', QUERY_WELL_KEYS, 2, parse_well, format_well),
+}
+
+
+def find_id_pages(query_service, kind):
+    """
+    Yields the ids of all the objects of `kind` in pages of at most
+    `PAGE_SIZE` ids, in order.  Each page is a range scan of the primary
+    key following the last id of the previous one.
+    """
+    params = ParametersI()
+    last_id = -1
+    while True:
+        params.add('id', rlong(last_id))
+        params.page(0, PAGE_SIZE)
+        ids = [r[0].val for r in query_service.projection(
+            QUERY_IDS % kind, params, {'omero.group': '-1'}
+        )]
+        if len(ids) > 0:
+            yield ids
+        if len(ids) < PAGE_SIZE:
+            return
+        last_id = ids[-1]
+
+
+def find_keys(query_service, query, ids):
+    """
+    Returns the keys, tuples of ids, that `query` returns for the objects
+    in the id range of the page `ids`.
+    """
+    params = ParametersI()
+    params.add('first', rlong(ids[0]))
+    params.add('last', rlong(ids[-1]))
+    return [
+        tuple([v.val for v in r]) for r in query_service.projection(
+            query, params, {'omero.group': '-1'}
+        )
+    ]
+
+
+def stream_keys(query_service, kind, query, width):
+    """
+    Returns an iterator over the keys of the expected documents in order.
+    The objects of `kind` are paged through by id and the keys of the
+    documents of each page found by `query`.  Unless their ids are the
+    keys themselves these are sorted client side; see `external_sort()`.
+    """
+    pages = find_id_pages(query_service, kind)
+    if query is None:
+        return ((v,) for ids in pages for v in ids)
+    return external_sort((
+        key for ids in pages for key in find_keys(query_service, query, ids)
+    ), width)
+
+
+def spill(keys, width):
+    """
+    Sorts `keys` and writes them to a temporary file as consecutive
+    64-bit integers, `width` per key.
+    """
+    run = tempfile.TemporaryFile()
+    block = array('l')
+    for key in sorted(keys):
+        block.extend(key)
+    block.tofile(run)
+    return run
+
+
+def read_run(run, width):
+    run.seek(0)
+    size = PAGE_SIZE * width
+    while True:
+        block = array('l')
+        try:
+            block.fromfile(run, size)
+        except EOFError:
+            # Whatever was left has still been read
+            pass
+        for i in range(0, len(block), width):
+            yield tuple(block[i:i + width])
+        if len(block) < size:
+            return
+
+
+def external_sort(keys, width):
+    """
+    Returns an iterator over `keys`, tuples of `width` ids, in order.
+    They are sorted in runs of `RUN_SIZE` that are spilled to disk and
+    merged, so that memory use does not grow with the number of keys.
+    """
+    runs = list()
+    block = list()
+    for key in keys:
+        block.append(key)
+        if len(block) >= RUN_SIZE:
+            runs.append(spill(block, width))
+            block = list()
+    runs.append(spill(block, width))
+    return heapq.merge(*[read_run(v, width) for v in runs])
+
+
+def stream_documents(es, index, doc_type, parse, width):
+    """
+    Yields the keys of all the documents of `doc_type` in order.
+    """
+    hits = scan(
+        es, query={'_source': False}, index=index, doc_type=doc_type,
+        size=PAGE_SIZE
+    )
+    return external_sort((parse(hit) for hit in hits), width)
+
+
+def orphans(expected, actual):
+    """
+    Yields the keys of the sorted iterable `actual` that are not in the
+    sorted iterable `expected`.
+    """
+    expected = iter(expected)
+    e = next(expected, None)
+    for a in actual:
+        while e is not None and e < a:
+            e = next(expected, None)
+        if e != a:
+            yield a
+
+
+def reconcile(client, es, sink, index, doc_type, dry_run):
+    """
+    Deletes the documents of `doc_type` that no longer exist in OMERO.
+    Both sides are streamed as sorted keys and diffed in a single pass and
+    the orphaned documents deleted as they are found.  Returns their
+    number.
+    """
+    kind, query, width, parse, unparse = TYPES[doc_type]
+    query_service = client.getSession().getQueryService()
+    t0 = time.time()
+    orphaned = (unparse(v) for v in orphans(
+        stream_keys(query_service, kind, query, width),
+        stream_documents(es, index, doc_type, parse, width)
+    ))
+    if dry_run:
+        count = 0
+        for _id, parent in orphaned:
+            count += 1
+            log.debug(
+                'Orphaned %s document: %s (parent %s)' % (
+                    doc_type, _id, parent
+                )
+            )
+        log.info(
+            'Found %d orphaned %s documents (%dms)' % (
+                count, doc_type, (time.time() - t0) * 1000
+            )
+        )
+        return count
+    writer = sink.writer(doc_type)
+    count = writer.send(
+        serializer.delete_action(index, doc_type, _id, parent)
+        for _id, parent in orphaned
+    )
+    sink.flush()
+    writer.wait()
+    log.info(
+        'Deleted %d orphaned %s documents (%dms)' % (
+            count, doc_type, (time.time() - t0) * 1000
+        )
+    )
+    return count
+
+
+def main():
+    try:
+        options, args = getopt(
+            sys.argv[1:], "s:p:u:w:h", [
+                "debug", "url=", "index=", "type=", "dry-run", "fingerprints="
+            ]
+        )
+    except GetoptError, (msg, _opt):
+        usage(msg)
+
+    level = logging.INFO
+    server = username = password = url = None
+    port = 4064
+    index = 'omero'
+    doc_types = list()
+    dry_run = False
+    settings = dict(SETTINGS)
+    for option, argument in options:
+        if option == "-s":
+            server = argument
+        if option == "-p":
+            port = int(argument)
+        if option == "-u":
+            username = argument
+        if option == "-w":
+            password = argument
+        if option == "-h":
+            usage()
+        if option == "--debug":
+            level = logging.DEBUG
+        if option == "--url":
+            url = argument
+        if option == "--index":
+            index = argument
+        if option == "--type":
+            if argument not in TYPES:
+                usage('Invalid document type: %s' % argument)
+            doc_types.append(argument)
+        if option == "--dry-run":
+            dry_run = True
+        if option == "--fingerprints":
+            settings['fingerprints'] = argument
+
+    if server is None or username is None or password is None:
+        usage('Server, username and password required!')
+    if url is None:
+        usage('Elasticsearch URL required!')
+    if len(doc_types) < 1:
+        doc_types = ['image', 'well', 'project', 'plate']
+
+    format = "%(asctime)s %(levelname)-7s [%(name)16s] %(message)s"
+    logging.basicConfig(level=level, format=format)
+    configure(settings)
+
+    es = create_elasticsearch(url, settings)
+    sink = create_sink(url, settings)
+    client = omero.client(server, port)
+    client.createSession(username, password)
+    try:
+        for doc_type in doc_types:
+            reconcile(client, es, sink, index, doc_type, dry_run)
+    finally:
+        sink.close()
+        transport.sent.report()
+        client.closeSession()
+
+
+if __name__ == '__main__':
+    main()
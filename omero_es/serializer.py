@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+import logging
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+
+def ujson_dumps():
+    import ujson
+    # Defaults to 9 decimal places which would truncate doubles; smaller
+    # values than the 15 kept still lose significant digits
+    return lambda v: ujson.dumps(v, double_precision=15)
+
+
+def simplejson_dumps():
+    import simplejson
+    return simplejson.dumps
+
+
+def json_dumps():
+    return json.dumps
+
+
+# JSON backends, fastest first, by name
+BACKENDS = [
+    ('ujson', ujson_dumps),
+    ('simplejson', simplejson_dumps),
+    ('json', json_dumps),
+]
+
+# Backends chosen from when none is specified.  They serialize documents
+# identically; `ujson` rounds doubles, so the documents, and their
+# fingerprints, would otherwise depend on what happens to be installed
+DEFAULT_BACKENDS = ('simplejson', 'json')
+
+# Name of the backend in use and its `dumps()`, see `use()`
+backend = 'json'
+dumps = json.dumps
+
+
+def use(name=None):
+    """
+    Selects the JSON backend used to serialize documents; the fastest of
+    `DEFAULT_BACKENDS` that is installed if `name` is not specified.
+    """
+    global backend, dumps
+    for _name, load in BACKENDS:
+        if name is None and _name not in DEFAULT_BACKENDS:
+            continue
+        if name is not None and name != _name:
+            continue
+        try:
+            dumps = load()
+        except ImportError:
+            if name is not None:
+                raise
+            continue
+        backend = _name
+        log.info('Using JSON backend: %s' % backend)
+        return backend
+
+
+def index_action(index, doc_type, _id, parent, source, version=None):
+    """
+    Returns the two newline terminated lines of a bulk API index action
+    for the already serialized document `source`.  Container documents
+    have no `parent`.  With a `version` the document is externally
+    versioned; Elasticsearch rejects it with a version conflict unless it
+    is newer than the indexed one.
+    """
+    metadata = {'_index': index, '_type': doc_type, '_id': _id}
+    if parent is not None:
+        metadata['_parent'] = parent
+    if version is not None:
+        metadata['_version'] = version
+        metadata['_version_type'] = 'external'
+    return '%s\n%s\n' % (dumps({'index': metadata}), source)
+
+
+def update_action(index, doc_type, _id, parent, source):
+    """
+    Returns the two newline terminated lines of a bulk API update action
+    for the already serialized partial document or script `source`.
+    """
+    metadata = {'_index': index, '_type': doc_type, '_id': _id}
+    if parent is not None:
+        metadata['_parent'] = parent
+    return '%s\n%s\n' % (dumps({'update': metadata}), source)
+
+
+def delete_action(index, doc_type, _id, parent):
+    """
+    Returns the newline terminated line of a bulk API delete action.
+    """
+    metadata = {'_index': index, '_type': doc_type, '_id': _id}
+    if parent is not None:
+        metadata['_parent'] = parent
+    return '%s\n' % dumps({'delete': metadata})
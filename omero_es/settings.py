@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+# Indexing settings and the Elasticsearch clients and bulk sinks created
+# from them.  Must not import OMERO so that `omero_es.load` can run
+# without it.
+
+import logging
+
+from elasticsearch import Elasticsearch
+
+from . import bulk, cache, checkpoint, export, fingerprint, transport
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+
+# Default indexing settings
+SETTINGS = {
+    'queue_size': 100,
+    'page_size': 100,
+    'image_loading': 'project',
+    'loader': 'join',
+    'cache_size': cache.DEFAULT_SIZE,
+    'fast_encoders': False,
+    'json': None,
+    'bulk_size': bulk.CHUNK_SIZE,
+    'bulk_bytes': bulk.MAX_CHUNK_BYTES,
+    'bulk_requests': bulk.CONCURRENCY,
+    'bulk_latency': bulk.TARGET_LATENCY,
+    'bulk_retries': bulk.MAX_RETRIES,
+    'dead_letters': None,
+    'compress': False,
+    'connections': transport.POOL_SIZE,
+    'keep_alive': None,
+    'http': 'urllib3',
+    'versioning': False,
+    'fingerprints': None,
+    'journal': None,
+    'checkpoint_size': checkpoint.CHECKPOINT_SIZE,
+    'output': None,
+    'output_bytes': export.MAX_FILE_BYTES,
+}
+
+
+def describe_error(e):
+    return '%s: %s' % (e.__class__.__name__, e)
+
+
+def create_elasticsearch(url, settings, compress=False):
+    compress_level = 0
+    if compress and settings['compress']:
+        compress_level = transport.COMPRESS_LEVEL
+    return Elasticsearch(
+        [url], verify_certs=True, timeout=60,
+        connection_class=transport.BACKENDS[settings['http']],
+        maxsize=settings['connections'], keep_alive=settings['keep_alive'],
+        compress_level=compress_level
+    )
+
+
+def create_sink(url, settings):
+    if settings['output'] is not None:
+        # With a journal containers are only recorded once their actions
+        # are safely on disk
+        return export.FileSink(
+            settings['output'], settings['output_bytes'],
+            settings['compress'], settings['journal'] is not None
+        )
+    if url is None:
+        return None
+    dead_letters = None
+    if settings['dead_letters'] is not None:
+        dead_letters = bulk.DeadLetters(settings['dead_letters'])
+    fingerprints = None
+    if settings['fingerprints'] is not None:
+        fingerprints = fingerprint.FingerprintStore(settings['fingerprints'])
+    return bulk.Sink(
+        create_elasticsearch(url, settings, compress=True),
+        settings['bulk_size'],
+        settings['bulk_bytes'], settings['bulk_requests'],
+        settings['bulk_latency'], settings['bulk_retries'], dead_letters,
+        fingerprints
+    )
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import logging
+import socket
+import threading
+import zlib
+
+from elasticsearch import RequestsHttpConnection, Urllib3HttpConnection
+
+
+# Package scoped logger
+log = logging.getLogger(__name__)
+
+# Number of connections kept open to each Elasticsearch node
+POOL_SIZE = 10
+
+# gzip level of compressed request bodies; the fastest, JSON compresses
+# well regardless
+COMPRESS_LEVEL = 1
+
+
+class Counter(object):
+    """
+    Per process count of the request body bytes sent, before and after
+    compression.
+    """
+
+    def __init__(self):
+        self.raw = 0
+        self.wire = 0
+        self.lock = threading.Lock()
+
+    def add(self, raw, wire):
+        with self.lock:
+            self.raw += raw
+            self.wire += wire
+
+    def report(self):
+        if self.raw == 0:
+            return
+        log.info(
+            'Sent %d bytes of request bodies, %d bytes on the wire '
+            '(%.1f%%)' % (self.raw, self.wire, 100.0 * self.wire / self.raw)
+        )
+
+
+sent = Counter()
+
+
+def gzip(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def socket_options(keep_alive):
+    """
+    Returns the socket options that enable TCP keepalive probes after
+    `keep_alive` idle seconds, so that firewalls do not silently drop
+    pooled connections, or `None` to use the defaults.
+    """
+    if keep_alive is None:
+        return None
+    from urllib3.connection import HTTPConnection
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    # Only available on Linux
+    for name in ('TCP_KEEPIDLE', 'TCP_KEEPINTVL'):
+        if hasattr(socket, name):
+            options.append(
+                (socket.IPPROTO_TCP, getattr(socket, name), keep_alive)
+            )
+    return options
+
+
+class TunedConnection(object):
+    """
+    Mixin for the connection classes of the Elasticsearch client that sets
+    the size of the connection pool and TCP keepalive, gzips request
+    bodies if `compress_level` is specified and counts the bytes sent.
+    Compression applies to every request so it is only enabled for the
+    clients that exclusively make bulk requests.
+    """
+
+    def __init__(self, compress_level=0, keep_alive=None, maxsize=POOL_SIZE,
+                 **kwargs):
+        if compress_level:
+            headers = dict(kwargs.get('headers') or {})
+            headers['content-encoding'] = 'gzip'
+            kwargs['headers'] = headers
+        super(TunedConnection, self).__init__(maxsize=maxsize, **kwargs)
+        self.compress_level = compress_level
+        self.tune(maxsize, socket_options(keep_alive))
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        if body is not None:
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            raw = len(body)
+            if self.compress_level:
+                body = gzip(body, self.compress_level)
+            sent.add(raw, len(body))
+        return super(TunedConnection, self).perform_request(
+            method, url, params, body, timeout, ignore
+        )
+
+
+class Urllib3Connection(TunedConnection, Urllib3HttpConnection):
+
+    def tune(self, maxsize, options):
+        # `maxsize` is handled by `Urllib3HttpConnection`
+        if options is not None:
+            self.pool.conn_kw['socket_options'] = options
+
+
+class RequestsConnection(TunedConnection, RequestsHttpConnection):
+
+    def tune(self, maxsize, options):
+        from requests.adapters import HTTPAdapter
+
+        class Adapter(HTTPAdapter):
+
+            def init_poolmanager(self, *args, **kwargs):
+                if options is not None:
+                    kwargs['socket_options'] = options
+                super(Adapter, self).init_poolmanager(*args, **kwargs)
+
+        adapter = Adapter(pool_connections=1, pool_maxsize=maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+# Connection class for each HTTP backend, by name
+BACKENDS = {
+    'urllib3': Urllib3Connection,
+    'requests': RequestsConnection,
+}
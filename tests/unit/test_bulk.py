@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import gzip
+import json
+
+import pytest
+
+from elasticsearch import TransportError
+from elasticsearch.helpers import BulkIndexError
+
+from omero_es import bulk
+from omero_es.serializer import delete_action, index_action, update_action
+
+
+def action(_id):
+    return index_action('omero', 'project', _id, None, json.dumps({'id': _id}))
+
+
+def parse(body):
+    """
+    Returns the `(op, id)` of the actions of a bulk request body.
+    """
+    actions = list()
+    for line in body.splitlines():
+        if line.split('"')[1] in ('index', 'update', 'delete'):
+            op, metadata = json.loads(line).items()[0]
+            actions.append((op, metadata['_id']))
+    return actions
+
+
+class Elasticsearch(object):
+    """
+    Records bulk requests and answers each action with the status that
+    `statuses` returns for its id, created by default.
+    """
+
+    def __init__(self, statuses=lambda _id: 201):
+        self.statuses = statuses
+        self.requests = list()
+
+    def bulk(self, body):
+        actions = parse(body)
+        self.requests.append([v[1] for v in actions])
+        return {'items': [
+            {op: {'_id': v, 'status': self.statuses(v)}}
+            for op, v in actions
+        ]}
+
+
+class TestStatus(object):
+
+    def test_success(self):
+        assert bulk.status({'index': {'status': 201}}) == 201
+
+    def test_failure(self):
+        assert bulk.status({'index': {'status': 400, 'error': {}}}) == 400
+
+    def test_error_without_status(self):
+        assert bulk.status({'index': {'error': {}}}) == 500
+
+    def test_delete_of_missing_document(self):
+        assert bulk.status({'delete': {'status': 404}}) == 200
+        assert bulk.status({'index': {'status': 404}}) == 404
+
+
+class TestSink(object):
+    """
+    The actions of all writers stream through shared chunks and each
+    writer accounts for its own.
+    """
+
+    @pytest.fixture(autouse=True)
+    def close_sinks(self, request):
+        self.sinks = list()
+
+        def close():
+            for sink in self.sinks:
+                sink.close()
+        request.addfinalizer(close)
+
+    def create_sink(self, es, **kwargs):
+        kwargs.setdefault('target_latency', None)
+        sink = bulk.Sink(es, **kwargs)
+        self.sinks.append(sink)
+        return sink
+
+    def test_writers_share_requests(self):
+        es = Elasticsearch()
+        sink = self.create_sink(es)
+        a = sink.writer('a')
+        b = sink.writer('b')
+        assert a.send([action('1'), action('2')]) == 2
+        assert b.send([action('3')]) == 1
+        sink.flush()
+        assert a.wait() == 2
+        assert b.wait() == 1
+        assert es.requests == [['1', '2', '3']]
+
+    def test_chunk_size(self):
+        es = Elasticsearch()
+        sink = self.create_sink(es, chunk_size=2, concurrency=1)
+        writer = sink.writer('a')
+        writer.send([action(str(v)) for v in range(5)])
+        assert writer.wait() == 5
+        assert es.requests == [['0', '1'], ['2', '3'], ['4']]
+
+    def test_max_chunk_bytes(self):
+        es = Elasticsearch()
+        sink = self.create_sink(
+            es, max_chunk_bytes=len(action('0')) * 2, concurrency=1
+        )
+        writer = sink.writer('a')
+        writer.send([action(str(v)) for v in range(3)])
+        assert writer.wait() == 3
+        assert es.requests == [['0', '1'], ['2']]
+
+    def test_wait_flushes_own_actions(self):
+        es = Elasticsearch()
+        sink = self.create_sink(es)
+        writer = sink.writer('a')
+        writer.send([action('1')])
+        assert writer.wait() == 1
+
+    def test_delete(self):
+        es = Elasticsearch(lambda _id: 404)
+        sink = self.create_sink(es)
+        writer = sink.writer('a')
+        writer.send([delete_action('omero', 'project', '1', None)])
+        assert writer.wait() == 1
+
+    def test_failed_actions(self):
+        es = Elasticsearch(lambda _id: 400 if _id == '2' else 201)
+        sink = self.create_sink(es)
+        a = sink.writer('a')
+        b = sink.writer('b')
+        a.send([action('1'), action('2')])
+        b.send([action('3')])
+        with pytest.raises(BulkIndexError) as e:
+            a.wait()
+        assert [v['index']['_id'] for v in e.value.errors] == ['2']
+        assert a.success == 1
+        assert b.wait() == 1
+
+    def test_failed_request(self):
+        class Failing(Elasticsearch):
+            def bulk(self, body):
+                raise TransportError(400, 'failed')
+        sink = self.create_sink(Failing())
+        writer = sink.writer('a')
+        writer.send([action('1')])
+        with pytest.raises(TransportError):
+            writer.wait()
+
+    def test_rejected_actions_are_retried(self, monkeypatch):
+        monkeypatch.setattr(bulk, 'INITIAL_BACKOFF', 0)
+        rejected = set(['2'])
+
+        def statuses(_id):
+            if _id in rejected:
+                rejected.remove(_id)
+                return bulk.REJECTED
+            return 201
+        es = Elasticsearch(statuses)
+        sink = self.create_sink(es)
+        writer = sink.writer('a')
+        writer.send([action('1'), action('2')])
+        assert writer.wait() == 2
+        assert es.requests == [['1', '2'], ['2']]
+        assert sink.retries == 1
+
+    def test_rejected_requests_are_retried(self, monkeypatch):
+        monkeypatch.setattr(bulk, 'INITIAL_BACKOFF', 0)
+
+        class Overloaded(Elasticsearch):
+            def bulk(self, body):
+                if len(self.requests) == 0:
+                    self.requests.append(None)
+                    raise TransportError(bulk.REJECTED, 'rejected')
+                return super(Overloaded, self).bulk(body)
+        es = Overloaded()
+        sink = self.create_sink(es)
+        writer = sink.writer('a')
+        writer.send([action('1')])
+        assert writer.wait() == 1
+        assert es.requests == [None, ['1']]
+
+    def test_retries_exhausted(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(bulk, 'INITIAL_BACKOFF', 0)
+        path = str(tmpdir.join('dead.json'))
+        es = Elasticsearch(lambda _id: bulk.REJECTED)
+        sink = self.create_sink(
+            es, max_retries=2, dead_letters=bulk.DeadLetters(path)
+        )
+        writer = sink.writer('a')
+        writer.send([action('1')])
+        with pytest.raises(BulkIndexError):
+            writer.wait()
+        assert len(es.requests) == 3
+        assert list(bulk.read_actions(path)) == [action('1')]
+
+    def test_dead_letters(self, tmpdir):
+        path = str(tmpdir.join('dead.json'))
+        es = Elasticsearch(lambda _id: 400 if _id != '2' else 201)
+        sink = self.create_sink(es, dead_letters=bulk.DeadLetters(path))
+        writer = sink.writer('a')
+        delete = delete_action('omero', 'project', '3', None)
+        writer.send([action('1'), action('2'), delete])
+        with pytest.raises(BulkIndexError):
+            writer.wait()
+        assert list(bulk.read_actions(path)) == [action('1'), delete]
+
+
+class TestAdapt(object):
+    """
+    The chunk size grows while requests are fast and full, shrinks in
+    proportion to slow requests and halves on rejections, within bounds.
+    """
+
+    @pytest.fixture(autouse=True)
+    def create_sink(self, request):
+        self.sink = bulk.Sink(
+            Elasticsearch(), chunk_size=100, target_latency=1.0
+        )
+        request.addfinalizer(self.sink.close)
+
+    def test_grows(self):
+        self.sink.adapt(100, 0.5, 0)
+        assert self.sink.chunk_size == 110
+
+    def test_only_grows_when_full(self):
+        self.sink.adapt(50, 0.5, 0)
+        assert self.sink.chunk_size == 100
+
+    def test_shrinks(self):
+        self.sink.adapt(100, 4.0, 0)
+        assert self.sink.chunk_size == 25
+
+    def test_halves_on_rejection(self):
+        self.sink.adapt(100, 0.5, 1)
+        assert self.sink.chunk_size == 50
+
+    def test_bounds(self):
+        for i in range(10):
+            self.sink.adapt(100, 0.5, 1)
+        assert self.sink.chunk_size == bulk.MIN_CHUNK_SIZE
+        for i in range(100):
+            self.sink.adapt(bulk.MAX_CHUNK_SIZE, 0.5, 0)
+        assert self.sink.chunk_size == bulk.MAX_CHUNK_SIZE
+        assert min(self.sink.sizes) == bulk.MIN_CHUNK_SIZE
+
+    def test_disabled(self):
+        self.sink.target_latency = None
+        self.sink.adapt(100, 4.0, 1)
+        assert self.sink.chunk_size == 100
+
+
+class TestReadActions(object):
+
+    @pytest.mark.parametrize('name', ['actions.json', 'actions.json.gz'])
+    def test_read(self, tmpdir, name):
+        path = str(tmpdir.join(name))
+        actions = [
+            action('1'), delete_action('omero', 'project', '2', None),
+            action('3'),
+        ]
+        if name.endswith('.gz'):
+            f = gzip.open(path, 'wb')
+        else:
+            f = open(path, 'wb')
+        with f:
+            f.write(''.join(actions))
+        assert list(bulk.read_actions(path)) == actions
+
+    def test_truncated(self, tmpdir):
+        path = tmpdir.join('actions.json')
+        path.write(action('1') + action('2').splitlines(True)[0])
+        assert list(bulk.read_actions(str(path))) == [action('1')]
+
+
+class TestConflicts(object):
+    """
+    An externally versioned action rejected with a version conflict is
+    only skipped if the document indexed has the same source.
+    """
+
+    @pytest.fixture(autouse=True)
+    def create_sink(self, request):
+        class Versioned(Elasticsearch):
+            def mget(self, body):
+                return {'docs': [
+                    {'found': True, '_source': {'id': '1'}},
+                    {'found': True, '_source': {'id': 'stale'}},
+                    {'found': False},
+                ]}
+        self.es = Versioned(lambda _id: bulk.CONFLICT)
+        self.sink = bulk.Sink(self.es, target_latency=None)
+        request.addfinalizer(self.sink.close)
+
+    def test_conflicts(self):
+        writer = self.sink.writer('a')
+        writer.send([action('1'), action('2'), action('3')])
+        with pytest.raises(BulkIndexError) as e:
+            writer.wait()
+        assert [v['index']['_id'] for v in e.value.errors] == ['2', '3']
+        assert writer.skipped == 1
+        assert writer.success == 0
+
+
+class TestMissing(object):
+    """
+    Updates of documents that do not exist are reported to their writer
+    rather than failed.
+    """
+
+    @pytest.fixture(autouse=True)
+    def create_sink(self, request, tmpdir):
+        class Missing(Elasticsearch):
+            def bulk(self, body):
+                response = super(Missing, self).bulk(body)
+                for item in response['items']:
+                    op, result = item.items()[0]
+                    if op == 'update' and result['_id'] == '2':
+                        result['status'] = 404
+                        result['error'] = {'type': bulk.DOCUMENT_MISSING}
+                return response
+        self.path = str(tmpdir.join('dead.json'))
+        self.sink = bulk.Sink(
+            Missing(), target_latency=None,
+            dead_letters=bulk.DeadLetters(self.path)
+        )
+        request.addfinalizer(self.sink.close)
+
+    def update(self, _id):
+        return update_action(
+            'omero', 'project', _id, None, json.dumps({'doc': {}})
+        )
+
+    def test_missing(self):
+        writer = self.sink.writer('a')
+        writer.send([self.update('1'), self.update('2'), action('3')])
+        assert writer.wait() == 2
+        assert [v['update']['_id'] for v in writer.missing] == ['2']
+        assert list(bulk.read_actions(self.path)) == []
+
+    def test_only_updates(self):
+        assert not bulk.missing({'index': {
+            'status': 404, 'error': {'type': bulk.DOCUMENT_MISSING}
+        }})
+        assert not bulk.missing({'update': {'status': 404, 'error': 'old'}})
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import pytest
+
+from omero_es import cache
+from omero_es.cache import LRUCache
+
+
+class TestLRUCache(object):
+    """
+    Entries are evicted least recently used first once the cache is full.
+    """
+
+    def test_get(self):
+        lru = LRUCache('test', 2)
+        lru.put('a', 1)
+        assert lru.get('a') == 1
+        assert lru.get('b') is None
+        assert lru.get('b', 2) == 2
+        assert (lru.hits, lru.misses) == (1, 2)
+
+    def test_evicts_least_recently_put(self):
+        lru = LRUCache('test', 2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.put('c', 3)
+        assert 'a' not in lru
+        assert len(lru) == 2
+
+    def test_get_refreshes(self):
+        lru = LRUCache('test', 2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.get('a')
+        lru.put('c', 3)
+        assert 'a' in lru
+        assert 'b' not in lru
+
+    def test_put_replaces(self):
+        lru = LRUCache('test', 2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.put('a', 3)
+        lru.put('c', 4)
+        assert lru.get('a') == 3
+        assert 'b' not in lru
+
+    def test_disabled(self):
+        lru = LRUCache('test', 0)
+        lru.put('a', 1)
+        assert 'a' not in lru
+        assert len(lru) == 0
+
+    def test_resize(self):
+        lru = LRUCache('test', 3)
+        for i in range(3):
+            lru.put(i, i)
+        lru.resize(1)
+        assert len(lru) == 1
+        assert 2 in lru
+        lru.resize(0)
+        assert len(lru) == 0
+
+
+class TestResize(object):
+    """
+    Resizing applies to every cache of the process.
+    """
+
+    @pytest.fixture(autouse=True)
+    def restore_caches(self, request):
+        sizes = [v.maxsize for v in cache.CACHES]
+
+        def restore():
+            for lru, maxsize in zip(cache.CACHES, sizes):
+                lru.resize(maxsize)
+        request.addfinalizer(restore)
+
+    def test_resize(self):
+        cache.resize(0)
+        for lru in cache.CACHES:
+            lru.put('a', 1)
+            assert len(lru) == 0
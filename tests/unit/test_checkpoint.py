@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import pytest
+
+from omero_es import checkpoint
+from omero_es.checkpoint import Journal, Progress, Segments
+
+
+class TestJournal(object):
+    """
+    The latest entry of each key survives reopening the journal, and a
+    partially written last line.
+    """
+
+    @pytest.fixture(autouse=True)
+    def create_path(self, tmpdir):
+        self.path = str(tmpdir.join('journal.json'))
+
+    def reopen(self, journal):
+        journal.close()
+        return Journal(self.path)
+
+    def test_record(self):
+        journal = Journal(self.path)
+        journal.record('Project:1', position=(None, 10))
+        journal.record('Project:2', done=True)
+        journal = self.reopen(journal)
+        try:
+            assert not journal.done('Project:1')
+            assert journal.position('Project:1') == (None, 10)
+            assert journal.done('Project:2')
+            assert journal.position('Project:2') is None
+            assert not journal.done('Project:3')
+        finally:
+            journal.close()
+
+    def test_latest_entry(self):
+        journal = Journal(self.path)
+        journal.record('Project:1', position=(2, 10))
+        journal.record('Project:1', position=(3, 5))
+        journal.record('Project:1', done=True)
+        journal = self.reopen(journal)
+        try:
+            assert journal.done('Project:1')
+            assert journal.position('Project:1') is None
+        finally:
+            journal.close()
+
+    def test_partial_line(self):
+        journal = Journal(self.path)
+        journal.record('Project:1', done=True)
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('{"key": "Project:2", "do')
+        journal = Journal(self.path)
+        journal.record('Project:3', done=True)
+        journal = self.reopen(journal)
+        try:
+            assert journal.done('Project:1')
+            assert not journal.done('Project:2')
+            assert journal.done('Project:3')
+        finally:
+            journal.close()
+
+
+class TestResume(object):
+    """
+    Tasks, and shards, that the journal of the process records as done
+    are not run again.
+    """
+
+    @pytest.fixture(autouse=True)
+    def use_journal(self, request, tmpdir):
+        checkpoint.use(str(tmpdir.join('journal.json')))
+
+        def close():
+            if checkpoint.journal is not None:
+                checkpoint.journal.close()
+            checkpoint.use(None)
+        request.addfinalizer(close)
+
+    def test_key(self):
+        assert checkpoint.key(('Project', 1L)) == 'Project:1'
+        assert checkpoint.key(('ProjectParent', 1L)) == 'Project:1'
+        assert checkpoint.key(('PlateParent', 2L)) == 'Plate:2'
+        assert checkpoint.key(('PlateShard', (2L, 1L, 5L))) == \
+            'PlateShard:(2L, 1L, 5L)'
+
+    def test_remaining(self):
+        checkpoint.record('Project:1', done=True)
+        checkpoint.record('Screen:2', position=(None, 5))
+        assert checkpoint.remaining({
+            ('Project', 1L): 10, ('Project', 3L): 5, ('Screen', 2L): 20,
+        }) == {('Project', 3L): 5, ('Screen', 2L): 20}
+
+    def test_no_journal(self):
+        checkpoint.journal.close()
+        checkpoint.use(None)
+        checkpoint.record('Project:1', done=True)
+        assert not checkpoint.done('Project:1')
+        assert checkpoint.position('Project:1') is None
+        estimates = {('Project', 1L): 10}
+        assert checkpoint.remaining(estimates) is estimates
+
+    def test_remaining_shards(self):
+        first = ('PlateShard', (1L, 1L, 10L))
+        second = ('PlateShard', (1L, 11L, 20L))
+        third = ('PlateShard', (2L, 1L, 10L))
+        fourth = ('PlateShard', (3L, 1L, 10L))
+        parents = {
+            first: ('PlateParent', 1L), second: ('PlateParent', 1L),
+            third: ('PlateParent', 2L), fourth: ('PlateParent', 3L),
+        }
+        estimates = {
+            first: 10, second: 10, third: 10, fourth: 10, ('Project', 4L): 5,
+        }
+        checkpoint.record(checkpoint.key(first), done=True)
+        # All shards of Plate:2 are done, but not the Plate
+        checkpoint.record(checkpoint.key(third), done=True)
+        # Plate:3 is done
+        checkpoint.record('Plate:3', done=True)
+        left, left_parents = checkpoint.remaining_shards(estimates, parents)
+        assert left == {
+            second: 10, ('PlateParent', 2L): 0, ('Project', 4L): 5,
+        }
+        assert left_parents == {second: ('PlateParent', 1L)}
+
+
+class TestSegments(object):
+
+    def test_segments(self):
+        segments = [list(v) for v in Segments(range(5), 2)]
+        assert segments == [[0, 1], [2, 3], [4]]
+
+    def test_exact_multiple(self):
+        segments = [list(v) for v in Segments(range(4), 2)]
+        assert segments == [[0, 1], [2, 3], []]
+
+    def test_empty(self):
+        assert [list(v) for v in Segments([], 2)] == [[]]
+
+    def test_lazy(self):
+        def items():
+            for i in range(4):
+                consumed.append(i)
+                yield i
+        consumed = list()
+        segments = iter(Segments(items(), 2))
+        assert list(next(segments)) == [0, 1]
+        assert consumed == [0, 1]
+
+
+class TestProgress(object):
+
+    def test_update(self):
+        progress = Progress({('Project', 1L): 10, ('Project', 2L): 30})
+        progress.update(('Project', 2L))
+        assert (progress.tasks, progress.done, progress.total) == (1, 30, 40)
+        # Parent tasks are not estimated
+        progress.update(('ProjectParent', 3L))
+        assert (progress.tasks, progress.done) == (2, 30)
+
+    def test_format_duration(self):
+        assert checkpoint.format_duration(3725.5) == '1:02:05'
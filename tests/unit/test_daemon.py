@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import pytest
+
+from omero_es import daemon
+from omero_es.daemon import ChangeQueue
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestChangeQueue(object):
+    """
+    Changes to the same objects are coalesced and are ready once quiet,
+    once the first has waited long enough or once there are enough of
+    them.
+    """
+
+    @pytest.fixture(autouse=True)
+    def clock(self, monkeypatch):
+        self.clock = Clock()
+        monkeypatch.setattr(daemon.time, 'time', self.clock)
+
+    def test_coalesce(self):
+        queue = ChangeQueue(5, 60, 100)
+        for kind, _id in [('Image', 1L), ('Image', 2L), ('Image', 1L),
+                          ('Dataset', 1L), ('Image', 1L)]:
+            queue.add(kind, _id)
+        assert queue.size == 3
+        assert queue.take() == (
+            {'Image': set([1L, 2L]), 'Dataset': set([1L])}, 5
+        )
+        assert (queue.size, queue.events) == (0, 0)
+        assert not queue.ready()
+
+    def test_empty(self):
+        queue = ChangeQueue(5, 60, 100)
+        self.clock.now += 3600
+        assert not queue.ready()
+
+    def test_quiet(self):
+        queue = ChangeQueue(5, 60, 100)
+        queue.add('Image', 1L)
+        self.clock.now += 4
+        assert not queue.ready()
+        queue.add('Image', 2L)
+        self.clock.now += 4
+        assert not queue.ready()
+        self.clock.now += 1
+        assert queue.ready()
+
+    def test_max_delay(self):
+        queue = ChangeQueue(5, 60, 100)
+        for i in range(30):
+            queue.add('Image', 1L)
+            assert not queue.ready()
+            self.clock.now += 2
+        assert queue.ready()
+
+    def test_max_pending(self):
+        queue = ChangeQueue(5, 60, 2)
+        queue.add('Image', 1L)
+        queue.add('Image', 1L)
+        assert not queue.full
+        assert not queue.ready()
+        queue.add('Image', 2L)
+        assert queue.full
+        assert queue.ready()
+
+
+class Stop(Exception):
+    pass
+
+
+class Client(object):
+
+    def getSession(self):
+        return self
+
+    def getQueryService(self):
+        return None
+
+
+class TestRun(object):
+    """
+    The cursor is only advanced once the changes read up to it have been
+    indexed without any task failing.
+    """
+
+    @pytest.fixture(autouse=True)
+    def follow(self, monkeypatch, tmpdir):
+        self.path = str(tmpdir.join('cursor.json'))
+        daemon.write_cursor(self.path, 100L)
+        # EventLog pages and tasks failed by `process()`, in turn
+        self.entries = list()
+        self.failures = list()
+        self.retried = list()
+        # Cursor after each iteration
+        self.cursors = list()
+
+        def poll(query_service, cursor):
+            return self.entries.pop(0)
+
+        def process(client, sink, index, settings, queue, retry):
+            queue.take()
+            self.retried.append(retry)
+            return self.failures.pop(0)
+
+        def sleep(seconds):
+            self.cursors.append(daemon.read_cursor(self.path))
+            if len(self.entries) == 0:
+                raise Stop()
+        monkeypatch.setattr(daemon, 'poll', poll)
+        monkeypatch.setattr(daemon, 'process', process)
+        monkeypatch.setattr(daemon.time, 'sleep', sleep)
+
+    def run(self, entries, failures, retry_interval):
+        self.entries.extend(entries)
+        self.failures.extend(failures)
+        with pytest.raises(Stop):
+            daemon.run(
+                Client(), None, 'omero', dict(), self.path,
+                ChangeQueue(0, 0, 10), 1, retry_interval
+            )
+
+    def test_advance(self):
+        self.run([[(101L, 'Image', 1L, 'UPDATE')], []], [set()], 60)
+        assert self.cursors == [101L, 101L]
+
+    def test_failures(self):
+        task = ('ProjectImages', (10L, (1L,)))
+        self.run([
+            [(101L, 'Image', 1L, 'UPDATE')],
+            [(102L, 'Image', 2L, 'UPDATE')],
+            [],
+        ], [set([task]), set([task]), set()], 0)
+        assert self.cursors == [100L, 100L, 102L]
+        # Retried along with the new changes, then on their own
+        assert self.retried == [set(), set([task]), set([task])]
+
+    def test_irrelevant(self):
+        self.run([[(101L, 'Session', 1L, 'INSERT')]], [], 60)
+        assert self.cursors == [101L]
+
+    def test_irrelevant_failures(self):
+        # Only irrelevant changes while the failed task waits to be retried
+        task = ('ProjectImages', (10L, (1L,)))
+        self.run([
+            [(101L, 'Image', 1L, 'UPDATE')],
+            [(102L, 'Session', 1L, 'INSERT')],
+        ], [set([task])], 60)
+        assert self.cursors == [100L, 100L]
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import pytest
+
+from omero.model import DatasetI, ImageI, ProjectI
+from omero.rtypes import rlong, rstring
+from omero.sys import ParametersI
+
+from omero_es.document import QUERY_ID_PAGE, BaseDocument, ProjectDocument
+
+
+class QueryService(object):
+    """
+    Answers id page queries from `ids` as the server would, recording the
+    `last_id` of each.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.last_ids = list()
+
+    def projection(self, query, params, ctx):
+        assert query.endswith(QUERY_ID_PAGE % ('image', 'image'))
+        last_id = params.map['last_id'].val
+        self.last_ids.append(last_id)
+        ids = [v for v in sorted(self.ids) if v > last_id]
+        return [[rlong(v)] for v in ids[:params.theFilter.limit.val]]
+
+
+class TestFindIdPages(object):
+    """
+    Pages seek past the last id of the previous page and the empty page
+    that follows a full last page is not yielded.
+    """
+
+    def find_id_pages(self, ids, page_size, last_id=-1):
+        document = BaseDocument(None)
+        document.page_size = page_size
+        self.query_service = QueryService(ids)
+        return list(document.find_id_pages(
+            self.query_service, 'SELECT image.id FROM Image AS image\n',
+            ParametersI(), 'image', last_id
+        ))
+
+    @pytest.mark.parametrize('page_size,pages,last_ids', [
+        (2, [[1L, 2L], [3L, 4L], [5L]], [-1, 2L, 4L]),
+        (5, [[1L, 2L, 3L, 4L, 5L]], [-1, 5L]),
+        (10, [[1L, 2L, 3L, 4L, 5L]], [-1]),
+    ])
+    def test_pages(self, page_size, pages, last_ids):
+        assert self.find_id_pages(range(1, 6), page_size) == pages
+        assert self.query_service.last_ids == last_ids
+
+    def test_last_id(self):
+        assert self.find_id_pages(range(1, 6), 2, 3L) == [[4L, 5L]]
+        assert self.query_service.last_ids == [3L, 5L]
+
+    def test_sparse_ids(self):
+        assert self.find_id_pages([3L, 70L, 9L, 1000L], 2) == \
+            [[3L, 9L], [70L, 1000L]]
+        assert self.query_service.last_ids == [-1, 9L, 1000L]
+
+    def test_empty(self):
+        assert self.find_id_pages([], 2) == []
+        assert self.query_service.last_ids == [-1]
+
+
+def image(_id, dataset_ids):
+    obj = ImageI(_id, True)
+    obj.name = rstring('image %d' % _id)
+    for dataset_id in dataset_ids:
+        obj.linkDataset(DatasetI(dataset_id, False))
+    return obj
+
+
+class TestImageDocuments(object):
+    """
+    An Image is encoded and serialized once whatever the number of
+    Datasets it is linked to and Images linked to several of them are
+    only documented the first time they are found.
+    """
+
+    @pytest.fixture(autouse=True)
+    def project_document(self):
+        self.document = ProjectDocument(None, ProjectI(1L, True))
+
+    def dataset_ids(self, image_documents):
+        return [v.dataset_id for v in image_documents]
+
+    def test_single_dataset(self):
+        image_documents = self.document.create_image_documents(
+            image(1L, [2L])
+        )
+        assert self.dataset_ids(image_documents) == [2L]
+        # Only found once; not remembered
+        assert self.document.seen_image_ids == set()
+
+    def test_for_dataset(self):
+        image_documents = self.document.create_image_documents(
+            image(1L, [2L, 3L, 4L])
+        )
+        assert self.dataset_ids(image_documents) == [2L, 3L, 4L]
+        first = image_documents[0]
+        for image_document in image_documents[1:]:
+            assert image_document.image is first.image
+            assert image_document.document is first.document
+            assert image_document.source is first.source
+            assert image_document.version == first.version
+
+    def test_seen(self):
+        image_documents = self.document.create_image_documents(
+            image(1L, [2L, 3L])
+        )
+        assert len(image_documents) == 2
+        # Found again via its other Dataset
+        assert self.document.create_image_documents(
+            image(1L, [2L, 3L])
+        ) == []
+        assert self.document.seen_image_ids == set([1L])
+
+    def test_no_datasets(self):
+        assert self.document.create_image_documents(image(1L, [])) == []
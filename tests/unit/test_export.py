@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+import os
+
+import pytest
+
+from omero_es import bulk, export
+from omero_es.export import FileSink
+from omero_es.serializer import index_action
+
+
+def action(_id):
+    return index_action('omero', 'project', _id, None, json.dumps({'id': _id}))
+
+
+class TestFileSink(object):
+    """
+    Actions are written to rotated files, renamed once complete, that read
+    back as the same actions.
+    """
+
+    @pytest.fixture(autouse=True)
+    def create_prefix(self, tmpdir):
+        self.tmpdir = tmpdir
+        self.prefix = str(tmpdir.join('omero'))
+
+    def files(self):
+        return sorted(os.listdir(str(self.tmpdir)))
+
+    def read(self):
+        actions = list()
+        for name in self.files():
+            actions.extend(bulk.read_actions(str(self.tmpdir.join(name))))
+        return actions
+
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_export(self, compress):
+        sink = FileSink(self.prefix, compress=compress)
+        a = sink.writer('a')
+        b = sink.writer('b')
+        a.send([action('1'), action('2')])
+        b.send([action('3')])
+        sink.flush()
+        assert a.wait() == 2
+        assert b.wait() == 1
+        sink.close()
+        suffix = '.json.gz' if compress else '.json'
+        assert self.files() == ['omero-%d-00001%s' % (os.getpid(), suffix)]
+        assert self.read() == [action('1'), action('2'), action('3')]
+
+    def test_rotate(self):
+        sink = FileSink(self.prefix, max_bytes=len(action('1')) * 2)
+        writer = sink.writer('a')
+        writer.send([action(str(v)) for v in range(5)])
+        sink.close()
+        assert len(self.files()) == 3
+        assert self.read() == [action(str(v)) for v in range(5)]
+        assert (sink.files, sink.actions) == (3, 5)
+
+    def test_partial(self):
+        sink = FileSink(self.prefix)
+        writer = sink.writer('a')
+        writer.send([action('1')])
+        assert self.files() == [
+            'omero-%d-00001.json%s' % (os.getpid(), export.PARTIAL)
+        ]
+        sink.close()
+        assert not self.files()[0].endswith(export.PARTIAL)
+
+    def test_acknowledged_when_written(self):
+        sink = FileSink(self.prefix)
+        writer = sink.writer('a')
+        writer.send([action('1')])
+        assert writer.acknowledged == 1
+        sink.close()
+
+    def test_durable(self):
+        sink = FileSink(self.prefix, durable=True)
+        a = sink.writer('a')
+        b = sink.writer('b')
+        a.send([action('1')])
+        b.send([action('2')])
+        # Only acknowledged once the file is complete
+        assert (a.acknowledged, b.acknowledged) == (0, 0)
+        assert a.wait() == 1
+        assert b.acknowledged == 1
+        assert not self.files()[0].endswith(export.PARTIAL)
+        c = sink.writer('c')
+        c.send([action('3')])
+        # Waiting for a writer without actions in the current file does
+        # not complete it
+        assert b.wait() == 1
+        assert self.files()[-1].endswith(export.PARTIAL)
+        sink.close()
+        assert c.acknowledged == 1
+        assert self.read() == [action('1'), action('2'), action('3')]
+
+    def test_durable_rotate(self):
+        sink = FileSink(
+            self.prefix, max_bytes=len(action('1')) * 2, durable=True
+        )
+        writer = sink.writer('a')
+        writer.send([action(str(v)) for v in range(3)])
+        assert writer.acknowledged == 2
+        assert writer.wait() == 3
+        sink.close()
+        assert len(self.files()) == 2
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+
+import omero_marshal
+import pytest
+
+from omero.model import BooleanAnnotationI, ChannelI, CommentAnnotationI, \
+    DoubleAnnotationI, EventI, EventTypeI, ExperimenterI, \
+    ExperimenterGroupI, ImageI, LengthI, LogicalChannelI, LongAnnotationI, \
+    MapAnnotationI, NamedValue, PixelsI, TagAnnotationI, TermAnnotationI, \
+    TimeI, TimestampAnnotationI, WellI, WellSampleI, XmlAnnotationI
+from omero.model.enums import UnitsLength, UnitsTime
+from omero.rtypes import rbool, rdouble, rint, rlong, rstring, rtime
+
+from omero_es import prune
+from omero_es.document import WellDocument
+from omero_es.encoders import fast
+
+
+def set_details(obj):
+    owner = ExperimenterI(2L, True)
+    owner.omeName = rstring('jsmith')
+    group = ExperimenterGroupI(3L, True)
+    group.name = rstring('lab')
+    event = EventI(4L, True)
+    event.type = EventTypeI(5L, True)
+    event.type.value = rstring('Import')
+    obj.details.setOwner(owner)
+    obj.details.setGroup(group)
+    obj.details.setCreationEvent(event)
+    obj.details.setUpdateEvent(event)
+    return obj
+
+
+def annotations():
+    boolean = BooleanAnnotationI(1L, True)
+    boolean.boolValue = rbool(True)
+    comment = CommentAnnotationI(2L, True)
+    comment.textValue = rstring('comment')
+    comment.description = rstring('description')
+    double = DoubleAnnotationI(3L, True)
+    double.doubleValue = rdouble(1.5)
+    long_annotation = LongAnnotationI(4L, True)
+    long_annotation.longValue = rlong(42L)
+    map_annotation = MapAnnotationI(5L, True)
+    map_annotation.setMapValue([NamedValue('key', 'value')])
+    empty_map_annotation = MapAnnotationI(6L, True)
+    tag = TagAnnotationI(7L, True)
+    tag.textValue = rstring('tag')
+    tag.ns = rstring('namespace')
+    term = TermAnnotationI(8L, True)
+    term.termValue = rstring('term')
+    timestamp = TimestampAnnotationI(9L, True)
+    timestamp.timeValue = rtime(1000000L)
+    xml = XmlAnnotationI(10L, True)
+    xml.textValue = rstring('<xml/>')
+    return [
+        boolean, comment, double, long_annotation, map_annotation,
+        empty_map_annotation, tag, term, timestamp, xml
+    ]
+
+
+def image(_id):
+    image = set_details(ImageI(_id, True))
+    image.name = rstring('image %d' % _id)
+    image.description = rstring('description')
+    image.acquisitionDate = rtime(1000000L)
+    image.archived = rbool(False)
+    image.series = rint(0)
+    pixels = set_details(PixelsI(_id, True))
+    pixels.sizeX = rint(512)
+    pixels.sizeY = rint(512)
+    pixels.sizeZ = rint(10)
+    pixels.sizeC = rint(2)
+    pixels.sizeT = rint(1)
+    pixels.sha1 = rstring('sha1')
+    pixels.significantBits = rint(16)
+    pixels.physicalSizeX = LengthI(0.5, UnitsLength.MICROMETER)
+    pixels.physicalSizeY = LengthI(0.5, UnitsLength.MICROMETER)
+    pixels.timeIncrement = TimeI(1.0, UnitsTime.SECOND)
+    for i in range(2):
+        channel = set_details(ChannelI(_id * 2 + i, True))
+        channel.red = rint(255)
+        channel.green = rint(i * 255)
+        channel.blue = rint(0)
+        channel.alpha = rint(255)
+        logical_channel = LogicalChannelI(_id * 2 + i, True)
+        logical_channel.name = rstring('channel %d' % i)
+        logical_channel.emissionWave = LengthI(500 + i, UnitsLength.NANOMETER)
+        logical_channel.samplesPerPixel = rint(1)
+        channel.logicalChannel = logical_channel
+        channel.linkAnnotation(annotations()[0])
+        pixels.addChannel(channel)
+    image.addPixels(pixels)
+    for annotation in annotations():
+        image.linkAnnotation(annotation)
+    return image
+
+
+def well():
+    well = set_details(WellI(1L, True))
+    well.row = rint(0)
+    well.column = rint(1)
+    for i in range(3):
+        wellsample = set_details(WellSampleI(i + 1L, True))
+        wellsample.image = image(i + 1L)
+        well.addWellSample(wellsample)
+    for annotation in annotations():
+        well.linkAnnotation(annotation)
+    return well
+
+
+def encode(obj):
+    encoder = omero_marshal.get_encoder(obj.__class__)
+    return json.dumps(encoder.encode(obj), sort_keys=True)
+
+
+class TestFastEncoders(object):
+    """
+    The fast encoders must produce output identical to the encoders they
+    replace.
+    """
+
+    @pytest.fixture(autouse=True)
+    def restore_encoders(self, request):
+        encoders = dict(omero_marshal.ENCODERS)
+
+        def restore():
+            omero_marshal.ENCODERS.clear()
+            omero_marshal.ENCODERS.update(encoders)
+        request.addfinalizer(restore)
+
+    def assert_identical(self, create, pruner=None):
+        expected = create()
+        actual = create()
+        if pruner is not None:
+            pruner.prune(expected)
+            pruner.prune(actual)
+        expected = encode(expected)
+        fast.install()
+        assert encode(actual) == expected
+
+    @pytest.mark.parametrize('index', range(len(annotations())))
+    def test_annotation(self, index):
+        self.assert_identical(lambda: annotations()[index])
+
+    def test_image(self):
+        self.assert_identical(lambda: image(1L))
+
+    def test_pruned_image(self):
+        self.assert_identical(lambda: image(1L), prune.IMAGE)
+
+    def test_pruned_well(self):
+        self.assert_identical(well, prune.WELL)
+
+    def test_well_document(self):
+        expected = WellDocument(None, well()).source
+        fast.install()
+        assert WellDocument(None, well()).source == expected
+
+    def test_install_is_idempotent(self):
+        fast.install()
+        encoder = omero_marshal.ENCODERS[ImageI]
+        fast.install()
+        assert omero_marshal.ENCODERS[ImageI] is encoder
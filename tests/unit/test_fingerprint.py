@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+
+import pytest
+
+from omero_es import bulk, fingerprint
+from omero_es.fingerprint import FingerprintStore
+from omero_es.serializer import delete_action, index_action
+
+
+def action(_id, value=1, index='omero'):
+    return index_action(
+        index, 'image', _id, '1', json.dumps({'value': value})
+    )
+
+
+class Elasticsearch(object):
+    """
+    Answers each action with the status of its id in `statuses`, created
+    by default.
+    """
+
+    def __init__(self, statuses=dict()):
+        self.statuses = statuses
+
+    def bulk(self, body):
+        items = list()
+        for line in body.splitlines():
+            if line.startswith('{"index"') or line.startswith('{"delete"'):
+                op, metadata = json.loads(line).items()[0]
+                items.append({op: {
+                    '_id': metadata['_id'],
+                    'status': self.statuses.get(metadata['_id'], 201)
+                }})
+        return {'items': items}
+
+
+class TestFingerprint(object):
+
+    def test_key(self):
+        key, digest = fingerprint.fingerprint(action('2'))
+        assert key == 'omero/image/2/1'
+        assert len(digest) == 20
+
+    def test_container_key(self):
+        key, digest = fingerprint.fingerprint(
+            index_action('omero', 'project', '2', None, '{}')
+        )
+        assert key == 'omero/project/2/'
+
+    def test_digest_covers_source(self):
+        assert fingerprint.fingerprint(action('2', 1)) != \
+            fingerprint.fingerprint(action('2', 2))
+
+    def test_delete(self):
+        assert fingerprint.fingerprint(
+            delete_action('omero', 'image', '2', '1')
+        ) == ('omero/image/2/1', None)
+
+
+class TestFingerprintStore(object):
+    """
+    Actions are only dropped once the fingerprint of the same action has
+    been recorded.
+    """
+
+    @pytest.fixture(autouse=True)
+    def create_store(self, request, tmpdir):
+        self.path = str(tmpdir.join('fingerprints.db'))
+        self.store = FingerprintStore(self.path)
+        request.addfinalizer(self.store.close)
+
+    def test_check(self):
+        expected = self.store.check(action('2'))
+        assert expected is not None
+        # Not recorded yet
+        assert self.store.check(action('2')) == expected
+        self.store.record([expected])
+        assert self.store.check(action('2')) is None
+        assert self.store.check(action('2', 2)) is not None
+        assert (self.store.hits, self.store.misses) == (1, 3)
+
+    def test_deletes_are_always_sent(self):
+        delete = delete_action('omero', 'image', '2', '1')
+        self.store.record([self.store.check(delete)])
+        assert self.store.check(delete) == ('omero/image/2/1', None)
+
+    def test_delete_forgets(self):
+        self.store.record([self.store.check(action('2'))])
+        self.store.record([
+            self.store.check(delete_action('omero', 'image', '2', '1'))
+        ])
+        assert self.store.check(action('2')) is not None
+
+    def test_shared(self):
+        self.store.record([self.store.check(action('2'))])
+        other = FingerprintStore(self.path)
+        try:
+            assert other.check(action('2')) is None
+        finally:
+            other.close()
+
+    def test_vacuum_forgets_index(self):
+        self.store.record([
+            self.store.check(action('2')),
+            self.store.check(action('2', index='other')),
+        ])
+        fingerprint.vacuum(self.path, ['other'])
+        assert self.store.check(action('2')) is None
+        assert self.store.check(action('2', index='other')) is not None
+
+
+class TestSink(object):
+    """
+    The sink records the fingerprints of the actions Elasticsearch
+    indexed, and only those.
+    """
+
+    @pytest.fixture(autouse=True)
+    def create_store(self, request, tmpdir):
+        self.store = FingerprintStore(str(tmpdir.join('fingerprints.db')))
+        self.sinks = list()
+
+        def close():
+            for sink in self.sinks:
+                sink.close()
+        request.addfinalizer(close)
+
+    def create_sink(self, statuses=dict()):
+        sink = bulk.Sink(
+            Elasticsearch(statuses), target_latency=None,
+            fingerprints=self.store
+        )
+        self.sinks.append(sink)
+        return sink
+
+    def test_unchanged_are_dropped(self):
+        writer = self.create_sink().writer('a')
+        assert writer.send([action('2'), action('3')]) == 2
+        assert writer.wait() == 2
+        writer = self.create_sink().writer('b')
+        assert writer.send([action('2'), action('3', 2)]) == 2
+        assert writer.wait() == 1
+        assert writer.skipped == 1
+
+    def test_failed_are_not_recorded(self):
+        writer = self.create_sink({'3': 400}).writer('a')
+        writer.send([action('2'), action('3')])
+        with pytest.raises(bulk.BulkIndexError):
+            writer.wait()
+        assert self.store.check(action('2')) is None
+        assert self.store.check(action('3')) is not None
+
+    def test_conflicts_are_not_recorded(self):
+        sink = self.create_sink({'2': bulk.CONFLICT})
+        sink.es.mget = lambda body: {'docs': [{'found': False}]}
+        writer = sink.writer('a')
+        writer.send([action('2')])
+        with pytest.raises(bulk.BulkIndexError):
+            writer.wait()
+        assert self.store.check(action('2')) is not None
+
+    def test_recorded_before_wait(self):
+        sink = self.create_sink()
+        writer = sink.writer('a')
+        writer.send([action('2')])
+        sink.flush()
+        # Recorded as the bulk response is handled, not by `wait()`
+        with writer.condition:
+            while writer.acknowledged < 1:
+                writer.condition.wait(0.1)
+        assert self.store.check(action('2')) is None
+
+    def test_deletes_forget(self):
+        writer = self.create_sink().writer('a')
+        writer.send([action('2')])
+        writer.wait()
+        writer.send([delete_action('omero', 'image', '2', '1')])
+        writer.wait()
+        assert self.store.check(action('2')) is not None
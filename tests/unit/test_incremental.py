@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import os
+
+import pytest
+
+from omero.rtypes import rlong
+
+from omero_es import incremental
+
+
+class QueryService(object):
+    """
+    Answers each query with its `(key, row)` results; the rows whose key
+    is in the `ids` parameter, or all of them for changes `since`.
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def projection(self, query, params, ctx):
+        results = self.results.get(query, ())
+        if 'ids' in params.map:
+            ids = set([v.val for v in params.map['ids'].val])
+            results = [v for v in results if v[0] in ids]
+        return [[rlong(v) for v in row] for _, row in results]
+
+
+# Project:10 contains Dataset:2 which contains Images 1 and 3; Image:4 is
+# in Dataset:5 which is in no Project yet
+RESULTS = {
+    incremental.QUERY_IMAGE_PROJECTS: [(1L, (10L, 1L)), (3L, (10L, 3L))],
+    incremental.QUERY_DATASET_IMAGES: [
+        (2L, (10L, 1L)), (2L, (10L, 3L)), (5L, (11L, 4L)),
+    ],
+    incremental.QUERY_DATASET_PROJECTS: [(2L, (10L,))],
+    # Image:6 is in Well:20 of Plate:30 which is in Screen:40
+    incremental.QUERY_IMAGE_WELLS: [(6L, (30L, 20L))],
+    incremental.QUERY_WELL_PLATES: [(20L, (30L, 20L))],
+    incremental.QUERY_SCREEN_PLATES: [(40L, (30L,))],
+}
+
+
+def plan(**changes):
+    return incremental.plan(QueryService(RESULTS), changes)
+
+
+class TestPlan(object):
+    """
+    Changes are resolved to the tasks that re-index the documents they
+    affect, or only update their annotations.
+    """
+
+    def test_image(self):
+        assert plan(Image=set([1L])) == {('ProjectImages', (10L, (1L,))): 1}
+
+    def test_image_in_well(self):
+        assert plan(Image=set([6L])) == {('PlateWells', (30L, (20L,))): 1}
+
+    def test_project(self):
+        assert plan(Project=set([10L])) == {('ProjectParent', 10L): 1}
+
+    def test_dataset(self):
+        assert plan(Dataset=set([2L])) == {('ProjectParent', 10L): 1}
+
+    def test_dataset_link(self):
+        # Dataset:5 linked to Project:11 brings its Images
+        assert plan(ProjectDatasetLink=set([(11L, 5L)])) == {
+            ('ProjectParent', 11L): 1,
+            ('ProjectImages', (11L, (4L,))): 1,
+        }
+
+    def test_image_link(self):
+        assert plan(DatasetImageLink=set([(2L, 3L)])) == {
+            ('ProjectImages', (10L, (3L,))): 1
+        }
+
+    def test_screen(self):
+        assert plan(Screen=set([40L])) == {('PlateParent', 30L): 1}
+
+    def test_well(self):
+        assert plan(Well=set([20L])) == {('PlateWells', (30L, (20L,))): 1}
+
+    def test_annotations(self):
+        assert plan(
+            ProjectAnnotations=set([10L]), ImageAnnotations=set([1L, 3L])
+        ) == {
+            ('ProjectAnnotations', (10L,)): 1,
+            ('ImageAnnotations', (1L, 3L)): 2,
+        }
+
+    def test_annotations_reindexed(self):
+        # The re-indexed documents have up to date annotations
+        assert plan(
+            Project=set([10L]), ProjectAnnotations=set([10L]),
+            Image=set([1L]), ImageAnnotations=set([1L, 3L])
+        ) == {
+            ('ProjectParent', 10L): 1,
+            ('ProjectImages', (10L, (1L,))): 1,
+            ('ImageAnnotations', (3L,)): 1,
+        }
+
+    def test_image_in_well_annotations(self):
+        # Images are nested in Well documents, which are re-indexed
+        estimates = plan(ImageAnnotations=set([6L]))
+        assert estimates[('PlateWells', (30L, (20L,)))] == 1
+
+    def test_batches(self, monkeypatch):
+        monkeypatch.setattr(incremental, 'BATCH_SIZE', 1)
+        assert plan(Image=set([1L, 3L]), WellAnnotations=set([7L, 8L])) == {
+            ('ProjectImages', (10L, (1L,))): 1,
+            ('ProjectImages', (10L, (3L,))): 1,
+            ('WellAnnotations', (7L,)): 1,
+            ('WellAnnotations', (8L,)): 1,
+        }
+
+    def test_no_changes(self):
+        assert plan() == {}
+
+
+class TestFindChangesSince(object):
+
+    def test_changes(self):
+        query_service = QueryService({
+            incremental.QUERY_CHANGED % 'Image': [(None, (1L,))],
+            incremental.QUERY_CHANGED % 'Well': [(None, (20L,))],
+            incremental.QUERY_CHANGED_ANNOTATIONS % 'Dataset':
+                [(None, (2L,))],
+            incremental.QUERY_CHANGED_ANNOTATIONS % 'Image':
+                [(None, (3L,))],
+            incremental.QUERY_CHANGED_LINKS % 'DatasetImageLink':
+                [(None, (2L, 3L))],
+            incremental.QUERY_CHANGED_WELL_SAMPLES: [(None, (21L,))],
+        })
+        changes = incremental.find_changes_since(query_service, 100L)
+        assert changes['Image'] == set([1L])
+        assert changes['Well'] == set([20L, 21L])
+        # Changes to the annotations of Datasets change their Projects'
+        # documents
+        assert changes['Dataset'] == set([2L])
+        assert changes['ImageAnnotations'] == set([3L])
+        assert changes['DatasetImageLink'] == set([(2L, 3L)])
+        assert changes['Project'] == set()
+
+
+class TestWatermark(object):
+    """
+    The watermark is replaced atomically and incremental runs start
+    `OVERLAP` Events before it.
+    """
+
+    @pytest.fixture(autouse=True)
+    def path(self, tmpdir):
+        self.path = str(tmpdir.join('watermark.json'))
+
+    def test_missing(self):
+        assert incremental.read_watermark(self.path) is None
+
+    def test_write(self):
+        incremental.write_watermark(self.path, 25000L)
+        assert incremental.read_watermark(self.path) == 25000L
+        assert not os.path.exists(self.path + '.tmp')
+
+    def test_replace(self):
+        incremental.write_watermark(self.path, 25000L)
+        incremental.write_watermark(self.path, 30000L)
+        assert incremental.read_watermark(self.path) == 30000L
+
+    @pytest.mark.parametrize('event_id,overlap,since', [
+        (25000L, incremental.OVERLAP, 25000L - incremental.OVERLAP),
+        (incremental.OVERLAP - 1, incremental.OVERLAP, 0),
+        (25000L, 0, 25000L),
+    ])
+    def test_since(self, event_id, overlap, since):
+        assert incremental.since_watermark(event_id, overlap) == since
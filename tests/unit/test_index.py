@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import omero
+import pytest
+
+from omero_es import index
+
+
+class PermissionDenied(Exception):
+    pass
+
+
+class Client(object):
+    """
+    An OMERO client whose credentials are always refused.
+    """
+
+    def __init__(self, server, port):
+        pass
+
+    def createSession(self, username, password):
+        raise PermissionDenied('Bad password')
+
+
+class TestWorker(object):
+    """
+    A pool worker that fails to initialize fails each of its tasks rather
+    than raising, which would have the pool start new workers forever.
+    """
+
+    @pytest.fixture(autouse=True)
+    def refuse_sessions(self, request, monkeypatch):
+        monkeypatch.setattr(omero, 'client', Client)
+        request.addfinalizer(index._worker.clear)
+
+    def test_login_failure(self):
+        index.init_worker(
+            'localhost', 4064, 'root', 'secret', None, 'omero',
+            dict(index.SETTINGS)
+        )
+        assert index.work(('Project', 1L)) == (
+            'Project', 1L, 0, 0, 'PermissionDenied: Bad password', 0
+        )
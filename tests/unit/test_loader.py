@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import pytest
+
+from omero.model import ChannelI, DatasetI, DatasetImageLinkI, EventI, \
+    EventTypeI, ExperimenterI, ExperimenterGroupI, ImageI, \
+    LogicalChannelI, PixelsI, TagAnnotationI, WellI, WellSampleI
+from omero.rtypes import rint, rlong, rstring
+
+from omero_es import cache, loader, prune
+from omero_es.document import ImageDocument, WellDocument
+from omero_es.loader import JoinFetchLoader, NarrowLoader
+
+
+def set_details(obj, event_id):
+    owner = ExperimenterI(2L, True)
+    owner.omeName = rstring('jsmith')
+    event = EventI(event_id, True)
+    event.type = EventTypeI(5L, True)
+    event.type.value = rstring('Import')
+    obj.details.setOwner(owner)
+    # Only JOIN FETCHed by `JoinFetchLoader`; see `group()`
+    obj.details.setGroup(ExperimenterGroupI(3L, False))
+    obj.details.setCreationEvent(event)
+    obj.details.setUpdateEvent(event)
+    return obj
+
+
+def group():
+    group = ExperimenterGroupI(3L, True)
+    group.name = rstring('lab')
+    return group
+
+
+def image():
+    image = set_details(ImageI(1L, True), 10L)
+    image.name = rstring('image')
+    return image
+
+
+def pixels():
+    pixels = set_details(PixelsI(1L, True), 11L)
+    pixels.sizeX = rint(512)
+    channel = set_details(ChannelI(1L, True), 12L)
+    logical_channel = set_details(LogicalChannelI(1L, True), 12L)
+    logical_channel.name = rstring('channel')
+    channel.logicalChannel = logical_channel
+    pixels.addChannel(channel)
+    return pixels
+
+
+def tag(_id=7L, event_id=13L):
+    tag = set_details(TagAnnotationI(_id, True), event_id)
+    tag.textValue = rstring('tag %d' % _id)
+    return tag
+
+
+def well():
+    well = set_details(WellI(1L, True), 16L)
+    well.row = rint(0)
+    well.column = rint(1)
+    return well
+
+
+def wellsample():
+    return set_details(WellSampleI(1L, True), 15L)
+
+
+# Id and update event id of the link between the Image and its tag; the
+# latest update of the graph
+LINK = (5L, 20L)
+
+# Id and update event id of the link between the Well and its tag, and
+# the tag's id and update event id
+WELL_LINK = (6L, 21L)
+
+WELL_TAG = (8L, 14L)
+
+
+class QueryService(object):
+    """
+    Answers each query with the objects, or rows, created by the function
+    in `results` for it.
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def findAllByQuery(self, query, params, ctx):
+        return self.results[query]()
+
+    def projection(self, query, params, ctx):
+        return self.results[query]()
+
+
+def link_annotation(obj, annotation, link_key):
+    link = obj.linkAnnotation(annotation)
+    link.setId(rlong(link_key[0]))
+    link.details.setUpdateEvent(EventI(link_key[1], False))
+
+
+def join_image():
+    obj = image()
+    obj.addPixels(pixels())
+    link_annotation(obj, tag(), LINK)
+    return obj
+
+
+def join_images():
+    obj = join_image()
+    obj.details.setGroup(group())
+    obj.linkDataset(DatasetI(2L, False))
+    return [obj]
+
+
+def join_wells():
+    obj = well()
+    obj.details.setGroup(group())
+    _wellsample = wellsample()
+    _wellsample.image = join_image()
+    obj.addWellSample(_wellsample)
+    link_annotation(obj, tag(*WELL_TAG), WELL_LINK)
+    return [obj]
+
+
+def dataset_image_links():
+    link = DatasetImageLinkI(8L, True)
+    link.setParent(DatasetI(2L, False))
+    link.setChild(ImageI(1L, False))
+    return [link]
+
+
+def narrow_pixels():
+    obj = pixels()
+    obj.image = ImageI(1L, False)
+    return [obj]
+
+
+def image_annotation_link_keys():
+    return [[rlong(v) for v in (LINK[0], 1L, 7L, 13L, LINK[1])]]
+
+
+def well_annotation_link_keys():
+    return [[rlong(v) for v in (WELL_LINK[0], 1L) + WELL_TAG + WELL_LINK[1:]]]
+
+
+def well_samples():
+    obj = wellsample()
+    obj.well = WellI(1L, False)
+    obj.image = image()
+    return [obj]
+
+
+JOIN_IMAGES = {
+    loader.QUERY_PROJECT_IMAGES: join_images,
+}
+
+NARROW_IMAGES = {
+    loader.QUERY_IMAGES_CORE: lambda: [image()],
+    loader.QUERY_DATASET_IMAGE_LINKS: dataset_image_links,
+    loader.QUERY_PIXELS: narrow_pixels,
+    loader.QUERY_ANNOTATION_LINK_KEYS % 'ImageAnnotationLink':
+        image_annotation_link_keys,
+    loader.QUERY_ANNOTATIONS: lambda: [tag()],
+    loader.QUERY_GROUPS: lambda: [group()],
+}
+
+JOIN_WELLS = {
+    loader.QUERY_WELLS: join_wells,
+}
+
+NARROW_WELLS = {
+    loader.QUERY_WELLS_CORE: lambda: [well()],
+    loader.QUERY_WELL_SAMPLES: well_samples,
+    loader.QUERY_PIXELS: narrow_pixels,
+    loader.QUERY_ANNOTATION_LINK_KEYS % 'ImageAnnotationLink':
+        image_annotation_link_keys,
+    loader.QUERY_ANNOTATION_LINK_KEYS % 'WellAnnotationLink':
+        well_annotation_link_keys,
+    loader.QUERY_ANNOTATIONS: lambda: [tag(), tag(*WELL_TAG)],
+    loader.QUERY_GROUPS: lambda: [group()],
+}
+
+
+class TestLoaders(object):
+    """
+    Both loaders load the same graphs from the same rows.
+    """
+
+    @pytest.fixture(autouse=True)
+    def disable_cache(self, request):
+        cache.annotations.resize(0)
+
+        def restore():
+            cache.annotations.resize(cache.DEFAULT_SIZE)
+        request.addfinalizer(restore)
+
+    def load_images(self, loader, results):
+        return loader.load_images(QueryService(results), 1L, [1L])
+
+    def load_wells(self, loader, results):
+        return loader.load_wells(QueryService(results), [1L])
+
+    def test_image_version(self):
+        join = self.load_images(JoinFetchLoader(), JOIN_IMAGES)
+        narrow = self.load_images(NarrowLoader(), NARROW_IMAGES)
+        assert len(join) == len(narrow) == 1
+        assert prune.IMAGE.prune(join[0]) == LINK[1]
+        assert prune.IMAGE.prune(narrow[0]) == LINK[1]
+
+    def test_image_document(self):
+        join = self.load_images(JoinFetchLoader(), JOIN_IMAGES)
+        narrow = self.load_images(NarrowLoader(), NARROW_IMAGES)
+        join = ImageDocument(None, join[0], 2L)
+        narrow = ImageDocument(None, narrow[0], 2L)
+        assert narrow.source == join.source
+        assert narrow.version == join.version
+
+    def test_well_document(self):
+        join = self.load_wells(JoinFetchLoader(), JOIN_WELLS)
+        narrow = self.load_wells(NarrowLoader(), NARROW_WELLS)
+        assert len(join) == len(narrow) == 1
+        join = WellDocument(None, join[0])
+        narrow = WellDocument(None, narrow[0])
+        assert narrow.source == join.source
+        assert narrow.version == join.version == WELL_LINK[1]
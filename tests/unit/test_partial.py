@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+
+import pytest
+
+from omero.rtypes import rlong
+
+from omero_es import bulk, partial
+
+
+class QueryService(object):
+    """
+    Answers each projection query with the rows in `results` for it.
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def projection(self, query, params, ctx):
+        ids = set([v.val for v in params.map['ids'].val])
+        return [
+            [rlong(v) for v in row] for row in self.results[query]
+            if row[0] in ids
+        ]
+
+
+class Client(object):
+
+    def __init__(self, results):
+        self.query_service = QueryService(results)
+
+    def getSession(self):
+        return self
+
+    def getQueryService(self):
+        return self.query_service
+
+
+class Elasticsearch(object):
+    """
+    Answers updates of documents with ids in `missing` as Elasticsearch
+    does when the document does not exist.
+    """
+
+    def __init__(self, missing):
+        self.missing = missing
+        self.updates = list()
+
+    def bulk(self, body):
+        items = list()
+        lines = body.splitlines()
+        for metadata, source in zip(lines[::2], lines[1::2]):
+            op, metadata = json.loads(metadata).items()[0]
+            _id = str(metadata['_id'])
+            self.updates.append((_id, json.loads(source)))
+            result = {'_id': _id, 'status': 200}
+            if _id in self.missing:
+                result['status'] = 404
+                result['error'] = {'type': bulk.DOCUMENT_MISSING}
+            items.append({op: result})
+        return {'items': items}
+
+
+class TestPartialDocument(object):
+
+    def test_annotations(self):
+        assert partial.partial_document([{'@id': 1}]) == {
+            'doc': {'Annotations': [{'@id': 1}]}
+        }
+
+    def test_no_annotations(self):
+        # Fully encoded documents have no `Annotations` at all
+        assert partial.partial_document([]) == partial.REMOVE_ANNOTATIONS
+
+
+class TestUpdateAnnotations(object):
+    """
+    Annotations are updated in place and documents that do not exist yet
+    are indexed in full rather than failed.
+    """
+
+    @pytest.fixture(autouse=True)
+    def create_sink(self, request, monkeypatch, tmpdir):
+        def encode_annotations(query_service, kind, ids):
+            return dict([(v, [{'@id': v}] if v % 2 else []) for v in ids])
+        monkeypatch.setattr(partial, 'encode_annotations', encode_annotations)
+        self.path = str(tmpdir.join('dead.json'))
+        self.indexed = list()
+        self.sink = None
+
+        def close():
+            if self.sink is not None:
+                self.sink.close()
+        request.addfinalizer(close)
+
+    def fallback(self, writer, index, client, task, settings):
+        self.indexed.append(task)
+        if isinstance(task, tuple):
+            return len(task[1])
+        return 1
+
+    def update(self, kind, rows, ids, missing=()):
+        self.es = Elasticsearch(missing)
+        self.sink = bulk.Sink(
+            self.es, target_latency=None,
+            dead_letters=bulk.DeadLetters(self.path)
+        )
+        writer = self.sink.writer('a')
+        query = partial.DOCUMENTS[kind][1]
+        return partial.update_annotations(
+            writer, 'omero', Client({query: rows}), kind, ids,
+            self.fallback, dict()
+        )
+
+    def test_update(self):
+        assert self.update('Project', [(1L,), (2L,)], [1L, 2L, 3L]) == 2
+        assert sorted(self.es.updates) == [
+            ('1', {'doc': {'Annotations': [{'@id': 1}]}}),
+            ('2', partial.REMOVE_ANNOTATIONS),
+        ]
+        assert self.indexed == []
+
+    def test_image_documents(self):
+        # Image:1 is in two Datasets of Project:10
+        rows = [(1L, 10L, 5L), (1L, 10L, 6L), (2L, 11L, 7L)]
+        assert self.update('Image', rows, [1L, 2L]) == 3
+        assert sorted([v[0] for v in self.es.updates]) == \
+            ['5_1', '6_1', '7_2']
+
+    def test_missing_container(self):
+        count = self.update('Plate', [(1L,), (2L,)], [1L, 2L], ['2'])
+        assert count == 2
+        assert self.indexed == [2L]
+        # Not failures
+        assert list(bulk.read_actions(self.path)) == []
+
+    def test_missing_children(self):
+        rows = [(1L, 10L), (2L, 10L), (3L, 10L), (4L, 11L)]
+        count = self.update('Well', rows, [1L, 2L, 3L, 4L], ['3', '1'])
+        assert count == 4
+        assert self.indexed == [(10L, [1L, 3L])]
+        assert list(bulk.read_actions(self.path)) == []
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import pytest
+
+from omero_es.pipeline import Pipeline
+
+
+class Failure(Exception):
+    pass
+
+
+def fail(item):
+    raise Failure(item)
+
+
+def failing_source(count):
+    for i in range(count):
+        yield i
+    raise Failure('source')
+
+
+class TestPipeline(object):
+    """
+    Items flow through every stage in order to the sink and the first
+    failure, wherever it happens, is raised by `run()` without hanging.
+    """
+
+    def test_stages(self):
+        pipeline = Pipeline('test', maxsize=2)
+        pipeline.stage('double', lambda v: [v * 2])
+        pipeline.stage('split', lambda v: [v, v + 1])
+        assert pipeline.run(range(3), list) == [0, 1, 2, 3, 4, 5]
+
+    def test_stage_drops_items(self):
+        pipeline = Pipeline('test')
+        pipeline.stage('even', lambda v: [v] if v % 2 == 0 else [])
+        assert pipeline.run(range(10), list) == [0, 2, 4, 6, 8]
+
+    def test_threads(self):
+        pipeline = Pipeline('test', maxsize=1)
+        pipeline.stage('square', lambda v: [v * v], threads=4)
+        assert sorted(pipeline.run(range(100), list)) == [
+            v * v for v in range(100)
+        ]
+
+    def test_no_stages(self):
+        assert Pipeline('test').run(iter('abc'), list) == ['a', 'b', 'c']
+
+    def test_empty_source(self):
+        pipeline = Pipeline('test')
+        pipeline.stage('identity', lambda v: [v], threads=2)
+        assert pipeline.run([], list) == []
+
+    def test_source_failure(self):
+        pipeline = Pipeline('test', maxsize=1)
+        pipeline.stage('identity', lambda v: [v])
+        with pytest.raises(Failure) as e:
+            pipeline.run(failing_source(10), list)
+        assert e.value.args == ('source',)
+
+    @pytest.mark.parametrize('threads', [1, 3])
+    def test_stage_failure(self, threads):
+        pipeline = Pipeline('test', maxsize=1)
+        pipeline.stage('identity', lambda v: [v])
+        pipeline.stage('fail', fail, threads=threads)
+        with pytest.raises(Failure):
+            # More items than the queues hold so that the source blocks
+            pipeline.run(range(100), list)
+
+    def test_sink_failure(self):
+        def sink(items):
+            for item in items:
+                raise Failure(item)
+        pipeline = Pipeline('test', maxsize=1)
+        pipeline.stage('identity', lambda v: [v])
+        with pytest.raises(Failure) as e:
+            pipeline.run(range(100), sink)
+        assert e.value.args == (0,)
+
+    def test_first_failure_is_raised(self):
+        pipeline = Pipeline('test', maxsize=1)
+        pipeline.stage('fail', fail)
+        with pytest.raises(Failure) as e:
+            pipeline.run(failing_source(100), list)
+        assert e.value.args == (0,)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+from omero.rtypes import rlong
+
+from omero_es import planning
+from omero_es.document import QUERY_IMAGE_COUNTS
+
+
+class TestSchedule(object):
+    """
+    Tasks are handed out longest first and the loads are those of the
+    resulting LPT bin packing.
+    """
+
+    def test_longest_first(self):
+        estimates = {
+            ('Project', 1L): 10, ('Project', 2L): 30, ('Screen', 3L): 20,
+        }
+        tasks, loads = planning.schedule(estimates, 2)
+        assert tasks == [('Project', 2L), ('Screen', 3L), ('Project', 1L)]
+        assert loads == [30, 30]
+
+    def test_more_workers_than_tasks(self):
+        tasks, loads = planning.schedule({('Project', 1L): 10}, 3)
+        assert tasks == [('Project', 1L)]
+        assert loads == [10, 0, 0]
+
+    def test_no_tasks(self):
+        assert planning.schedule(dict(), 2) == ([], [0, 0])
+
+    def test_loads_sum_to_estimates(self):
+        estimates = dict([(('Project', long(v)), v) for v in range(1, 20)])
+        tasks, loads = planning.schedule(estimates, 4)
+        assert sorted(tasks) == sorted(estimates)
+        assert sum(loads) == sum(estimates.values())
+        # No worker is left with more than the largest task above another
+        assert loads[0] - loads[-1] <= max(estimates.values())
+
+
+class QueryService(object):
+    """
+    Returns canned projection rows by query and `id` parameter.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def projection(self, query, params, ctx):
+        return [
+            [rlong(v) for v in row]
+            for row in self.rows[(query, params.map['id'].val)]
+        ]
+
+
+class Client(object):
+
+    def __init__(self, rows):
+        self.query_service = QueryService(rows)
+
+    def getSession(self):
+        return self
+
+    def getQueryService(self):
+        return self.query_service
+
+
+class TestSplit(object):
+    """
+    Containers estimated to produce more than the shard size are split
+    into shards of at most that many documents, each with the parent task
+    to run once they are all complete.
+    """
+
+    def test_small_tasks_are_not_split(self):
+        estimates = {('Project', 1L): 10, ('Screen', 2L): 10}
+        assert planning.split(Client(dict()), estimates, 10) == (
+            estimates, dict()
+        )
+
+    def test_project(self):
+        client = Client({
+            (QUERY_IMAGE_COUNTS, 1L): [(13L, 25L), (11L, 4L), (12L, 4L)],
+            (planning.QUERY_DATASET_IMAGE_IDS, 13L): [
+                (v,) for v in range(100L, 125L)
+            ],
+        })
+        estimates, parents = planning.split(
+            client, {('Project', 1L): 33, ('Project', 2L): 5}, 10
+        )
+        assert estimates == {
+            ('ProjectShard', (1L, (11L, 12L), None, None)): 8,
+            ('ProjectShard', (1L, (13L,), 100L, 109L)): 10,
+            ('ProjectShard', (1L, (13L,), 110L, 119L)): 10,
+            ('ProjectShard', (1L, (13L,), 120L, 124L)): 5,
+            ('Project', 2L): 5,
+        }
+        assert parents == dict([
+            (v, ('ProjectParent', 1L)) for v in estimates
+            if v[0] == 'ProjectShard'
+        ])
+
+    def test_screen(self):
+        client = Client({
+            (planning.QUERY_PLATE_WELL_COUNTS, 1L): [(21L, 5L), (22L, 15L)],
+            (planning.QUERY_PLATE_WELL_IDS, 22L): [
+                (v,) for v in range(200L, 215L)
+            ],
+        })
+        estimates, parents = planning.split(
+            client, {('Screen', 1L): 20}, 10
+        )
+        assert estimates == {
+            ('PlateShard', (21L, None, None)): 5,
+            ('PlateShard', (22L, 200L, 209L)): 10,
+            ('PlateShard', (22L, 210L, 214L)): 5,
+        }
+        assert parents == {
+            ('PlateShard', (21L, None, None)): ('PlateParent', 21L),
+            ('PlateShard', (22L, 200L, 209L)): ('PlateParent', 22L),
+            ('PlateShard', (22L, 210L, 214L)): ('PlateParent', 22L),
+        }
+
+    def test_empty_plate(self):
+        client = Client({
+            (planning.QUERY_PLATE_WELL_COUNTS, 1L): [(21L, 15L), (22L, 0L)],
+            (planning.QUERY_PLATE_WELL_IDS, 21L): [
+                (v,) for v in range(200L, 215L)
+            ],
+        })
+        estimates, parents = planning.split(
+            client, {('Screen', 1L): 17}, 10
+        )
+        # Its shard has no Wells but its parent task writes its document
+        assert estimates[('PlateShard', (22L, None, None))] == 0
+        assert parents[('PlateShard', (22L, None, None))] == \
+            ('PlateParent', 22L)
+        assert 'LEFT OUTER JOIN plate.wells' in \
+            planning.QUERY_PLATE_WELL_COUNTS
+
+    def test_empty_container_is_not_split(self):
+        client = Client({(QUERY_IMAGE_COUNTS, 1L): []})
+        estimates = {('Project', 1L): 20}
+        assert planning.split(client, estimates, 10) == (estimates, dict())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+from omero.model import Annotation, ChannelI, DatasetI, EventI, \
+    ExperimenterI, ExperimenterGroupI, ImageI, PixelsI, PlateI, ProjectI, \
+    ScreenI, TagAnnotationI
+
+from omero_es import prune
+from omero_es.prune import Pruner
+
+
+def set_details(obj, event_id):
+    obj.details.setOwner(ExperimenterI(2L, True))
+    obj.details.setGroup(ExperimenterGroupI(3L, True))
+    obj.details.setUpdateEvent(EventI(event_id, True))
+    return obj
+
+
+def image():
+    image = set_details(ImageI(1L, True), 10L)
+    pixels = set_details(PixelsI(1L, True), 11L)
+    channel = set_details(ChannelI(1L, True), 12L)
+    pixels.addChannel(channel)
+    image.addPixels(pixels)
+    # Only the first Pixels are walked
+    image.addPixels(set_details(PixelsI(2L, True), 99L))
+    image.linkAnnotation(set_details(TagAnnotationI(1L, True), 13L))
+    return image
+
+
+class TestPruner(object):
+    """
+    The graph is walked once from the root along the edges of the rules;
+    everything reached but the root has its details unloaded and the
+    latest update event of all of them is returned.
+    """
+
+    def test_version(self):
+        assert prune.IMAGE.prune(image()) == 13L
+
+    def test_root_keeps_details(self):
+        obj = image()
+        prune.IMAGE.prune(obj)
+        assert obj.getDetails().getOwner().id.val == 2L
+
+    def test_unloads_details(self):
+        obj = image()
+        prune.IMAGE.prune(obj)
+        pixels = obj.getPrimaryPixels()
+        assert pixels.getDetails() is None
+        assert pixels.copyChannels()[0].getDetails() is None
+        assert obj.copyAnnotationLinks()[0].child.getDetails() is None
+
+    def test_first_only(self):
+        obj = image()
+        prune.IMAGE.prune(obj)
+        assert obj.copyPixels()[1].getDetails() is not None
+
+    def test_links_keep_details(self):
+        obj = image()
+        obj.copyAnnotationLinks()[0].details.setUpdateEvent(
+            EventI(14L, True)
+        )
+        assert prune.IMAGE.prune(obj) == 14L
+        assert obj.copyAnnotationLinks()[0].getDetails() is not None
+
+    def test_unloaded_objects_are_skipped(self):
+        obj = set_details(ImageI(1L, True), 10L)
+        obj.linkAnnotation(TagAnnotationI(1L, False))
+        assert prune.IMAGE.prune(obj) == 10L
+
+    def test_shared_objects_are_visited_once(self):
+        obj = image()
+        tag = obj.copyAnnotationLinks()[0].child
+        obj.getPrimaryPixels().copyChannels()[0].linkAnnotation(tag)
+        assert prune.IMAGE.prune(obj) == 13L
+        assert tag.getDetails() is None
+
+    def test_project(self):
+        project = set_details(ProjectI(1L, True), 10L)
+        dataset = set_details(DatasetI(1L, True), 11L)
+        dataset.linkAnnotation(set_details(TagAnnotationI(1L, True), 12L))
+        project.linkDataset(dataset)
+        assert prune.PROJECT.prune(project) == 12L
+        assert project.getDetails() is not None
+        assert dataset.getDetails() is None
+
+    def test_plate(self):
+        plate = set_details(PlateI(1L, True), 10L)
+        screen = set_details(ScreenI(1L, True), 11L)
+        screen.linkPlate(plate)
+        assert prune.PLATE.prune(plate) == 11L
+        assert plate.getDetails() is not None
+        assert screen.getDetails() is None
+
+    def test_rule_of_most_specific_class(self):
+        rule = (True, [])
+        pruner = Pruner({Annotation: rule})
+        assert pruner.rule(TagAnnotationI) is rule
+        assert pruner.rule(ImageI) is None
+
+
+class TestUpdateEventId(object):
+
+    def test_details(self):
+        assert prune.update_event_id(set_details(ImageI(1L, True), 5L)) == 5L
+
+    def test_no_update_event(self):
+        assert prune.update_event_id(ImageI(1L, True)) is None
+
+    def test_cache_key(self):
+        annotation = TagAnnotationI(1L, True)
+        annotation.unloadDetails()
+        annotation._cache_key = (1L, 42L)
+        assert prune.update_event_id(annotation) == 42L
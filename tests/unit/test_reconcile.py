@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+import random
+
+import pytest
+
+from omero.rtypes import rlong
+
+from omero_es import reconcile
+
+
+def image_hit(project_id, dataset_id, image_id):
+    return {
+        '_id': '%d_%d' % (dataset_id, image_id), '_parent': str(project_id)
+    }
+
+
+class QueryService(object):
+    """
+    Pages through the ids of the objects with canned `rows`, keyed by the
+    id of the object and in no particular order, as the id and key
+    queries do.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def projection(self, query, params, ctx):
+        self.queries += 1
+        if 'first' in params.map:
+            first, last = params.map['first'].val, params.map['last'].val
+            return [
+                [rlong(v) for v in row] for _id, row in self.rows
+                if first <= _id <= last
+            ]
+        last_id = params.map['id'].val
+        offset, limit = params.theFilter.offset.val, params.theFilter.limit.val
+        ids = sorted(set([v[0] for v in self.rows if v[0] > last_id]))
+        return [[rlong(v)] for v in ids[offset:offset + limit]]
+
+
+class Client(object):
+
+    def __init__(self, rows):
+        self.query_service = QueryService(rows)
+
+    def getSession(self):
+        return self
+
+    def getQueryService(self):
+        return self.query_service
+
+
+class Writer(object):
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def send(self, actions):
+        actions = list(actions)
+        self.sink.actions.extend(actions)
+        return len(actions)
+
+    def wait(self):
+        return len(self.sink.actions)
+
+
+class Sink(object):
+
+    def __init__(self):
+        self.actions = list()
+
+    def writer(self, name):
+        return Writer(self)
+
+    def flush(self, writer=None):
+        pass
+
+
+class TestKeys(object):
+    """
+    The keys of child documents start with their parent.
+    """
+
+    def test_container(self):
+        assert reconcile.parse_container({'_id': '1'}) == (1L,)
+        assert reconcile.format_container((1L,)) == ('1', None)
+
+    def test_image(self):
+        key = reconcile.parse_image(image_hit(1, 2, 3))
+        assert key == (1L, 2L, 3L)
+        assert reconcile.format_image(key) == ('2_3', '1')
+
+    def test_well(self):
+        key = reconcile.parse_well({'_id': '2', '_parent': '1'})
+        assert key == (1L, 2L)
+        assert reconcile.format_well(key) == ('2', '1')
+
+
+class TestExternalSort(object):
+    """
+    Keys are sorted in runs spilled to disk and merged.
+    """
+
+    @pytest.mark.parametrize('run_size', [1, 3, 1000])
+    def test_sort(self, monkeypatch, run_size):
+        monkeypatch.setattr(reconcile, 'RUN_SIZE', run_size)
+        monkeypatch.setattr(reconcile, 'PAGE_SIZE', 2)
+        keys = [
+            (random.randint(0, 5), random.randint(0, 5), v)
+            for v in range(50)
+        ]
+        assert list(reconcile.external_sort(iter(keys), 3)) == sorted(keys)
+
+    def test_large_ids(self):
+        keys = [(2 ** 40, 1), (1, 2 ** 40)]
+        assert list(reconcile.external_sort(iter(keys), 2)) == sorted(keys)
+
+    def test_empty(self):
+        assert list(reconcile.external_sort(iter([]), 1)) == []
+
+
+class TestOrphans(object):
+
+    def test_orphans(self):
+        expected = [(1,), (3,), (5,)]
+        actual = [(0,), (1,), (2,), (5,), (6,)]
+        assert list(reconcile.orphans(expected, actual)) == [
+            (0,), (2,), (6,)
+        ]
+
+    def test_nothing_expected(self):
+        assert list(reconcile.orphans([], [(1,), (2,)])) == [(1,), (2,)]
+
+    def test_nothing_indexed(self):
+        assert list(reconcile.orphans([(1,)], [])) == []
+
+    def test_moved_child(self):
+        # Image:3 of Dataset:2 now in Project:4, its document still in 1
+        expected = [(4, 2, 3)]
+        actual = [(1, 2, 3), (4, 2, 3)]
+        assert list(reconcile.orphans(expected, actual)) == [(1, 2, 3)]
+
+
+class TestStreamKeys(object):
+    """
+    Objects are paged through by id and the keys of their documents
+    sorted.
+    """
+
+    @pytest.mark.parametrize('page_size,queries', [(1, 11), (2, 6), (10, 2)])
+    def test_pages(self, monkeypatch, page_size, queries):
+        monkeypatch.setattr(reconcile, 'PAGE_SIZE', page_size)
+        # DatasetImageLink:4 is to a Dataset in two Projects
+        rows = [
+            (4L, (1L, 1L, 1L)), (2L, (2L, 1L, 5L)), (4L, (2L, 1L, 1L)),
+            (5L, (1L, 2L, 1L)), (3L, (1L, 1L, 2L)), (6L, (2L, 1L, 6L)),
+        ]
+        kind, query, width, parse, unparse = reconcile.TYPES['image']
+        client = Client(rows)
+        keys = list(reconcile.stream_keys(
+            client.getQueryService(), kind, query, width
+        ))
+        assert keys == sorted([v[1] for v in rows])
+        # A key query for each page of ids
+        assert client.query_service.queries == queries
+
+    def test_containers(self, monkeypatch):
+        monkeypatch.setattr(reconcile, 'PAGE_SIZE', 2)
+        client = Client([(v, (v,)) for v in (3L, 1L, 2L)])
+        kind, query, width, parse, unparse = reconcile.TYPES['project']
+        keys = list(reconcile.stream_keys(
+            client.getQueryService(), kind, query, width
+        ))
+        assert keys == [(1L,), (2L,), (3L,)]
+        # Only the ids are queried
+        assert client.query_service.queries == 2
+
+    def test_empty(self):
+        client = Client([])
+        kind, query, width, parse, unparse = reconcile.TYPES['well']
+        assert list(reconcile.stream_keys(
+            client.getQueryService(), kind, query, width
+        )) == []
+
+
+class TestReconcile(object):
+    """
+    Documents missing from OMERO, or under another parent, are deleted.
+    """
+
+    @pytest.fixture(autouse=True)
+    def stub_scan(self, monkeypatch):
+        self.hits = list()
+
+        def scan(es, query, index, doc_type, size):
+            return iter(self.hits)
+        monkeypatch.setattr(reconcile, 'scan', scan)
+
+    def test_images(self):
+        client = Client([(1L, (1L, 2L, 3L)), (2L, (1L, 2L, 4L))])
+        self.hits = [
+            image_hit(1, 2, 4), image_hit(5, 2, 3), image_hit(1, 2, 3),
+            image_hit(1, 6, 7),
+        ]
+        sink = Sink()
+        assert reconcile.reconcile(
+            client, None, sink, 'omero', 'image', False
+        ) == 2
+        assert [json.loads(v)['delete'] for v in sink.actions] == [
+            {'_index': 'omero', '_type': 'image', '_id': '6_7',
+             '_parent': '1'},
+            {'_index': 'omero', '_type': 'image', '_id': '2_3',
+             '_parent': '5'},
+        ]
+
+    def test_projects(self):
+        client = Client([(1L, (1L,)), (3L, (3L,))])
+        self.hits = [{'_id': v} for v in ('3', '2', '1')]
+        sink = Sink()
+        assert reconcile.reconcile(
+            client, None, sink, 'omero', 'project', False
+        ) == 1
+        assert [json.loads(v)['delete'] for v in sink.actions] == [
+            {'_index': 'omero', '_type': 'project', '_id': '2'},
+        ]
+
+    def test_dry_run(self):
+        client = Client([])
+        self.hits = [{'_id': '1', '_parent': '2'}]
+        sink = Sink()
+        assert reconcile.reconcile(
+            client, None, sink, 'omero', 'well', True
+        ) == 1
+        assert sink.actions == []
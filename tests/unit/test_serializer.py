@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import json
+import sys
+
+import pytest
+
+from omero_es import serializer
+
+
+DOCUMENT = {
+    'Name': u'Image \xe9',
+    'Pixels': {'PhysicalSizeX': {'Value': 0.123456789012345}},
+    'SizeX': 512,
+    'Annotations': [],
+}
+
+
+def parse(lines):
+    return [json.loads(v) for v in lines.splitlines()]
+
+
+class TestUse(object):
+    """
+    The backend is the named one, or the fastest installed of the default
+    backends; never `ujson` unless it is asked for.
+    """
+
+    @pytest.fixture(autouse=True)
+    def restore(self, request):
+        backend, dumps = serializer.backend, serializer.dumps
+
+        def restore():
+            serializer.backend, serializer.dumps = backend, dumps
+        request.addfinalizer(restore)
+
+    def test_json(self):
+        assert serializer.use('json') == 'json'
+        assert serializer.dumps is json.dumps
+
+    def test_default(self, monkeypatch):
+        # Installed, as far as `use()` can tell
+        monkeypatch.setitem(sys.modules, 'ujson', sys.modules['json'])
+        assert serializer.use() in serializer.DEFAULT_BACKENDS
+
+    def test_default_fallback(self, monkeypatch):
+        # Not installed
+        monkeypatch.setitem(sys.modules, 'simplejson', None)
+        assert serializer.use() == 'json'
+
+    def test_missing(self, monkeypatch):
+        monkeypatch.setitem(sys.modules, 'ujson', None)
+        backend = serializer.backend
+        with pytest.raises(ImportError):
+            serializer.use('ujson')
+        assert serializer.backend == backend
+
+    @pytest.mark.parametrize('name', ['ujson', 'simplejson', 'json'])
+    def test_round_trip(self, name):
+        pytest.importorskip(name)
+        serializer.use(name)
+        assert json.loads(serializer.dumps(DOCUMENT)) == DOCUMENT
+
+    @pytest.mark.parametrize('value', [
+        0.1, 123.456789012345, 0.000123456789012, 6.02214076e23
+    ])
+    def test_ujson_double_precision(self, value):
+        pytest.importorskip('ujson')
+        serializer.use('ujson')
+        assert json.loads(serializer.dumps({'Value': value})) == \
+            {'Value': value}
+
+    def test_ujson_rounds(self):
+        # Why `ujson` is not a default backend
+        pytest.importorskip('ujson')
+        serializer.use('ujson')
+        assert json.loads(serializer.dumps({'Value': 1.23456789e-14})) != \
+            {'Value': 1.23456789e-14}
+
+
+class TestActions(object):
+    """
+    Actions are serialized by the backend in use around the already
+    serialized source.
+    """
+
+    def test_index(self):
+        action = serializer.index_action('omero', 'image', '2_1', 2L, '{}')
+        assert action.endswith('\n')
+        assert parse(action) == [
+            {'index': {
+                '_index': 'omero', '_type': 'image', '_id': '2_1',
+                '_parent': 2,
+            }},
+            {},
+        ]
+
+    def test_index_container(self):
+        action = serializer.index_action('omero', 'project', 1L, None, '{}')
+        assert parse(action)[0] == {
+            'index': {'_index': 'omero', '_type': 'project', '_id': 1}
+        }
+
+    def test_index_version(self):
+        action = serializer.index_action(
+            'omero', 'project', 1L, None, '{}', 21L
+        )
+        assert parse(action)[0] == {
+            'index': {
+                '_index': 'omero', '_type': 'project', '_id': 1,
+                '_version': 21, '_version_type': 'external',
+            }
+        }
+
+    def test_update(self):
+        action = serializer.update_action(
+            'omero', 'image', '2_1', 2L, '{"doc": {}}'
+        )
+        assert parse(action) == [
+            {'update': {
+                '_index': 'omero', '_type': 'image', '_id': '2_1',
+                '_parent': 2,
+            }},
+            {'doc': {}},
+        ]
+
+    def test_delete(self):
+        action = serializer.delete_action('omero', 'project', 1L, None)
+        assert action.endswith('\n')
+        assert parse(action) == [
+            {'delete': {'_index': 'omero', '_type': 'project', '_id': 1}}
+        ]
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Glencoe Software, Inc. All rights reserved.
+#
+# This software is distributed under the terms described by the LICENCE file
+# you can find at the root of the distribution bundle.
+# If the file is missing please request a copy by contacting
+# jason@glencoesoftware.com.
+#
+
+import zlib
+
+import pytest
+
+from elasticsearch import Urllib3HttpConnection
+
+from omero_es import settings, transport
+from omero_es.transport import Counter, Urllib3Connection
+
+
+BODY = '{"index": {"_id": 1}}\n{"Name": "image"}\n'
+
+
+def gunzip(body):
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+
+class TestTunedConnection(object):
+    """
+    Request bodies are gzipped, and declared so, only by the connections
+    of clients created to compress; the bulk sink's.
+    """
+
+    @pytest.fixture(autouse=True)
+    def perform_request(self, monkeypatch):
+        self.requests = list()
+
+        def perform_request(connection, method, url, params=None, body=None,
+                            timeout=None, ignore=()):
+            self.requests.append((body, dict(connection.headers)))
+            return 200, {}, '{}'
+        monkeypatch.setattr(
+            Urllib3HttpConnection, 'perform_request', perform_request
+        )
+        monkeypatch.setattr(transport, 'sent', Counter())
+
+    def test_compress(self):
+        connection = Urllib3Connection(compress_level=transport.COMPRESS_LEVEL)
+        connection.perform_request('POST', '/_bulk', body=BODY)
+        body, headers = self.requests[0]
+        assert headers['content-encoding'] == 'gzip'
+        assert gunzip(body) == BODY
+        assert (transport.sent.raw, transport.sent.wire) == \
+            (len(BODY), len(body))
+
+    def test_no_compress(self):
+        connection = Urllib3Connection()
+        connection.perform_request('POST', '/_bulk', body=BODY)
+        body, headers = self.requests[0]
+        assert 'content-encoding' not in headers
+        assert body == BODY
+        assert (transport.sent.raw, transport.sent.wire) == \
+            (len(BODY), len(BODY))
+
+    def test_unicode(self):
+        connection = Urllib3Connection(compress_level=transport.COMPRESS_LEVEL)
+        connection.perform_request('POST', '/_bulk', body=u'{"Name": "\xe9"}')
+        assert gunzip(self.requests[0][0]) == '{"Name": "\xc3\xa9"}'
+
+    def test_no_body(self):
+        connection = Urllib3Connection(compress_level=transport.COMPRESS_LEVEL)
+        connection.perform_request('GET', '/')
+        assert self.requests[0][0] is None
+        assert transport.sent.raw == 0
+
+    def test_headers(self):
+        connection = Urllib3Connection(
+            compress_level=transport.COMPRESS_LEVEL,
+            headers={'X-Opaque-Id': 'omero'}
+        )
+        assert connection.headers['x-opaque-id'] == 'omero'
+        assert connection.headers['content-encoding'] == 'gzip'
+
+    @pytest.mark.parametrize('compress,sink,compress_level', [
+        (True, True, transport.COMPRESS_LEVEL),
+        (True, False, 0),
+        (False, True, 0),
+    ])
+    def test_create_elasticsearch(self, compress, sink, compress_level):
+        _settings = dict(settings.SETTINGS, compress=compress)
+        es = settings.create_elasticsearch(
+            'http://localhost:9200', _settings, compress=sink
+        )
+        connection = es.transport.get_connection()
+        assert connection.compress_level == compress_level
+        connection.perform_request('POST', '/_bulk', body=BODY)
+        body, headers = self.requests[0]
+        if compress_level:
+            assert headers['content-encoding'] == 'gzip'
+            assert gunzip(body) == BODY
+        else:
+            assert 'content-encoding' not in headers
+            assert body == BODY